@@ -1,7 +1,9 @@
-import time
 import kopf
-from .aws_base import AwsBackendBase, calculate_maintenance_window
-from ..config import get_one_of, config_get
+from .aws_base import AwsBackendBase, calculate_maintenance_window, describe_all
+from ..config import get_one_of, get_index_one_of, config_get
+from ..util import operations, tracing
+from ..util.aws import aws_client_autoscaling
+from ..util.inventory import aws_managed, get_inventory
 from ..util.reconcile_helpers import field_from_spec
 
 
@@ -11,19 +13,26 @@ def _backend_config(key, default=None, fail_if_missing=False):
 
 def _calc_name(namespace, name):
     # Allow admins to override names so that existing servers not following the schema can still be managed
-    name_overrides = _backend_config("name_overrides", default=[])
-    for override in name_overrides:
-        if override["namespace"] == namespace and override["name"] == name:
-            return override["aws_identifier"]
+    override = get_index_one_of("backends.awsaurora.name_overrides", "backends.aws.name_overrides", fields=("namespace", "name")).get((namespace, name))
+    if override:
+        return override["aws_identifier"]
     return _backend_config("name_pattern", "{namespace}-{name}").format(namespace=namespace, name=name)
 
 
 class AwsAuroraBackend(AwsBackendBase):
 
+    def _region(self):
+        return _backend_config("region", fail_if_missing=True)
+
+    def _config(self, key, default=None, fail_if_missing=False):
+        return _backend_config(key, default=default, fail_if_missing=fail_if_missing)
+
     def server_spec_valid(self, namespace, name, spec):
         server_name = _calc_name(namespace, name)
         if len(server_name) > 63:
             return (False, f"calculated server name '{server_name}' is longer than 63 characters")
+        if field_from_spec(spec, "connectionPooling.enabled", default=False) and len(f"{server_name}-proxy") > 63:
+            return (False, f"calculated proxy name '{server_name}-proxy' is longer than 63 characters")
         size = spec.get("size", dict())
         if size.get("storageGB", 20) < 20:
             return (False, f"size.storageGB must be at least 20 GB")
@@ -50,8 +59,14 @@ class AwsAuroraBackend(AwsBackendBase):
         except:
             return None
 
+    def _clusters(self):
+        return self._inventory("awsaurora-clusters", _list_clusters)
+
+    def _instances(self):
+        return self._inventory("awsaurora-instances", _list_instances)
+
     def server_exists(self, namespace, name):
-        return self._get_cluster(namespace, name) is not None
+        return self._clusters().get(_calc_name(namespace, name), lambda: self._get_cluster(namespace, name)) is not None
 
     def create_or_update_server(self, namespace, name, spec, password, admin_password_changed=False):
         cluster_name = _calc_name(namespace, name)
@@ -74,7 +89,12 @@ class AwsAuroraBackend(AwsBackendBase):
         if scaling_configuration:
             args["ServerlessV2ScalingConfiguration"] = scaling_configuration
 
-        if not existing_cluster:
+        # A change started by an earlier run of the handler is not repeated, only its progress is checked
+        request = dict(spec=spec, admin_password_changed=admin_password_changed)
+        if operations.pending("cluster", request):
+            self._logger.info("Cluster change already in progress")
+            response = {"DBCluster": existing_cluster}
+        elif not existing_cluster:
             response = self._rds_client.create_db_cluster(
                 DBClusterIdentifier=cluster_name,
                 AvailabilityZones=_backend_config("availability_zones", default=[]),
@@ -124,27 +144,15 @@ class AwsAuroraBackend(AwsBackendBase):
                 **args
             )
 
-        # Wait for endpoint to be configured
+        # Wait for endpoint to be configured and the cluster to become available
         self._logger.info("Waiting for cluster to be created")
-        response = field_from_spec(response, "DBCluster")
-        wait_time = 0
-        while not field_from_spec(response, "Endpoint"):
-            if wait_time > 10*60:
-                raise kopf.TemporaryError("Timed out waiting for DB cluster to be created", delay=20)
-            time.sleep(10)
-            wait_time += 10
-            response = self._get_cluster(namespace, name)
+        with tracing.span("wait_for_cluster", **{"aws.resource": cluster_name}):
+            response = self._wait_for("cluster", request, "cluster", [cluster_name],
+                lambda cluster: field_from_spec(cluster, "Endpoint") and field_from_spec(cluster, "Status") == "available",
+                "Timed out waiting for DB cluster to be available")[cluster_name]
+        self._clusters().put(cluster_name, response)
         host = response['Endpoint']
-
-        self._logger.info("Waiting for cluster to become available")
-        response = self._get_cluster(namespace, name)
-        wait_time = 0
-        while field_from_spec(response, "Status") != "available":
-            if wait_time > 10*60:
-                raise kopf.TemporaryError("Timed out waiting for DB cluster to be available", delay=20)
-            time.sleep(10)
-            wait_time += 10
-            response = self._get_cluster(namespace, name)
+        reader_host = response.get("ReaderEndpoint")
 
         # Prepare credentials
         data = {
@@ -159,7 +167,10 @@ class AwsAuroraBackend(AwsBackendBase):
         # Deploy primary (writer) instance
         instance_name = f"{cluster_name}-primary"
         public_access = _backend_config("network.public_access", default=False)
-        if not existing_primary_instance:
+        if operations.pending("primary_instance", request):
+            self._logger.info("Primary instance change already in progress")
+            response = {"DBInstance": existing_primary_instance}
+        elif not existing_primary_instance:
             response = self._rds_client.create_db_instance(
                 DBClusterIdentifier=cluster_name,
                 DBInstanceIdentifier=instance_name,
@@ -182,21 +193,140 @@ class AwsAuroraBackend(AwsBackendBase):
             else:
                 self._logger.info("Primary instance already up-to-date")
 
+        # Readers are started right away, so they become available together with the writer
+        readers = self._reconcile_readers(cluster_name, spec, instance_class, public_access, tags, request)
+
         self._logger.info("Waiting for writer instance to be available")
-        response = field_from_spec(response, "DBInstance")
-        wait_time = 0
-        while field_from_spec(response, "DBInstanceStatus") != "available":
-            if wait_time > 10*60:
-                raise kopf.TemporaryError("Timed out waiting for DB writer instance to be available", delay=20)
-            time.sleep(10)
-            wait_time += 10
-            response = self._get_server(namespace, name, "primary")
+        with tracing.span("wait_for_instance", **{"aws.resource": instance_name}):
+            response = self._wait_for("primary_instance", request, "instance", [instance_name],
+                lambda instance: field_from_spec(instance, "DBInstanceStatus") == "available",
+                "Timed out waiting for DB writer instance to be available",
+                initial={instance_name: field_from_spec(response, "DBInstance")})[instance_name]
+        self._instances().put(instance_name, response)
+
+        if readers:
+            self._logger.info("Waiting for reader instances to be available")
+            with tracing.span("wait_for_readers", **{"aws.resource": cluster_name}):
+                readers = self._wait_for("reader_instances", request, "instance", list(readers.keys()),
+                    lambda instance: field_from_spec(instance, "DBInstanceStatus") == "available",
+                    "Timed out waiting for DB reader instances to be available",
+                    initial=readers)
+            for reader_name, reader in readers.items():
+                self._instances().put(reader_name, reader)
+        autoscaling = self._reconcile_reader_autoscaling(cluster_name, spec)
+        # Without readers the key is removed from the secret again
+        data["reader_host"] = reader_host if readers or autoscaling else None
+
+        with tracing.span("reconcile_proxy", **{"aws.resource": cluster_name}):
+            proxy_host = self._reconcile_proxy(cluster_name, spec, admin_username, password, tags, request, db_cluster=cluster_name)
+        data["proxy_host"] = proxy_host
 
         return data, warnings
 
+    def _cluster_instances(self, cluster_name):
+        paginator = self._rds_client.get_paginator("describe_db_instances")
+        instances = dict()
+        for page in paginator.paginate(Filters=[{"Name": "db-cluster-id", "Values": [cluster_name]}]):
+            for instance in page.get("DBInstances", []):
+                instances[instance["DBInstanceIdentifier"]] = instance
+        return instances
+
+    def _reconcile_readers(self, cluster_name, spec, instance_class, public_access, tags, request):
+        """Create, update and delete the reader instances ({cluster}-reader-{n}) according to readReplicas.count.
+        Returns the wanted readers with their last known state. Readers added by auto scaling are left alone"""
+        count = int(field_from_spec(spec, "readReplicas.count", default=0))
+        reader_class = instance_class
+        if field_from_spec(spec, "readReplicas.class"):
+            reader_class = _determine_instance_class({"class": field_from_spec(spec, "readReplicas.class")})[0]
+        wanted = [f"{cluster_name}-reader-{index}" for index in range(1, count+1)]
+        existing = {identifier: instance for identifier, instance in self._cluster_instances(cluster_name).items() if identifier.startswith(f"{cluster_name}-reader-")}
+        if operations.pending("reader_instances", request):
+            self._logger.info("Reader instance changes already in progress")
+            return {reader_name: existing.get(reader_name) for reader_name in wanted}
+        readers = dict()
+        for reader_name in wanted:
+            reader = existing.get(reader_name)
+            if not reader:
+                self._logger.info(f"Creating reader instance {reader_name}")
+                reader = self._rds_client.create_db_instance(
+                    DBClusterIdentifier=cluster_name,
+                    DBInstanceIdentifier=reader_name,
+                    DBInstanceClass=reader_class,
+                    PubliclyAccessible=public_access,
+                    Engine='aurora-postgresql',
+                    Tags=tags,
+                )["DBInstance"]
+            elif reader.get("DBInstanceClass") != reader_class or reader.get("PubliclyAccessible") != public_access:
+                if reader.get("DBInstanceStatus") != "available":
+                    raise kopf.TemporaryError(f"Waiting for reader instance {reader_name} to be available", delay=20)
+                self._logger.info(f"Updating reader instance {reader_name}")
+                reader = self._rds_client.modify_db_instance(
+                    DBInstanceIdentifier=reader_name,
+                    DBInstanceClass=reader_class,
+                    PubliclyAccessible=public_access,
+                    ApplyImmediately=True,
+                )["DBInstance"]
+            readers[reader_name] = reader
+        for reader_name, reader in existing.items():
+            if reader_name not in wanted and reader.get("DBInstanceStatus") != "deleting":
+                self._logger.info(f"Deleting reader instance {reader_name}")
+                self._rds_client.delete_db_instance(
+                    DBInstanceIdentifier=reader_name,
+                    SkipFinalSnapshot=True,
+                    DeleteAutomatedBackups=False
+                )
+                self._instances().remove(reader_name)
+        return readers
+
+    def replica_status(self, namespace, name, spec):
+        """State of the reader instances (name -> status) for the status of the server object"""
+        cluster_name = _calc_name(namespace, name)
+        status = dict()
+        for index in range(1, int(field_from_spec(spec, "readReplicas.count", default=0))+1):
+            reader_name = f"{cluster_name}-reader-{index}"
+            reader = self._instances().get(reader_name, lambda reader_name=reader_name: self._describe("instance", [reader_name])[reader_name])
+            status[reader_name] = reader.get("DBInstanceStatus") if reader else "missing"
+        return status
+
+    def _reconcile_reader_autoscaling(self, cluster_name, spec):
+        """Let Aurora auto scaling add readers (beyond readReplicas.count) based on their CPU utilization. Returns True if enabled"""
+        client = aws_client_autoscaling(self._region())
+        target = dict(ServiceNamespace="rds", ResourceId=f"cluster:{cluster_name}", ScalableDimension="rds:cluster:ReadReplicaCount")
+        if not field_from_spec(spec, "readReplicas.autoScaling.enabled", default=False):
+            if client.describe_scalable_targets(ServiceNamespace="rds", ResourceIds=[target["ResourceId"]]).get("ScalableTargets"):
+                self._logger.info("Disabling reader auto scaling")
+                # Also removes the scaling policy
+                client.deregister_scalable_target(**target)
+            return False
+        count = int(field_from_spec(spec, "readReplicas.count", default=0))
+        max_count = max(int(field_from_spec(spec, "readReplicas.autoScaling.maxCount", default=count+1)), count)
+        client.register_scalable_target(MinCapacity=count, MaxCapacity=max_count, **target)
+        client.put_scaling_policy(
+            PolicyName=f"{cluster_name}-readers",
+            PolicyType="TargetTrackingScaling",
+            TargetTrackingScalingPolicyConfiguration={
+                "TargetValue": float(field_from_spec(spec, "readReplicas.autoScaling.targetCPU", default=70)),
+                "PredefinedMetricSpecification": {"PredefinedMetricType": "RDSReaderAverageCPUUtilization"},
+            },
+            **target
+        )
+        return True
+
     def delete_server(self, namespace, name):
         cluster_name = _calc_name(namespace, name)
-        # First delete primary instance
+        target = dict(ServiceNamespace="rds", ResourceId=f"cluster:{cluster_name}", ScalableDimension="rds:cluster:ReadReplicaCount")
+        if aws_client_autoscaling(self._region()).describe_scalable_targets(ServiceNamespace="rds", ResourceIds=[target["ResourceId"]]).get("ScalableTargets"):
+            aws_client_autoscaling(self._region()).deregister_scalable_target(**target)
+        # First delete the readers (including the ones added by auto scaling) and the primary instance
+        for instance_name, instance in self._cluster_instances(cluster_name).items():
+            if instance_name != f"{cluster_name}-primary" and instance.get("DBInstanceStatus") != "deleting":
+                self._rds_client.delete_db_instance(
+                    DBInstanceIdentifier=instance_name,
+                    SkipFinalSnapshot=True,
+                    DeleteAutomatedBackups=False
+                )
+                self._instances().remove(instance_name)
+        self._delete_proxy(f"{cluster_name}-proxy")
         self._rds_client.delete_db_instance(
             DBInstanceIdentifier=f"{cluster_name}-primary",
             SkipFinalSnapshot=True,
@@ -207,21 +337,32 @@ class AwsAuroraBackend(AwsBackendBase):
             DBClusterIdentifier=cluster_name,
             SkipFinalSnapshot=True,
         )
+        self._instances().remove(f"{cluster_name}-primary")
+        self._clusters().remove(cluster_name)
 
-    def create_or_update_database(self, namespace, server_name, database_name, spec, admin_credentials=None):
-        primary_instance = self._get_server(namespace, server_name, "primary")
+    def create_or_update_database(self, namespace, server_name, database_name, spec, admin_credentials=None, state=None):
+        primary_instance = self._instances().get(f"{_calc_name(namespace, server_name)}-primary", lambda: self._get_server(namespace, server_name, "primary"))
         if not primary_instance or primary_instance.get("DBInstanceStatus") != "available":
             raise kopf.TemporaryError("Database instance currently not available.", delay=20)
         pgclient = self._pgclient(admin_credentials)
-        pgclient.create_database(database_name)
-        pgclient.restrict_database_permissions(database_name)
+        pgclient.provision_database(database_name, state=state)
         extensions = field_from_spec(spec, "database.extensions", default=[])
         if not extensions:
             return
-        for extension in extensions:
-            self._logger.info(f"Enabling extension {extension}")
-            pgclient.create_extension(extension)
-        return True
+        created, drift = pgclient.reconcile_extensions(extensions, update=config_get("extensions.update", default=False))
+        for extension in created:
+            self._logger.info(f"Enabled extension {extension}")
+        return drift
+
+
+def _list_clusters(region):
+    return [(cluster["DBClusterIdentifier"], cluster) for cluster in describe_all(region, "describe_db_clusters", "DBClusters") if aws_managed(cluster)]
+
+
+def _list_instances(region):
+    # The instances of a cluster are not tagged themselves
+    clusters = get_inventory(("awsaurora-clusters", region), _list_clusters, region).keys()
+    return [(instance["DBInstanceIdentifier"], instance) for instance in describe_all(region, "describe_db_instances", "DBInstances") if aws_managed(instance) or instance.get("DBClusterIdentifier") in clusters]
 
 
 def _map_version(version: str):
@@ -1,14 +1,30 @@
+from abc import ABC, abstractmethod
+import json
+import random
+import threading
+import time
+import kopf
 from .pgclient import PostgresSQLClient
-from ..util.aws import aws_client_rds
+from .pgclient_async import AsyncPostgresSQLClient
+from ..config import config_get
+from ..util import operations
+from ..util.aws import aws_client_rds, aws_client_secretsmanager
+from ..util.executor import run_sync
+from ..util.inventory import get_inventory
 from ..util.reconcile_helpers import field_from_spec
 
 
-class AwsBackendBase:
+# Attempts to change a proxy that is busy with another modification before giving up
+_PROXY_MODIFY_ATTEMPTS = 5
+_proxy_locks = dict()
+
+
+class AwsBackendBase(ABC):
     """
         Common methods used by both AWS backends
     """
     def __init__(self, logger):
-        self._rds_client = aws_client_rds()
+        self._rds_client = aws_client_rds(self._region())
         self._logger = logger
 
     def database_exists(self, namespace, server_name, database_name, admin_credentials=None):
@@ -24,29 +40,317 @@ class AwsBackendBase:
         pgclient = self._pgclient(admin_credentials)
         pgclient.delete_database(database_name)
 
-    def create_or_update_user(self, namespace, server_name, database_name, username, password, admin_credentials=None):
+    def probe_database(self, namespace, server_name, database_name, username, admin_credentials=None):
+        """State of the database and its user, read once per reconcile and passed to create_or_update_database and create_or_update_user"""
+        return self._pgclient(admin_credentials).probe(database=database_name, role=username)
+
+    def create_or_update_user(self, namespace, server_name, database_name, username, password, admin_credentials=None, state=None):
         pgclient = self._pgclient(admin_credentials, dbname=database_name)
-        newly_created = pgclient.create_or_update_user(username, password, database_name)
-        return newly_created, {
-            "username": username,
-            "password": password,
-            "dbname": database_name,
-            "host": admin_credentials["host"],
-            "port": "5432",
-            "sslmode": "require"
-        }
+        newly_created = pgclient.create_or_update_user(username, password, database_name, state=state)
+        self._register_proxy_user(admin_credentials, username, password)
+        return newly_created, _user_credentials(username, password, database_name, admin_credentials)
 
     def delete_user(self, namespace, server_name, username, admin_credentials=None):
         pgclient = self._pgclient(admin_credentials)
         pgclient.delete_user(username)
+        self._unregister_proxy_user(admin_credentials, username)
 
     def update_user_password(self, namespace, server_name, username, password, admin_credentials=None):
         pgclient = self._pgclient(admin_credentials)
         pgclient.update_password(username, password)
+        self._register_proxy_user(admin_credentials, username, password)
+
+    @abstractmethod
+    def _region(self):
+        """Region the backend manages servers in"""
+
+    @abstractmethod
+    def _config(self, key, default=None, fail_if_missing=False):
+        """Value of the backend specific config key"""
+
+    def _inventory(self, kind, fetch):
+        # Servers are listed per region as that is what the client is bound to, fetch is called with the region
+        region = self._rds_client.meta.region_name
+        return get_inventory((kind, region), fetch, region)
 
     def _pgclient(self, admin_credentials, dbname=None) -> PostgresSQLClient:
         return PostgresSQLClient(admin_credentials, dbname=dbname)
 
+    def _wait_for(self, key, request, kind, identifiers, ready, timeout_message, initial=None):
+        """Wait until ready(resource) is true for all the given instances or clusters (kind) and return them (identifier -> resource).
+        The poll interval grows with every attempt, all resources are checked with one describe call per poll.
+        If the handler can resume operations it only polls for the grace period and then gives the handler slot back
+        (operations.OperationPending) with the next poll interval as delay. Attempt and deadline are kept in the operation
+        state, so the backoff and the timeout continue across runs of the handler"""
+        resumable = operations.resumable()
+        state = operations.pending(key, request) or dict()
+        attempt = state.get("attempt", 0)
+        deadline = state.get("deadline") or time.time() + float(_waiter_config("timeout_seconds", 1800))
+        grace_end = time.monotonic() + operations.grace_seconds()
+        resources = dict(initial or dict())
+        unknown = [identifier for identifier in identifiers if not resources.get(identifier)]
+        if unknown:
+            resources.update(self._describe(kind, unknown))
+        while True:
+            waiting = [identifier for identifier in identifiers if not resources.get(identifier) or not ready(resources[identifier])]
+            if not waiting:
+                operations.finished(key)
+                return resources
+            if time.time() > deadline:
+                # Start over on the next run of the handler
+                operations.timed_out(key, timeout_message)
+            delay = _backoff(attempt)
+            attempt += 1
+            if resumable and time.monotonic() + delay > grace_end:
+                operations.wait(key, {"attempt": attempt, "deadline": deadline}, request, delay=max(int(delay), 1))
+            time.sleep(max(min(delay, deadline - time.time()), 0))
+            resources.update(self._describe(kind, waiting))
+
+    def _describe(self, kind, identifiers):
+        """Current state of instances, clusters or proxies (identifier -> resource, None if it does not exist) with as few describe calls as possible"""
+        if kind == "proxy":
+            # describe_db_proxies does not support filters but takes the name of a single proxy
+            return {identifier: self._describe_proxy(identifier) for identifier in identifiers}
+        if kind == "cluster":
+            operation, field, identifier_field, filter_name = "describe_db_clusters", "DBClusters", "DBClusterIdentifier", "db-cluster-id"
+        else:
+            operation, field, identifier_field, filter_name = "describe_db_instances", "DBInstances", "DBInstanceIdentifier", "db-instance-id"
+        resources = {identifier: None for identifier in identifiers}
+        paginator = self._rds_client.get_paginator(operation)
+        # A filter accepts at most 100 values
+        for start in range(0, len(identifiers), 100):
+            for page in paginator.paginate(Filters=[{"Name": filter_name, "Values": identifiers[start:start+100]}]):
+                for resource in page.get(field, []):
+                    resources[resource[identifier_field]] = resource
+        return resources
+
+    def _reconcile_proxy(self, server_name, spec, username, password, tags, request, db_instance=None, db_cluster=None):
+        """Create or update the RDS Proxy of the server if connectionPooling is enabled, delete it otherwise.
+        Returns the endpoint of the proxy"""
+        proxy_name = f"{server_name}-proxy"
+        proxy = self._describe("proxy", [proxy_name])[proxy_name]
+        if not field_from_spec(spec, "connectionPooling.enabled", default=False):
+            if proxy:
+                self._delete_proxy(proxy_name)
+            return None
+        idle_client_timeout = int(field_from_spec(spec, "connectionPooling.idleClientTimeoutSeconds", default=1800))
+        # The proxy logs in with the credentials from Secrets Manager, one secret per user
+        secret_arn = self._proxy_secret(proxy_name, username, password)
+        if operations.pending("proxy", request):
+            self._logger.info("Proxy change already in progress")
+        elif not proxy:
+            self._logger.info("Creating RDS Proxy")
+            proxy = self._rds_client.create_db_proxy(
+                DBProxyName=proxy_name,
+                EngineFamily="POSTGRESQL",
+                Auth=[_proxy_auth(secret_arn)],
+                RoleArn=self._config("proxy.role_arn", fail_if_missing=True),
+                VpcSubnetIds=self._proxy_subnet_ids(),
+                VpcSecurityGroupIds=self._config("vpc_security_group_ids", default=[]),
+                RequireTLS=True,
+                IdleClientTimeout=idle_client_timeout,
+                Tags=tags,
+            )["DBProxy"]
+        else:
+            def changes_for(proxy):
+                changes = _proxy_auth_changes(proxy, add=secret_arn)
+                if proxy.get("IdleClientTimeout") != idle_client_timeout:
+                    changes["IdleClientTimeout"] = idle_client_timeout
+                return changes
+            proxy = self._modify_proxy(proxy_name, changes_for) or proxy
+
+        self._logger.info("Waiting for proxy to be available")
+        proxy = self._wait_for("proxy", request, "proxy", [proxy_name],
+            lambda proxy: proxy.get("Status") == "available",
+            "Timed out waiting for RDS Proxy to be available",
+            initial={proxy_name: proxy})[proxy_name]
+
+        pool_config = {
+            "MaxConnectionsPercent": int(field_from_spec(spec, "connectionPooling.maxConnectionsPercent", default=100)),
+            "MaxIdleConnectionsPercent": int(field_from_spec(spec, "connectionPooling.maxIdleConnectionsPercent", default=50)),
+        }
+        target_group = self._rds_client.describe_db_proxy_target_groups(DBProxyName=proxy_name, TargetGroupName="default")["TargetGroups"][0]
+        current_pool_config = target_group.get("ConnectionPoolConfig", dict())
+        if any(current_pool_config.get(key) != value for key, value in pool_config.items()):
+            self._rds_client.modify_db_proxy_target_group(TargetGroupName="default", DBProxyName=proxy_name, ConnectionPoolConfig=pool_config)
+        targets = self._rds_client.describe_db_proxy_targets(DBProxyName=proxy_name, TargetGroupName="default").get("Targets", [])
+        if not any(target.get("RdsResourceId") in (db_instance, db_cluster) for target in targets):
+            self._logger.info("Registering server with the proxy")
+            if db_cluster:
+                self._rds_client.register_db_proxy_targets(DBProxyName=proxy_name, TargetGroupName="default", DBClusterIdentifiers=[db_cluster])
+            else:
+                self._rds_client.register_db_proxy_targets(DBProxyName=proxy_name, TargetGroupName="default", DBInstanceIdentifiers=[db_instance])
+        return proxy["Endpoint"]
+
+    def _describe_proxy(self, proxy_name):
+        try:
+            return self._rds_client.describe_db_proxies(DBProxyName=proxy_name)["DBProxies"][0]
+        except self._rds_client.exceptions.DBProxyNotFoundFault:
+            return None
+
+    def _modify_proxy(self, proxy_name, changes_for):
+        """Apply the changes returned by changes_for(proxy) and return the proxy (None if it does not exist).
+        Every user of the server changes the Auth list of the proxy and users are reconciled concurrently, so the
+        read-modify-write is serialized per proxy and based on a describe made right before the write.
+        The lock is not held while waiting for a busy proxy, so other users of the server do not block executor threads"""
+        lock = _proxy_locks.setdefault(proxy_name, threading.Lock())
+        for attempt in range(_PROXY_MODIFY_ATTEMPTS):
+            with lock:
+                proxy = self._describe_proxy(proxy_name)
+                if not proxy:
+                    return None
+                changes = changes_for(proxy)
+                if not changes:
+                    return proxy
+                if proxy.get("Status") == "available":
+                    self._logger.info("Updating RDS Proxy")
+                    try:
+                        return self._rds_client.modify_db_proxy(DBProxyName=proxy_name, **changes)["DBProxy"]
+                    except self._rds_client.exceptions.InvalidDBProxyStateFault:
+                        # Started another modification between the describe and the write
+                        pass
+            time.sleep(_backoff(attempt))
+        raise kopf.TemporaryError("Waiting for proxy to be available", delay=20)
+
+    def _proxy_subnet_ids(self):
+        subnet_ids = self._config("proxy.subnet_ids")
+        if subnet_ids:
+            return subnet_ids
+        # Default to the subnets of the DB subnet group the servers are placed in
+        subnet_group = self._rds_client.describe_db_subnet_groups(DBSubnetGroupName=self._config("subnet_group", fail_if_missing=True))["DBSubnetGroups"][0]
+        return [subnet["SubnetIdentifier"] for subnet in subnet_group["Subnets"]]
+
+    def _proxy_secret(self, proxy_name, username, password):
+        """Create or update the Secrets Manager secret the proxy uses to log in as the user, returns its ARN"""
+        client = aws_client_secretsmanager(self._region())
+        secret_name = f"{proxy_name}/{username}"
+        value = json.dumps({"username": username, "password": password})
+        try:
+            current = client.get_secret_value(SecretId=secret_name)
+        except client.exceptions.ResourceNotFoundException:
+            return client.create_secret(Name=secret_name, SecretString=value, Tags=[{"Key": "hybridcloud-postgresql-operator:proxy", "Value": proxy_name}])["ARN"]
+        if current.get("SecretString") != value:
+            client.put_secret_value(SecretId=secret_name, SecretString=value)
+        return current["ARN"]
+
+    def _register_proxy_user(self, admin_credentials, username, password):
+        """Allow a database user to log in via the proxy of the server (if it has one)"""
+        if not admin_credentials or not admin_credentials.get("proxy_host"):
+            return
+        # The name of the proxy is the first part of its endpoint
+        proxy_name = admin_credentials["proxy_host"].split(".")[0]
+        # The secrets are deleted together with the proxy, so none must be created for a proxy that is already gone
+        if not self._describe_proxy(proxy_name):
+            return
+        secret_arn = self._proxy_secret(proxy_name, username, password)
+        self._modify_proxy(proxy_name, lambda proxy: _proxy_auth_changes(proxy, add=secret_arn))
+
+    def _unregister_proxy_user(self, admin_credentials, username):
+        if not admin_credentials or not admin_credentials.get("proxy_host"):
+            return
+        proxy_name = admin_credentials["proxy_host"].split(".")[0]
+        client = aws_client_secretsmanager(self._region())
+        try:
+            secret_arn = client.describe_secret(SecretId=f"{proxy_name}/{username}")["ARN"]
+        except client.exceptions.ResourceNotFoundException:
+            return
+        self._modify_proxy(proxy_name, lambda proxy: _proxy_auth_changes(proxy, remove=secret_arn))
+        client.delete_secret(SecretId=secret_arn, ForceDeleteWithoutRecovery=True)
+
+    def _delete_proxy(self, proxy_name):
+        """Delete the proxy and the secrets of all its users"""
+        try:
+            self._rds_client.delete_db_proxy(DBProxyName=proxy_name)
+        except self._rds_client.exceptions.DBProxyNotFoundFault:
+            # Servers without connection pooling never had a proxy or secrets
+            return
+        self._logger.info("Deleting RDS Proxy")
+        client = aws_client_secretsmanager(self._region())
+        paginator = client.get_paginator("list_secrets")
+        for page in paginator.paginate(Filters=[{"Key": "tag-key", "Values": ["hybridcloud-postgresql-operator:proxy"]}, {"Key": "tag-value", "Values": [proxy_name]}]):
+            for secret in page.get("SecretList", []):
+                client.delete_secret(SecretId=secret["ARN"], ForceDeleteWithoutRecovery=True)
+
+    # Async variants of the methods that only talk to postgres, used by the handlers instead of the ones above
+
+    async def database_exists_async(self, namespace, server_name, database_name, admin_credentials=None):
+        if not admin_credentials:
+            return None
+        return await AsyncPostgresSQLClient(admin_credentials).database_exists(database_name)
+
+    async def delete_database_async(self, namespace, server_name, database_name, admin_credentials=None):
+        if not admin_credentials:
+            self._logger.warn("No admin credentials. Skipping deletion of database")
+            return
+        await AsyncPostgresSQLClient(admin_credentials).delete_database(database_name)
+
+    async def probe_database_async(self, namespace, server_name, database_name, username, admin_credentials=None):
+        return await AsyncPostgresSQLClient(admin_credentials).probe(database=database_name, role=username)
+
+    async def create_or_update_user_async(self, namespace, server_name, database_name, username, password, admin_credentials=None, state=None):
+        newly_created = await AsyncPostgresSQLClient(admin_credentials, dbname=database_name).create_or_update_user(username, password, database_name, state=state)
+        if admin_credentials.get("proxy_host"):
+            await run_sync(self._register_proxy_user, admin_credentials, username, password)
+        return newly_created, _user_credentials(username, password, database_name, admin_credentials)
+
+    async def delete_user_async(self, namespace, server_name, username, admin_credentials=None):
+        await AsyncPostgresSQLClient(admin_credentials).delete_user(username)
+        if admin_credentials and admin_credentials.get("proxy_host"):
+            await run_sync(self._unregister_proxy_user, admin_credentials, username)
+
+    async def update_user_password_async(self, namespace, server_name, username, password, admin_credentials=None):
+        await AsyncPostgresSQLClient(admin_credentials).update_password(username, password)
+        if admin_credentials.get("proxy_host"):
+            await run_sync(self._register_proxy_user, admin_credentials, username, password)
+
+
+def describe_all(region, operation, field):
+    paginator = aws_client_rds(region).get_paginator(operation)
+    for page in paginator.paginate():
+        yield from page.get(field, [])
+
+
+def _user_credentials(username, password, database_name, admin_credentials):
+    credentials = {
+        "username": username,
+        "password": password,
+        "dbname": database_name,
+        "host": admin_credentials["host"],
+        "port": "5432",
+        "sslmode": "require"
+    }
+    # Servers with read replicas or a proxy also provide hosts for read-only or pooled connections,
+    # None removes them from the secret of the database once the server no longer has them
+    for key in ("reader_host", "reader_hosts", "proxy_host"):
+        credentials[key] = admin_credentials.get(key) or None
+    return credentials
+
+
+def _proxy_auth(secret_arn):
+    return {"AuthScheme": "SECRETS", "SecretArn": secret_arn, "IAMAuth": "DISABLED"}
+
+
+def _waiter_config(key, default):
+    return config_get(f"backends.aws.waiter.{key}", default=default)
+
+
+def _proxy_auth_changes(proxy, add=None, remove=None):
+    """Changes to the Auth list of the proxy so that the secret add can log in and the secret remove no longer can"""
+    current = [entry["SecretArn"] for entry in proxy.get("Auth", []) if entry.get("SecretArn")]
+    wanted = [arn for arn in current if arn != remove]
+    if add and add not in wanted:
+        wanted.append(add)
+    if wanted == current:
+        return dict()
+    return {"Auth": [_proxy_auth(arn) for arn in wanted]}
+
+
+def _backoff(attempt):
+    """Poll interval for the attempt, growing from initial_delay_seconds up to max_delay_seconds with some jitter
+    so that many resources started at the same time are not polled in lockstep"""
+    delay = min(float(_waiter_config("initial_delay_seconds", 5)) * 1.5**attempt, float(_waiter_config("max_delay_seconds", 60)))
+    return delay * random.uniform(0.8, 1.2)
+
 
 weekdays = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
 
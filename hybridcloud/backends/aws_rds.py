@@ -1,7 +1,8 @@
-import time
 import kopf
-from .aws_base import AwsBackendBase, calculate_maintenance_window
-from ..config import get_one_of, config_get
+from .aws_base import AwsBackendBase, calculate_maintenance_window, describe_all
+from ..config import get_one_of, get_index_one_of, config_get
+from ..util import operations, tracing
+from ..util.inventory import aws_managed
 from ..util.reconcile_helpers import field_from_spec
 
 
@@ -11,22 +12,31 @@ def _backend_config(key, default=None, fail_if_missing=False):
 
 def _calc_name(namespace, name):
     # Allow admins to override names so that existing servers not following the schema can still be managed
-    name_overrides = _backend_config("name_overrides", default=[])
-    for override in name_overrides:
-        if override["namespace"] == namespace and override["name"] == name:
-            return override["aws_identifier"]
+    override = get_index_one_of("backends.awsrds.name_overrides", "backends.aws.name_overrides", fields=("namespace", "name")).get((namespace, name))
+    if override:
+        return override["aws_identifier"]
     return _backend_config("name_pattern", "{namespace}-{name}").format(namespace=namespace, name=name)
 
 
 class AwsRdsBackend(AwsBackendBase):
 
+    def _region(self):
+        return _backend_config("region", fail_if_missing=True)
+
+    def _config(self, key, default=None, fail_if_missing=False):
+        return _backend_config(key, default=default, fail_if_missing=fail_if_missing)
+
     def server_spec_valid(self, namespace, name, spec):
         server_name = _calc_name(namespace, name)
         if len(server_name) > 63:
             return (False, f"calculated server name '{server_name}' is longer than 63 characters")
+        if field_from_spec(spec, "connectionPooling.enabled", default=False) and len(f"{server_name}-proxy") > 63:
+            return (False, f"calculated proxy name '{server_name}-proxy' is longer than 63 characters")
         size = spec.get("size", dict())
         if size.get("storageGB", 20) < 20:
             return (False, f"size.storageGB must be at least 20 GB")
+        if field_from_spec(spec, "readReplicas.count", default=0) and field_from_spec(spec, "backup.retentionDays", default=7) == 0:
+            return (False, "readReplicas need backups to be enabled (backup.retentionDays > 0)")
         return (True, "")
 
     def _get_server(self, namespace, name):
@@ -39,8 +49,11 @@ class AwsRdsBackend(AwsBackendBase):
         except:
             return None
 
+    def _instances(self):
+        return self._inventory("awsrds-instances", _list_instances)
+
     def server_exists(self, namespace, name):
-        return self._get_server(namespace, name) is not None
+        return self._instances().get(_calc_name(namespace, name), lambda: self._get_server(namespace, name)) is not None
 
     def create_or_update_server(self, namespace, name, spec, password, admin_password_changed=False):
         server_name = _calc_name(namespace, name)
@@ -62,7 +75,12 @@ class AwsRdsBackend(AwsBackendBase):
         if maintenance_window:
             args["PreferredMaintenanceWindow"] = maintenance_window
 
-        if not existing_server:
+        # A change started by an earlier run of the handler is not repeated, only its progress is checked
+        request = dict(spec=spec, admin_password_changed=admin_password_changed)
+        if operations.pending("instance", request):
+            self._logger.info("Instance change already in progress")
+            response = {"DBInstance": existing_server}
+        elif not existing_server:
             if not highavailability:
                 args["AvailabilityZone"] = _backend_config("availability_zone", "eu-central-1a")
             response = self._rds_client.create_db_instance(
@@ -110,15 +128,13 @@ class AwsRdsBackend(AwsBackendBase):
             )
 
         # Wait for endpoint to be available
-        wait_time = 0
         self._logger.info("Waiting for server to be available")
-        response = field_from_spec(response, "DBInstance")
-        while not field_from_spec(response, "Endpoint.Address"):
-            if wait_time > 10*60:
-                raise kopf.TemporaryError("Timed out waiting for DB Instance to be available", delay=30)
-            time.sleep(10)
-            wait_time += 10
-            response = self._get_server(namespace, name)
+        with tracing.span("wait_for_instance", **{"aws.resource": server_name}):
+            response = self._wait_for("instance", request, "instance", [server_name],
+                lambda instance: field_from_spec(instance, "Endpoint.Address"),
+                "Timed out waiting for DB Instance to be available",
+                initial={server_name: field_from_spec(response, "DBInstance")})[server_name]
+        self._instances().put(server_name, response)
 
         # Prepare credentials
         data = {
@@ -129,27 +145,130 @@ class AwsRdsBackend(AwsBackendBase):
             "port": "5432",
             "sslmode": "require"
         }
+
+        replicas = self._reconcile_read_replicas(server_name, response, spec, instance_class, tags, request)
+        if replicas:
+            self._logger.info("Waiting for read replicas to be available")
+            with tracing.span("wait_for_replicas", **{"aws.resource": server_name}):
+                replicas = self._wait_for("read_replicas", request, "instance", list(replicas.keys()),
+                    lambda instance: field_from_spec(instance, "DBInstanceStatus") == "available" and field_from_spec(instance, "Endpoint.Address"),
+                    "Timed out waiting for read replicas to be available",
+                    initial=replicas)
+            for replica_name, replica in replicas.items():
+                self._instances().put(replica_name, replica)
+            data["reader_hosts"] = ",".join(replica["Endpoint"]["Address"] for replica in replicas.values())
+        else:
+            # Remove the hosts from the secret once all replicas are gone
+            data["reader_hosts"] = None
+
+        with tracing.span("reconcile_proxy", **{"aws.resource": server_name}):
+            proxy_host = self._reconcile_proxy(server_name, spec, admin_username, password, tags, request, db_instance=server_name)
+        # None once pooling is disabled, which removes it from the secret
+        data["proxy_host"] = proxy_host
         return data, []
 
+    def _replica_names(self, server_name, spec):
+        return [f"{server_name}-replica-{index}" for index in range(1, int(field_from_spec(spec, "readReplicas.count", default=0))+1)]
+
+    def _reconcile_read_replicas(self, server_name, server, spec, instance_class, tags, request):
+        """Create, update and delete the read replicas ({server}-replica-{n}) according to readReplicas.count.
+        Returns the wanted replicas with their last known state"""
+        wanted = self._replica_names(server_name, spec)
+        replica_class = instance_class
+        if field_from_spec(spec, "readReplicas.class"):
+            replica_class = _determine_instance_class({"class": field_from_spec(spec, "readReplicas.class")})[0]
+        public_access = _backend_config("network.public_access", default=False)
+        existing_names = [replica_name for replica_name in server.get("ReadReplicaDBInstanceIdentifiers", []) if replica_name.startswith(f"{server_name}-replica-")]
+        existing = self._describe("instance", existing_names) if existing_names else dict()
+        if operations.pending("read_replicas", request):
+            self._logger.info("Read replica changes already in progress")
+            return {replica_name: existing.get(replica_name) for replica_name in wanted}
+        replicas = dict()
+        for replica_name in wanted:
+            replica = existing.get(replica_name)
+            if not replica:
+                # Replicas are created from the current state of the instance, which is only possible while it is available
+                if server.get("DBInstanceStatus") != "available":
+                    raise kopf.TemporaryError("Waiting for instance to be available to create read replicas", delay=20)
+                self._logger.info(f"Creating read replica {replica_name}")
+                replica = self._rds_client.create_db_instance_read_replica(
+                    DBInstanceIdentifier=replica_name,
+                    SourceDBInstanceIdentifier=server_name,
+                    DBInstanceClass=replica_class,
+                    PubliclyAccessible=public_access,
+                    VpcSecurityGroupIds=_backend_config("vpc_security_group_ids", default=[]),
+                    AutoMinorVersionUpgrade=True,
+                    CopyTagsToSnapshot=True,
+                    DeletionProtection=_backend_config("deletion_protection", default=False),
+                    Tags=tags,
+                )["DBInstance"]
+            elif replica.get("DBInstanceClass") != replica_class or replica.get("PubliclyAccessible") != public_access:
+                if replica.get("DBInstanceStatus") != "available":
+                    raise kopf.TemporaryError(f"Waiting for read replica {replica_name} to be available", delay=20)
+                self._logger.info(f"Updating read replica {replica_name}")
+                replica = self._rds_client.modify_db_instance(
+                    DBInstanceIdentifier=replica_name,
+                    DBInstanceClass=replica_class,
+                    PubliclyAccessible=public_access,
+                    ApplyImmediately=True,
+                )["DBInstance"]
+            replicas[replica_name] = replica
+        for replica_name, replica in existing.items():
+            if replica_name not in wanted and replica and replica.get("DBInstanceStatus") != "deleting":
+                self._logger.info(f"Deleting read replica {replica_name}")
+                self._delete_replica(replica_name)
+        return replicas
+
+    def _delete_replica(self, replica_name):
+        self._rds_client.delete_db_instance(
+            DBInstanceIdentifier=replica_name,
+            SkipFinalSnapshot=True,
+            DeleteAutomatedBackups=True
+        )
+        self._instances().remove(replica_name)
+
+    def replica_status(self, namespace, name, spec):
+        """State of the read replicas (name -> status) for the status of the server object"""
+        server_name = _calc_name(namespace, name)
+        status = dict()
+        for replica_name in self._replica_names(server_name, spec):
+            replica = self._instances().get(replica_name, lambda replica_name=replica_name: self._describe("instance", [replica_name])[replica_name])
+            status[replica_name] = replica.get("DBInstanceStatus") if replica else "missing"
+        return status
+
     def delete_server(self, namespace, name):
         server_name = _calc_name(namespace, name)
+        # Replicas would be promoted to standalone instances if the source is deleted first
+        server = self._get_server(namespace, name) or dict()
+        replica_names = [replica_name for replica_name in server.get("ReadReplicaDBInstanceIdentifiers", []) if replica_name.startswith(f"{server_name}-replica-")]
+        if replica_names:
+            for replica_name, replica in self._describe("instance", replica_names).items():
+                if replica and replica.get("DBInstanceStatus") != "deleting":
+                    self._delete_replica(replica_name)
+            # RDS rejects deleting the source while its replicas are still being deleted, the handler retries until they are gone
+            raise kopf.TemporaryError("Waiting for read replicas to be deleted", delay=30)
+        self._delete_proxy(f"{server_name}-proxy")
         self._rds_client.delete_db_instance(
             DBInstanceIdentifier=server_name,
             SkipFinalSnapshot=True,
             DeleteAutomatedBackups=False # Keep backups around just in case
         )
+        self._instances().remove(server_name)
 
-    def create_or_update_database(self, namespace, server_name, database_name, spec, admin_credentials=None):
+    def create_or_update_database(self, namespace, server_name, database_name, spec, admin_credentials=None, state=None):
         pgclient = self._pgclient(admin_credentials)
-        pgclient.create_database(database_name)
-        pgclient.restrict_database_permissions(database_name)
+        pgclient.provision_database(database_name, state=state)
         extensions = field_from_spec(spec, "database.extensions", default=[])
         if not extensions:
             return
-        for extension in extensions:
-            self._logger.info(f"Enabling extension {extension}")
-            pgclient.create_extension(extension)
-        return True
+        created, drift = pgclient.reconcile_extensions(extensions, update=config_get("extensions.update", default=False))
+        for extension in created:
+            self._logger.info(f"Enabled extension {extension}")
+        return drift
+
+
+def _list_instances(region):
+    return [(instance["DBInstanceIdentifier"], instance) for instance in describe_all(region, "describe_db_instances", "DBInstances") if aws_managed(instance)]
 
 
 def _map_version(version: str):
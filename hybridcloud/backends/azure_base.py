@@ -0,0 +1,152 @@
+from abc import ABC, abstractmethod
+from azure.core.exceptions import ResourceNotFoundError
+from . import pgpool
+from .pgclient import PostgresSQLClient
+from .pgclient_async import AsyncPostgresSQLClient, close_pools
+from ..config import config_get
+from ..util.reconcile_helpers import field_from_spec
+
+
+class AzureBackendBase(ABC):
+    """
+        Common methods used by both Azure backends. The sync methods and their async variants only differ in the
+        Azure clients they use, everything around the Azure calls is shared
+    """
+
+    @abstractmethod
+    def _config(self, key, default=None, fail_if_missing=False):
+        """Value of the backend specific config key"""
+
+    @abstractmethod
+    def _calc_name(self, namespace, name):
+        """Name of the server in Azure"""
+
+    @abstractmethod
+    def _db_client_async(self):
+        """aio variant of the management client of the backend"""
+
+    @abstractmethod
+    def _database_parameters(self, spec):
+        """Database model of the backend with the charset and collation from the spec"""
+
+    @abstractmethod
+    def _server_update(self, tags):
+        """Server update model of the backend that sets the tags"""
+
+    def database_exists(self, namespace, server_name, database_name, admin_credentials=None):
+        try:
+            self._db_client.databases.get(self._resource_group, self._calc_name(namespace, server_name), database_name)
+            return True
+        except ResourceNotFoundError:
+            return False
+
+    def probe_database(self, namespace, server_name, database_name, username, admin_credentials=None):
+        """State of the database and its user, read once per reconcile and passed to create_or_update_database and create_or_update_user"""
+        return self._pgclient(admin_credentials).probe(database=database_name, role=username)
+
+    def delete_server(self, namespace, name):
+        server_name = self._calc_name(namespace, name)
+        if self._config("server_delete_fake", default=False):
+            # Set tag to mark server as deleted
+            poller = self._db_client.servers.begin_update(self._resource_group, server_name, self._server_update(_deletion_tags(namespace, name)))
+            self._inventory.put(server_name, poller.result())
+            return
+        self._delete_server_dependencies(server_name)
+        poller = self._db_client.servers.begin_delete(self._resource_group, server_name)
+        poller.result()
+        self._server_deleted(server_name)
+
+    def delete_database(self, namespace, server_name, database_name, admin_credentials=None):
+        if self._config("database_delete_fake", default=False):
+            # Do nothing
+            return
+        if admin_credentials:
+            # Pooled connections to the database would prevent deleting it
+            pgpool.close_pools(admin_credentials["host"], admin_credentials["port"], database_name)
+        poller = self._db_client.databases.begin_delete(self._resource_group, self._calc_name(namespace, server_name), database_name)
+        poller.result()
+
+    def delete_user(self, namespace, server_name, username, admin_credentials=None):
+        pgclient = self._pgclient(admin_credentials)
+        pgclient.delete_user(username)
+
+    def update_user_password(self, namespace, server_name, username, password, admin_credentials=None):
+        pgclient = self._pgclient(admin_credentials)
+        pgclient.update_password(username, password)
+
+    def _provision_database(self, pgclient, database_name, spec, state):
+        """Everything done via postgres after the database was created via the azure api, returns the extension drift"""
+        pgclient.provision_database(database_name, create=False, state=state)
+        extensions = field_from_spec(spec, "database.extensions", default=[])
+        if not extensions:
+            return None
+        return self._log_extensions(*pgclient.reconcile_extensions(extensions, update=config_get("extensions.update", default=False)))
+
+    def _database_created(self, state):
+        if state is not None and not state["database_exists"]:
+            # Just created via the azure api, PUBLIC has access to new databases
+            state.update(database_exists=True, public_has_access=True)
+
+    def _delete_server_dependencies(self, server_name):
+        """Delete resources that belong to the server before the server itself is deleted"""
+
+    def _server_deleted(self, server_name):
+        self._inventory.remove(server_name)
+
+    def _pgclient(self, admin_credentials, dbname=None) -> PostgresSQLClient:
+        return PostgresSQLClient(admin_credentials, dbname)
+
+    def _log_extensions(self, created, drift):
+        for extension in created:
+            self._logger.info(f"Enabled extension {extension}")
+        return drift
+
+    # Async variants used by the handlers instead of the ones above. They use the aio Azure clients, so polling
+    # long-running operations (e.g. of many databases at once) does not block an executor thread each
+
+    async def database_exists_async(self, namespace, server_name, database_name, admin_credentials=None):
+        try:
+            await self._db_client_async().databases.get(self._resource_group, self._calc_name(namespace, server_name), database_name)
+            return True
+        except ResourceNotFoundError:
+            return False
+
+    async def probe_database_async(self, namespace, server_name, database_name, username, admin_credentials=None):
+        return await AsyncPostgresSQLClient(admin_credentials).probe(database=database_name, role=username)
+
+    async def delete_server_async(self, namespace, name):
+        db_client = self._db_client_async()
+        server_name = self._calc_name(namespace, name)
+        if self._config("server_delete_fake", default=False):
+            # Set tag to mark server as deleted
+            poller = await db_client.servers.begin_update(self._resource_group, server_name, self._server_update(_deletion_tags(namespace, name)))
+            self._inventory.put(server_name, await poller.result())
+            return
+        await self._delete_server_dependencies_async(server_name)
+        poller = await db_client.servers.begin_delete(self._resource_group, server_name)
+        await poller.result()
+        self._server_deleted(server_name)
+
+    async def delete_database_async(self, namespace, server_name, database_name, admin_credentials=None):
+        if self._config("database_delete_fake", default=False):
+            # Do nothing
+            return
+        if admin_credentials:
+            # Pooled connections to the database would prevent deleting it
+            await close_pools(admin_credentials["host"], admin_credentials["port"], database_name)
+        poller = await self._db_client_async().databases.begin_delete(self._resource_group, self._calc_name(namespace, server_name), database_name)
+        await poller.result()
+
+    async def _provision_database_async(self, pgclient, database_name, spec, state):
+        await pgclient.provision_database(database_name, create=False, state=state)
+        extensions = field_from_spec(spec, "database.extensions", default=[])
+        if not extensions:
+            return None
+        return self._log_extensions(*await pgclient.reconcile_extensions(extensions, update=config_get("extensions.update", default=False)))
+
+    async def _delete_server_dependencies_async(self, server_name):
+        pass
+
+
+def _deletion_tags(namespace, name):
+    return {"hybridcloud-postgresql-operator:namespace": namespace, "hybridcloud-postgresql-operator:name": name, "hybridcloud-postgresql-operator:marked-for-deletion": "yes"}
@@ -2,9 +2,12 @@ from azure.core.exceptions import ResourceNotFoundError
 from azure.mgmt.network.models import PrivateEndpoint, Subnet, PrivateLinkServiceConnection
 from azure.mgmt.rdbms.postgresql.models import ServerForCreate, ServerPropertiesForDefaultCreate, ServerUpdateParameters, ServerVersion, Sku, StorageProfile, Database, Configuration, VirtualNetworkRule, FirewallRule
 from azure.mgmt.resource.locks.models import ManagementLockObject
-from .pgclient import PostgresSQLClient
-from ..config import get_one_of, config_get
-from ..util.azure import azure_client_locks, azure_client_postgres, azure_client_network, azure_client_privatedns
+from .azure_base import AzureBackendBase
+from .pgclient_async import AsyncPostgresSQLClient
+from ..config import get_one_of, get_index_one_of, config_get
+from ..util import operations
+from ..util.inventory import azure_managed, get_inventory
+from ..util.azure import azure_client_locks, azure_client_postgres, azure_client_postgres_async, azure_client_network, azure_client_network_async, azure_client_privatedns, azure_client_privatedns_async, wait_all, wait_for_operation
 from ..util.reconcile_helpers import field_from_spec
 
 
@@ -16,16 +19,19 @@ def _backend_config(key, default=None, fail_if_missing=False):
 EXTENSIONS_PARAMETER = "shared_preload_libraries"
 
 
+def _list_servers(resource_group):
+    return [(server.name, server) for server in azure_client_postgres().servers.list_by_resource_group(resource_group) if azure_managed(server)]
+
+
 def _calc_name(namespace, name):
     # Allow admins to override names so that existing storage accounts not following the schema can still be managed
-    name_overrides = _backend_config("name_overrides", default=[])
-    for override in name_overrides:
-        if override["namespace"] == namespace and override["name"] == name:
-            return override["azure_name"]
+    override = get_index_one_of("backends.azurepostgres.name_overrides", "backends.azure.name_overrides", fields=("namespace", "name")).get((namespace, name))
+    if override:
+        return override["azure_name"]
     return _backend_config("name_pattern", fail_if_missing=True).format(namespace=namespace, name=name)
 
 
-class AzurePostgreSQLBackend:
+class AzurePostgreSQLBackend(AzureBackendBase):
 
     def __init__(self, logger):
         self._db_client = azure_client_postgres()
@@ -35,6 +41,7 @@ class AzurePostgreSQLBackend:
         self._subscription_id = _backend_config("subscription_id", fail_if_missing=True)
         self._location = _backend_config("location", fail_if_missing=True)
         self._resource_group = _backend_config("resource_group", fail_if_missing=True)
+        self._inventory = get_inventory(("azurepostgres", self._subscription_id, self._resource_group), _list_servers, self._resource_group)
         self._virtual_network = _backend_config("virtual_network")
         self._subnet = _backend_config("subnet")
         self._logger = logger
@@ -51,23 +58,18 @@ class AzurePostgreSQLBackend:
         if storage_limit and size.get("storageGB", 1) > storage_limit:
             return (False, f"size.storageGB is limited to {storage_limit} GB")
         if size.get("storageGB", 100) < 100:
-            return (False, f"size.storageGB must be at least 100 GB")
+            return (False, "size.storageGB must be at least 100 GB")
         return (True, "")
 
-    def server_exists(self, namespace, name):
-        server_name = _calc_name(namespace, name)
+    def _get_server(self, server_name):
         try:
             return self._db_client.servers.get(self._resource_group, server_name)
         except ResourceNotFoundError:
-            return False
+            return None
 
-    def database_exists(self, namespace, server_name, database_name, admin_credentials=None):
-        server_name = _calc_name(namespace, server_name)
-        try:
-            self._db_client.databases.get(self._resource_group, server_name, database_name)
-            return True
-        except ResourceNotFoundError:
-            return False
+    def server_exists(self, namespace, name):
+        server_name = _calc_name(namespace, name)
+        return self._inventory.get(server_name, lambda: self._get_server(server_name)) or False
 
     def create_or_update_server(self, namespace, name, spec, password, admin_password_changed=False):
         warnings = []
@@ -117,8 +119,9 @@ class AzurePostgreSQLBackend:
             server = None
             changed = True
 
-        if not server:
-            poller = self._db_client.servers.begin_create(self._resource_group,
+        # Operations started by an earlier run of the handler are resumed instead of started again
+        if not server or operations.pending("server_create"):
+            server = wait_for_operation("server_create", self._db_client.servers.begin_create, self._resource_group,
                 server_name, 
                 ServerForCreate(
                     location=self._location,
@@ -140,8 +143,7 @@ class AzurePostgreSQLBackend:
                     tags=tags
                 )
             )
-            server = poller.result()
-        elif changed:
+        elif changed or operations.pending("server_update"):
             parameters = ServerUpdateParameters(
                 sku=sku,
                 public_network_access=public_network_access,
@@ -155,13 +157,16 @@ class AzurePostgreSQLBackend:
                 version=version,
                 tags=tags
             )
-            poller = self._db_client.servers.begin_update(self._resource_group, server_name, parameters)
-            server = poller.result()
+            server = wait_for_operation("server_update", self._db_client.servers.begin_update, self._resource_group, server_name, parameters)
+
+        self._inventory.put(server_name, server)
 
         if _backend_config("lock_from_deletion", default=False):
             self._lock_client.management_locks.create_or_update_at_resource_level(self._resource_group, "Microsoft.DBforPostgreSQL", "", "servers", server_name, "DoNotDeleteLock", parameters=ManagementLockObject(level="CanNotDelete", notes="Protection from accidental deletion"))
 
         if public_network_access == "Enabled":
+            # vnet and firewall rules are independent of each other, so all changes are started together
+            rule_operations = []
             # vnets
             existing_vnet_rules = dict()
             for vnet in self._db_client.virtual_network_rules.list_by_server(self._resource_group, server_name):
@@ -176,10 +181,9 @@ class AzurePostgreSQLBackend:
                     if existing.virtual_network_subnet_id == subnet_id:
                         # Rule is the same, skip update
                         continue
-                poller = self._db_client.virtual_network_rules.begin_create_or_update(self._resource_group, server_name, rule_name, VirtualNetworkRule(virtual_network_subnet_id=subnet_id, ignore_missing_vnet_service_endpoint=True))
-                poller.result()
+                rule_operations.append(lambda rule_name=rule_name, subnet_id=subnet_id: self._db_client.virtual_network_rules.begin_create_or_update(self._resource_group, server_name, rule_name, VirtualNetworkRule(virtual_network_subnet_id=subnet_id, ignore_missing_vnet_service_endpoint=True)))
             for rule in existing_vnet_rules.keys():
-                self._db_client.virtual_network_rules.begin_delete(self._resource_group, server_name, rule).result()
+                rule_operations.append(lambda rule=rule: self._db_client.virtual_network_rules.begin_delete(self._resource_group, server_name, rule))
 
             # firewall rules
             existing_rules = dict()
@@ -197,18 +201,18 @@ class AzurePostgreSQLBackend:
                     # Rule is the same, skip update
                     if existing.start_ip_address == rule["start_ip"] and existing.end_ip_address == rule["end_ip"]:
                         continue
-                poller = self._db_client.firewall_rules.begin_create_or_update(self._resource_group, server_name, rule["name"], FirewallRule(start_ip_address=rule["start_ip"], end_ip_address=rule["end_ip"]))
-                poller.result()
+                rule_operations.append(lambda rule=rule: self._db_client.firewall_rules.begin_create_or_update(self._resource_group, server_name, rule["name"], FirewallRule(start_ip_address=rule["start_ip"], end_ip_address=rule["end_ip"])))
             for rule in existing_rules.keys():
-                self._db_client.firewall_rules.begin_delete(self._resource_group, server_name, rule).result()
+                rule_operations.append(lambda rule=rule: self._db_client.firewall_rules.begin_delete(self._resource_group, server_name, rule))
+            wait_all(rule_operations, _backend_config("max_parallel_operations", default=5))
 
         if create_private_endpoint:
             self._logger.info("Creating private endpoint for server")
             # Create private endpoint
-            poller = self._network_client.private_endpoints.begin_create_or_update(
+            private_endpoint = wait_for_operation("private_endpoint", self._network_client.private_endpoints.begin_create_or_update,
                 self._resource_group,            
                 server_name,
-                parameters=PrivateEndpoint(
+                PrivateEndpoint(
                     location=self._location, 
                     subnet=Subnet(id=f"/subscriptions/{self._subscription_id}/resourceGroups/{self._resource_group}/providers/Microsoft.Network/virtualNetworks/{self._virtual_network}/subnets/{self._subnet}"),
                     private_link_service_connections=[PrivateLinkServiceConnection(
@@ -218,7 +222,6 @@ class AzurePostgreSQLBackend:
                     )],
                 )
             )
-            private_endpoint = poller.result()
             # Create private DNS record
             self._dns_client.record_sets.create_or_update(        
                 self._resource_group,
@@ -249,10 +252,10 @@ class AzurePostgreSQLBackend:
             # Update configuration
             poller = self._db_client.configurations.begin_create_or_update(self._resource_group, server_name, EXTENSIONS_PARAMETER, Configuration(value=",".join(extensions), source="user-override"))
             poller.result()
+        if extensions != applied_extensions or operations.pending("restart"):
             # Restart server
             self._logger.info("Restarting server due to changed extensions preload configuration")
-            poller = self._db_client.servers.begin_restart(self._resource_group, server_name)
-            poller.result()
+            wait_for_operation("restart", self._db_client.servers.begin_restart, self._resource_group, server_name)
         
         # Prepare credentials
         data = {
@@ -265,50 +268,15 @@ class AzurePostgreSQLBackend:
         }
         return data, warnings
 
-    def create_or_update_database(self, namespace, server_name, database_name, spec, admin_credentials=None):
-        server_name = _calc_name(namespace, server_name)
-        parameters = Database(charset=field_from_spec(spec, "database.charset", default="UTF8"), collation=field_from_spec(spec, "database.collation", default="English_United States.1252"))
-        poller = self._db_client.databases.begin_create_or_update(self._resource_group, server_name, database_name, parameters)
-        poller.result()
-        pgclient = self._pgclient(admin_credentials, database_name)
-        pgclient.restrict_database_permissions(database_name)
-        extensions = field_from_spec(spec, "database.extensions", default=[])
-        if not extensions:
-            return
-        for extension in extensions:
-            self._logger.info(f"Enabling extension {extension}")
-            pgclient.create_extension(extension)
-
-    def delete_server(self, namespace, name):
-        server_name = _calc_name(namespace, name)
-        delete_fake = _backend_config("server_delete_fake", default=False)
-        if delete_fake:
-            # Set tag to mark server as deleted
-            parameters = ServerUpdateParameters(
-                tags={"hybridcloud-postgresql-operator:namespace": namespace, "hybridcloud-postgresql-operator:name": name, "hybridcloud-postgresql-operator:marked-for-deletion": "yes"}
-            )
-            poller = self._db_client.servers.begin_update(self._resource_group, server_name, parameters)
-            poller.result()
-            return
-        if config_get("backends.azurepostgres.create_private_endpoint", default=False):
-            poller = self._network_client.private_endpoints.begin_delete(self._resource_group, server_name)
-            poller.result()
-            self._dns_client.record_sets.delete(self._resource_group, 'postgres.database.azure.com', 'A', server_name)
-        poller = self._db_client.servers.begin_delete(self._resource_group, server_name)
+    def create_or_update_database(self, namespace, server_name, database_name, spec, admin_credentials=None, state=None):
+        poller = self._db_client.databases.begin_create_or_update(self._resource_group, _calc_name(namespace, server_name), database_name, self._database_parameters(spec))
         poller.result()
+        self._database_created(state)
+        return self._provision_database(self._pgclient(admin_credentials, database_name), database_name, spec, state)
 
-    def delete_database(self, namespace, server_name, database_name, admin_credentials=None):
-        server_name = _calc_name(namespace, server_name)
-        delete_fake = _backend_config("database_delete_fake", default=False)
-        if delete_fake:
-            # Do nothing
-            return
-        poller = self._db_client.databases.begin_delete(self._resource_group, server_name, database_name)
-        poller.result()
-    
-    def create_or_update_user(self, namespace, server_name, database_name, username, password, admin_credentials=None):
+    def create_or_update_user(self, namespace, server_name, database_name, username, password, admin_credentials=None, state=None):
         pgclient = self._pgclient(admin_credentials)
-        newly_created = pgclient.create_or_update_user(username, password, database_name)
+        newly_created = pgclient.create_or_update_user(username, password, database_name, state=state)
         server_host = admin_credentials["host"]
         return newly_created, {
             "username": f"{username}@{server_host}",
@@ -319,16 +287,40 @@ class AzurePostgreSQLBackend:
             "sslmode": "require"
         }
 
-    def delete_user(self, namespace, server_name, username, admin_credentials=None):
-        pgclient = self._pgclient(admin_credentials)
-        pgclient.delete_user(username)
+    def _config(self, key, default=None, fail_if_missing=False):
+        return _backend_config(key, default=default, fail_if_missing=fail_if_missing)
 
-    def update_user_password(self, namespace, server_name, username, password, admin_credentials=None):
-        pgclient = self._pgclient(admin_credentials)
-        pgclient.update_password(username, password)
+    def _calc_name(self, namespace, name):
+        return _calc_name(namespace, name)
+
+    def _db_client_async(self):
+        return azure_client_postgres_async()
+
+    def _database_parameters(self, spec):
+        return Database(charset=field_from_spec(spec, "database.charset", default="UTF8"), collation=field_from_spec(spec, "database.collation", default="English_United States.1252"))
+
+    def _server_update(self, tags):
+        return ServerUpdateParameters(tags=tags)
 
-    def _pgclient(self, admin_credentials, dbname=None) -> PostgresSQLClient:
-        return PostgresSQLClient(admin_credentials, dbname)
+    def _delete_server_dependencies(self, server_name):
+        if config_get("backends.azurepostgres.create_private_endpoint", default=False):
+            poller = self._network_client.private_endpoints.begin_delete(self._resource_group, server_name)
+            poller.result()
+            self._dns_client.record_sets.delete(self._resource_group, 'postgres.database.azure.com', 'A', server_name)
+
+    # Async variants used by the handlers instead of the ones above, see AzureBackendBase
+
+    async def create_or_update_database_async(self, namespace, server_name, database_name, spec, admin_credentials=None, state=None):
+        poller = await self._db_client_async().databases.begin_create_or_update(self._resource_group, _calc_name(namespace, server_name), database_name, self._database_parameters(spec))
+        await poller.result()
+        self._database_created(state)
+        return await self._provision_database_async(AsyncPostgresSQLClient(admin_credentials, database_name), database_name, spec, state)
+
+    async def _delete_server_dependencies_async(self, server_name):
+        if config_get("backends.azurepostgres.create_private_endpoint", default=False):
+            poller = await azure_client_network_async().private_endpoints.begin_delete(self._resource_group, server_name)
+            await poller.result()
+            await azure_client_privatedns_async().record_sets.delete(self._resource_group, 'postgres.database.azure.com', 'A', server_name)
 
 
 def _determine_sku(size_spec):
@@ -1,11 +1,16 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import threading
+import time
 from azure.core.exceptions import ResourceNotFoundError
 from azure.mgmt.rdbms.postgresql_flexibleservers.models import ServerVersion, Sku, Database, Configuration, FirewallRule, Server, ServerForUpdate, Storage, Backup, Network, HighAvailability, MaintenanceWindow
 from azure.mgmt.resource.locks.models import ManagementLockObject
 import kopf
-from .pgclient import PostgresSQLClient
-from ..config import get_one_of, config_get
-from ..util.azure import azure_client_locks, azure_client_postgres_flexible, azure_client_network, azure_client_privatedns
+from .azure_base import AzureBackendBase
+from .pgclient_async import AsyncPostgresSQLClient
+from ..config import get_one_of, get_index_one_of, config_get
+from ..util.inventory import azure_managed, get_inventory
+from ..util.azure import azure_client_locks, azure_client_postgres_flexible, azure_client_postgres_flexible_async, azure_client_network, azure_client_privatedns, wait_all, wait_for_operation
+from ..util import operations, tracing
 from ..util.reconcile_helpers import field_from_spec
 
 
@@ -19,17 +24,34 @@ PRELOAD_LIST = ["timescaledb", "pg_cron", "pg_partman_bgw", "pg_partman", "pg_pr
 
 IGNORE_RESET_PARAMETERS = [PRELOAD_PARAMETER, EXTENSIONS_PARAMETER, "log_autovacuum_min_duration", "vacuum_cost_page_miss", "temp_tablespaces", "commit_timestamp_buffers", "subtransaction_buffers", "transaction_buffers"]
 
+# Defaults and restrictions of the server parameters are the same for all servers with the same version and SKU.
+# Defaults like max_connections or shared_buffers depend on the size of the SKU, not only on the tier
+_parameter_catalogs = dict()  # (version, tier, sku name) -> parameter name -> (default value, read-only, dynamic)
+# Above this many parameters listing all parameters of the server (a few pages) needs fewer calls than getting them one by one
+_PARAMETER_GET_LIMIT = 4
+# Parameters set by the operator per server and when all parameters of the server were last listed
+_managed_parameters = dict()  # server name -> (listed at, parameter names)
+_parameters_lock = threading.Lock()
+
+
+def _max_parallel_operations():
+    # Limit the number of concurrent long-running operations per step so the Azure API does not throttle
+    return _backend_config("max_parallel_operations", default=5)
+
+
+def _list_servers(resource_group):
+    return [(server.name, server) for server in azure_client_postgres_flexible().servers.list_by_resource_group(resource_group) if azure_managed(server)]
+
 
 def _calc_name(namespace, name):
     # Allow admins to override names so that existing storage accounts not following the schema can still be managed
-    name_overrides = _backend_config("name_overrides", default=[])
-    for override in name_overrides:
-        if override["namespace"] == namespace and override["name"] == name:
-            return override["azure_name"]
+    override = get_index_one_of("backends.azurepostgresflexible.name_overrides", "backends.azure.name_overrides", fields=("namespace", "name")).get((namespace, name))
+    if override:
+        return override["azure_name"]
     return _backend_config("name_pattern", fail_if_missing=True).format(namespace=namespace, name=name)
 
 
-class AzurePostgreSQLFlexibleBackend:
+class AzurePostgreSQLFlexibleBackend(AzureBackendBase):
 
     def __init__(self, logger):
         self._db_client = azure_client_postgres_flexible()
@@ -39,6 +61,7 @@ class AzurePostgreSQLFlexibleBackend:
         self._subscription_id = _backend_config("subscription_id", fail_if_missing=True)
         self._location = _backend_config("location", fail_if_missing=True)
         self._resource_group = _backend_config("resource_group", fail_if_missing=True)
+        self._inventory = get_inventory(("azurepostgresflexible", self._subscription_id, self._resource_group), _list_servers, self._resource_group)
         self._virtual_network = _backend_config("virtual_network")
         self._subnet = _backend_config("subnet")
         self._private_dns_zone = _backend_config("dns_zone.name", default=_backend_config("dns_zone"))
@@ -60,20 +83,15 @@ class AzurePostgreSQLFlexibleBackend:
             return (False, "size.storageGB must be at least 32 GB")
         return (True, "")
 
-    def server_exists(self, namespace, name):
-        server_name = _calc_name(namespace, name)
+    def _get_server(self, server_name):
         try:
             return self._db_client.servers.get(self._resource_group, server_name)
         except ResourceNotFoundError:
-            return False
+            return None
 
-    def database_exists(self, namespace, server_name, database_name, admin_credentials=None):
-        server_name = _calc_name(namespace, server_name)
-        try:
-            self._db_client.databases.get(self._resource_group, server_name, database_name)
-            return True
-        except ResourceNotFoundError:
-            return False
+    def server_exists(self, namespace, name):
+        server_name = _calc_name(namespace, name)
+        return self._inventory.get(server_name, lambda: self._get_server(server_name)) or False
 
     def create_or_update_server(self, namespace, name, spec, password, admin_password_changed=False):
         warnings = []
@@ -129,45 +147,83 @@ class AzurePostgreSQLFlexibleBackend:
             server = None
             changed = True
 
-        if not server:
-            parameters = Server(
-                location=self._location,
-                sku=sku,
-                administrator_login=admin_username,
-                administrator_login_password=password,
-                version=_map_version(spec.get("version")),
-                storage=Storage(storage_size_gb=storage_gb),
-                backup=backup,
-                network=network,
-                high_availability=high_availability,
-                maintenance_window=maintenance_window,
-                availability_zone=config_get("backends.azurepostgresflexible.availability_zone", default="1"),
-                tags=tags
-            )
-            poller = self._db_client.servers.begin_create(self._resource_group,
-                server_name, 
-                parameters=parameters
-            )
-            server = poller.result()
-        elif changed:
-            parameters = ServerForUpdate(
-                sku=sku,
-                administrator_login_password=password,
-                storage=Storage(storage_size_gb=storage_gb),
-                backup=backup,
-                high_availability=high_availability,
-                maintenance_window=maintenance_window,
-                tags=tags
-            )
-            poller = self._db_client.servers.begin_update(self._resource_group, server_name, parameters)
-            server = poller.result()
+        # Restarts of new servers do not interrupt anyone, so they are never postponed to the maintenance window
+        server_existed = server is not None and not operations.pending("server_create")
+
+        with tracing.span("server", **{"azure.resource": server_name}):
+            # Operations started by an earlier run of the handler are resumed instead of started again
+            if not server or operations.pending("server_create"):
+                parameters = Server(
+                    location=self._location,
+                    sku=sku,
+                    administrator_login=admin_username,
+                    administrator_login_password=password,
+                    version=_map_version(spec.get("version")),
+                    storage=Storage(storage_size_gb=storage_gb),
+                    backup=backup,
+                    network=network,
+                    high_availability=high_availability,
+                    maintenance_window=maintenance_window,
+                    availability_zone=config_get("backends.azurepostgresflexible.availability_zone", default="1"),
+                    tags=tags
+                )
+                server = wait_for_operation("server_create", self._db_client.servers.begin_create, self._resource_group, server_name, parameters)
+            elif changed or operations.pending("server_update"):
+                parameters = ServerForUpdate(
+                    sku=sku,
+                    administrator_login_password=password,
+                    storage=Storage(storage_size_gb=storage_gb),
+                    backup=backup,
+                    high_availability=high_availability,
+                    maintenance_window=maintenance_window,
+                    tags=tags
+                )
+                server = wait_for_operation("server_update", self._db_client.servers.begin_update, self._resource_group, server_name, parameters)
+
+        self._inventory.put(server_name, server)
 
         if _backend_config("lock_from_deletion", default=False):
-            self._lock_client.management_locks.create_or_update_at_resource_level(self._resource_group, "Microsoft.DBforPostgreSQL", "", "flexibleServers", server_name, "DoNotDeleteLock", parameters=ManagementLockObject(level="CanNotDelete", notes="Protection from accidental deletion"))
+            with tracing.span("lock", **{"azure.resource": server_name}):
+                self._lock_client.management_locks.create_or_update_at_resource_level(self._resource_group, "Microsoft.DBforPostgreSQL", "", "flexibleServers", server_name, "DoNotDeleteLock", parameters=ManagementLockObject(level="CanNotDelete", notes="Protection from accidental deletion"))
 
         if public_access:
+            self._reconcile_firewall_rules(server_name, spec)
+
+        # Keeps track of whether a restart is needed by changes to server configurations
+        should_restart = self._reconcile_extensions(server_name, spec)
+        should_restart = self._reconcile_parameters(server, server_parameters) or should_restart
+
+        restart_state = operations.pending("restart")
+        if should_restart or restart_state:
+            with tracing.span("restart", **{"azure.resource": server_name}):
+                # A restart that is already running is always resumed
+                if server_existed and operations.resumable() and not (restart_state and "continuation_token" in restart_state):
+                    delay = _seconds_until_maintenance_window(maintenance_window)
+                else:
+                    delay = 0
+                if delay:
+                    self._logger.info(f"Server needs a restart to apply static server parameters or preloaded extensions, postponed to the maintenance window in {delay} seconds")
+                    operations.schedule("restart", delay)
+                else:
+                    # Restart server
+                    self._logger.info("Restarting server due to changed static server parameters or preloaded extensions")
+                    wait_for_operation("restart", self._db_client.servers.begin_restart, self._resource_group, server_name)
+                    self._logger.info("Initiated server restart")
+
+        # Prepare credentials
+        data = {
+            "username": admin_username,
+            "password": password,
+            "dbname": "postgres",
+            "host": server.fully_qualified_domain_name,
+            "port": "5432",
+            "sslmode": "require"
+        }
+        return data, warnings
+
+    def _reconcile_firewall_rules(self, server_name, spec):
+        with tracing.span("firewall_rules", **{"azure.resource": server_name}):
             self._logger.info("Setting firewall rules")
-            # firewall rules
             existing_rules = dict()
             for rule in self._db_client.firewall_rules.list_by_server(self._resource_group, server_name):
                 existing_rules[rule.name] = rule
@@ -177,172 +233,213 @@ class AzurePostgreSQLFlexibleBackend:
             if _backend_config("network.allow_azure_services", default=False):
                 # There is no extra option to allow access for azure services, instead a special firewall rule is added
                 extra_rules.append(dict(name="AllowAllWindowsAzureIps", startIp="0.0.0.0", endIp="0.0.0.0"))
+            # Rules are independent of each other, so all changes are started together
+            rule_operations = []
             for rule in config_rules + spec_rules + extra_rules:
                 if rule["name"] in existing_rules:
                     existing = existing_rules.pop(rule["name"])
                     # Rule is the same, skip update
                     if existing.start_ip_address == rule["startIp"] and existing.end_ip_address == rule["endIp"]:
                         continue
-                poller = self._db_client.firewall_rules.begin_create_or_update(self._resource_group, server_name, rule["name"], FirewallRule(start_ip_address=rule["startIp"], end_ip_address=rule["endIp"]))
-                poller.result()
+                rule_operations.append(lambda rule=rule: self._db_client.firewall_rules.begin_create_or_update(self._resource_group, server_name, rule["name"], FirewallRule(start_ip_address=rule["startIp"], end_ip_address=rule["endIp"])))
             for rule in existing_rules.keys():
-                self._db_client.firewall_rules.begin_delete(self._resource_group, server_name, rule).result()
-
-        # Handle extensions
-        self._logger.info("Handling extensions")
-        extensions = spec.get("extensions", [])
-        extensions.extend(["pg_cron", "pg_stat_statements"])
-        extensions.sort()
-        preload_extensions = list(filter(lambda el: el in PRELOAD_LIST, extensions))
-        try:
-            configuration = self._db_client.configurations.get(self._resource_group, server_name, PRELOAD_PARAMETER)
-            if configuration.value:
-                applied_preload_extensions = configuration.value.split(",")
-                applied_preload_extensions.sort()
-            else:
+                rule_operations.append(lambda rule=rule: self._db_client.firewall_rules.begin_delete(self._resource_group, server_name, rule))
+            wait_all(rule_operations, _max_parallel_operations())
+
+    def _reconcile_extensions(self, server_name, spec):
+        """Update the list of allowed and preloaded extensions, returns True if the server needs a restart (only for changes to the preloaded ones)"""
+        with tracing.span("extensions", **{"azure.resource": server_name}):
+            self._logger.info("Handling extensions")
+            extensions = spec.get("extensions", [])
+            extensions.extend(["pg_cron", "pg_stat_statements"])
+            extensions.sort()
+            preload_extensions = list(filter(lambda el: el in PRELOAD_LIST, extensions))
+            try:
+                configuration = self._db_client.configurations.get(self._resource_group, server_name, PRELOAD_PARAMETER)
+                if configuration.value:
+                    applied_preload_extensions = configuration.value.split(",")
+                    applied_preload_extensions.sort()
+                else:
+                    applied_preload_extensions = []
+            except ResourceNotFoundError:
                 applied_preload_extensions = []
-        except ResourceNotFoundError:
-            applied_preload_extensions = []
-        try:
-            configuration = self._db_client.configurations.get(self._resource_group, server_name, EXTENSIONS_PARAMETER)
-            if configuration.value:
-                applied_allowed_extenions = configuration.value.split(",")
-                applied_allowed_extenions.sort()
-            else:
+            try:
+                configuration = self._db_client.configurations.get(self._resource_group, server_name, EXTENSIONS_PARAMETER)
+                if configuration.value:
+                    applied_allowed_extenions = configuration.value.split(",")
+                    applied_allowed_extenions.sort()
+                else:
+                    applied_allowed_extenions = []
+            except ResourceNotFoundError:
                 applied_allowed_extenions = []
-        except ResourceNotFoundError:
-            applied_allowed_extenions = []
-        
-        # Keeps track of whether a restart is needed by changes to server configurations
-        should_restart = False
-
-        if preload_extensions != applied_preload_extensions:
-            self._logger.info(f"Updating list of preload extensions from \"{','.join(applied_preload_extensions)}\" to \"{','.join(preload_extensions)}\"")
-            # Update configuration
-            poller = self._db_client.configurations.begin_put(self._resource_group, server_name, PRELOAD_PARAMETER, Configuration(value=",".join(preload_extensions), source="user-override"))
-            poller.result()
-            should_restart = True
-
-        if extensions != applied_allowed_extenions:
-            self._logger.info(f"Updating list of extensions from \"{','.join(applied_allowed_extenions)}\" to \"{','.join(extensions)}\"")
-            # Update configuration
-            poller = self._db_client.configurations.begin_put(self._resource_group, server_name, EXTENSIONS_PARAMETER, Configuration(value=",".join(extensions), source="user-override"))
-            poller.result()
-            should_restart = True
-
-        # Iterate through the server properties that are currently set on the server
-        for parameter in self._db_client.configurations.list_by_server(self._resource_group, server_name):
-
-            if parameter.is_read_only:
-                continue
-
-            # Extensions which are set above are part of the server properties and shouldn't be reset
-            if parameter.name in IGNORE_RESET_PARAMETERS:
-                continue
-
-            changed = False
-            value = ""
-
-            # Comparing target server properties to current ones
-            if parameter.name in server_parameters:
-                # Update configuration if parameter changed
-                if parameter.value != server_parameters[parameter.name]:
-                    self._logger.info(f"Updating parameter {parameter.name} to {server_parameters[parameter.name]}")
-                    value = server_parameters[parameter.name]
-                    changed = True
-            else:
-                # Reset parameter if it got removed from config-file
-                if parameter.value != parameter.default_value:
-                    self._logger.info(f"Resetting parameter {parameter.name} to {parameter.default_value}")
-                    value = parameter.default_value
-                    changed = True
-
-            if changed:
-                poller = self._db_client.configurations.begin_put(self._resource_group, server_name, parameter.name, Configuration(value=value, source="user-override"))
-                poller.result()
-                should_restart = True
-
-        if should_restart:
-            # Restart server
-            self._logger.info("Restarting server due to changed server parameters or extensions")
-            poller = self._db_client.servers.begin_restart(self._resource_group, server_name)
-            poller.result()
-            self._logger.info("Initiated server restart")
 
-        # Prepare credentials
-        data = {
-            "username": admin_username,
-            "password": password,
-            "dbname": "postgres",
-            "host": server.fully_qualified_domain_name,
-            "port": "5432",
-            "sslmode": "require"
-        }
-        return data, warnings
+            extension_operations = []
+            preload_changed = preload_extensions != applied_preload_extensions
+
+            if preload_changed:
+                self._logger.info(f"Updating list of preload extensions from \"{','.join(applied_preload_extensions)}\" to \"{','.join(preload_extensions)}\"")
+                # Update configuration
+                extension_operations.append(lambda: self._db_client.configurations.begin_put(self._resource_group, server_name, PRELOAD_PARAMETER, Configuration(value=",".join(preload_extensions), source="user-override")))
+
+            if extensions != applied_allowed_extenions:
+                self._logger.info(f"Updating list of extensions from \"{','.join(applied_allowed_extenions)}\" to \"{','.join(extensions)}\"")
+                # Update configuration
+                extension_operations.append(lambda: self._db_client.configurations.begin_put(self._resource_group, server_name, EXTENSIONS_PARAMETER, Configuration(value=",".join(extensions), source="user-override")))
+
+            wait_all(extension_operations, _max_parallel_operations())
+            # The list of allowed extensions is applied without a restart
+            return preload_changed
+
+    def _reconcile_parameters(self, server, server_parameters):
+        """Apply the server parameters from the spec and reset all others, returns True if the server needs a restart.
+        Dynamic parameters are applied right away, only changes to static ones need a restart"""
+        server_name = server.name
+        with tracing.span("parameters", **{"azure.resource": server_name}):
+            current, catalog, listed_at = self._current_parameters(server, server_parameters)
+            parameter_operations = []
+            static_changed = False
+            for name, current_value in current.items():
+                default_value, is_read_only, is_dynamic = catalog[name]
+                if is_read_only:
+                    continue
+
+                # Extensions which are set above are part of the server properties and shouldn't be reset
+                if name in IGNORE_RESET_PARAMETERS:
+                    continue
+
+                # Comparing target server properties to current ones
+                if name in server_parameters:
+                    # Update configuration if parameter changed
+                    if current_value == server_parameters[name]:
+                        continue
+                    self._logger.info(f"Updating parameter {name} to {server_parameters[name]}")
+                    value = server_parameters[name]
+                else:
+                    # Reset parameter if it got removed from config-file
+                    if current_value == default_value:
+                        continue
+                    self._logger.info(f"Resetting parameter {name} to {default_value}")
+                    value = default_value
+                if not is_dynamic:
+                    self._logger.info(f"Parameter {name} is static and needs a restart to be applied")
+                    static_changed = True
+                parameter_operations.append(lambda name=name, value=value: self._db_client.configurations.begin_put(self._resource_group, server_name, name, Configuration(value=value, source="user-override")))
+            # Parameters are independent of each other, the restart to apply them is done once all are set
+            wait_all(parameter_operations, _max_parallel_operations())
+            # Reset parameters are back to their default and need not be checked anymore
+            with _parameters_lock:
+                _managed_parameters[server_name] = (listed_at, set(server_parameters.keys()))
+            return static_changed
+
+    def _current_parameters(self, server, server_parameters):
+        """Current values of the parameters that are or were managed by the operator. All parameters are only listed
+        (which also fills the catalog) if the catalog for the version and SKU is missing, on the first reconcile
+        of a server since the operator started and then every parameter_resync_seconds to detect changes made by others"""
+        catalog_key = (str(server.version), str(server.sku.tier), str(server.sku.name))
+        with _parameters_lock:
+            catalog = _parameter_catalogs.get(catalog_key)
+            listed_at, managed = _managed_parameters.get(server.name, (None, set()))
+        resync_seconds = float(_backend_config("parameter_resync_seconds", default=3600))
+        if catalog is None or listed_at is None or time.monotonic() - listed_at > resync_seconds:
+            catalog = dict()
+            current = dict()
+            for parameter in self._db_client.configurations.list_by_server(self._resource_group, server.name):
+                # Parameters Azure does not report as dynamic are treated as static, i.e. needing a restart
+                catalog[parameter.name] = (parameter.default_value, parameter.is_read_only, parameter.is_dynamic_config is True)
+                current[parameter.name] = parameter.value
+            with _parameters_lock:
+                _parameter_catalogs[catalog_key] = catalog
+            return current, catalog, time.monotonic()
+        names = [name for name in set(server_parameters.keys()) | managed if name in catalog and name not in IGNORE_RESET_PARAMETERS]
+        if len(names) > _PARAMETER_GET_LIMIT:
+            current = {parameter.name: parameter.value for parameter in self._db_client.configurations.list_by_server(self._resource_group, server.name) if parameter.name in names}
+            return current, catalog, listed_at
+        current = dict()
+        for name in names:
+            try:
+                current[name] = self._db_client.configurations.get(self._resource_group, server.name, name).value
+            except ResourceNotFoundError:
+                pass
+        return current, catalog, listed_at
 
-    def create_or_update_database(self, namespace, server_name, database_name, spec, admin_credentials=None):
+    def create_or_update_database(self, namespace, server_name, database_name, spec, admin_credentials=None, state=None):
         server_name = _calc_name(namespace, server_name)
+        parameters = self._database_parameters(spec)
         try:
             database = self._db_client.databases.get(self._resource_group, server_name, database_name)
-            changed = database.charset != field_from_spec(spec, "database.charset", default="UTF8") or database.collation != field_from_spec(spec, "database.collation", default="en_US.utf8") 
-        except:
-            changed = True
-        if changed:
-            parameters = Database(charset=field_from_spec(spec, "database.charset", default="UTF8"), collation=field_from_spec(spec, "database.collation", default="en_US.utf8") )
+        except ResourceNotFoundError:
+            database = None
+        if _database_changed(database, parameters):
             poller = self._db_client.databases.begin_create(self._resource_group, server_name, database_name, parameters)
             poller.result()
+            self._database_created(state)
+        return self._provision_database(self._pgclient(admin_credentials, database_name), database_name, spec, state)
+
+    def create_or_update_user(self, namespace, server_name, database_name, username, password, admin_credentials=None, state=None):
         pgclient = self._pgclient(admin_credentials, database_name)
-        pgclient.restrict_database_permissions(database_name)
-        extensions = field_from_spec(spec, "database.extensions", default=[])
-        if not extensions:
-            return
-        for extension in extensions:
-            self._logger.info(f"Enabling extension {extension}")
-            pgclient.create_extension(extension)
-
-    def delete_server(self, namespace, name):
-        server_name = _calc_name(namespace, name)
-        if _backend_config("server_delete_fake", default=False):
-            # Set tag to mark server as deleted
-            parameters = ServerForUpdate(
-                tags={"hybridcloud-postgresql-operator:namespace": namespace, "hybridcloud-postgresql-operator:name": name, "hybridcloud-postgresql-operator:marked-for-deletion": "yes"}
-            )
-            poller = self._db_client.servers.begin_update(self._resource_group, server_name, parameters)
-            poller.result()
-            return
-        poller = self._db_client.servers.begin_delete(self._resource_group, server_name)
-        poller.result()
+        newly_created = pgclient.create_or_update_user(username, password, database_name, state=state)
+        return newly_created, _user_credentials(username, password, database_name, admin_credentials)
+
+    def _config(self, key, default=None, fail_if_missing=False):
+        return _backend_config(key, default=default, fail_if_missing=fail_if_missing)
 
-    def delete_database(self, namespace, server_name, database_name, admin_credentials=None):
+    def _calc_name(self, namespace, name):
+        return _calc_name(namespace, name)
+
+    def _db_client_async(self):
+        return azure_client_postgres_flexible_async()
+
+    def _database_parameters(self, spec):
+        return Database(charset=field_from_spec(spec, "database.charset", default="UTF8"), collation=field_from_spec(spec, "database.collation", default="en_US.utf8"))
+
+    def _server_update(self, tags):
+        return ServerForUpdate(tags=tags)
+
+    def _server_deleted(self, server_name):
+        super()._server_deleted(server_name)
+        with _parameters_lock:
+            _managed_parameters.pop(server_name, None)
+
+    # Async variants used by the handlers instead of the ones above, see AzureBackendBase
+
+    async def create_or_update_database_async(self, namespace, server_name, database_name, spec, admin_credentials=None, state=None):
+        db_client = self._db_client_async()
         server_name = _calc_name(namespace, server_name)
-        if _backend_config("database_delete_fake", default=False):
-            # Do nothing
-            return
-        poller = self._db_client.databases.begin_delete(self._resource_group, server_name, database_name)
-        poller.result()
-    
-    def create_or_update_user(self, namespace, server_name, database_name, username, password, admin_credentials=None):
-        pgclient = self._pgclient(admin_credentials, database_name)
-        newly_created = pgclient.create_or_update_user(username, password, database_name)
-        return newly_created, {
-            "username": username,
-            "password": password,
-            "dbname": database_name,
-            "host": admin_credentials["host"],
-            "port": "5432",
-            "sslmode": "require"
-        }
+        parameters = self._database_parameters(spec)
+        try:
+            database = await db_client.databases.get(self._resource_group, server_name, database_name)
+        except ResourceNotFoundError:
+            database = None
+        if _database_changed(database, parameters):
+            poller = await db_client.databases.begin_create(self._resource_group, server_name, database_name, parameters)
+            await poller.result()
+            self._database_created(state)
+        return await self._provision_database_async(AsyncPostgresSQLClient(admin_credentials, database_name), database_name, spec, state)
+
+    async def create_or_update_user_async(self, namespace, server_name, database_name, username, password, admin_credentials=None, state=None):
+        newly_created = await AsyncPostgresSQLClient(admin_credentials, database_name).create_or_update_user(username, password, database_name, state=state)
+        return newly_created, _user_credentials(username, password, database_name, admin_credentials)
+
+    async def delete_user_async(self, namespace, server_name, username, admin_credentials=None):
+        await AsyncPostgresSQLClient(admin_credentials).delete_user(username)
 
-    def delete_user(self, namespace, server_name, username, admin_credentials=None):
-        pgclient = self._pgclient(admin_credentials)
-        pgclient.delete_user(username)
+    async def update_user_password_async(self, namespace, server_name, username, password, admin_credentials=None):
+        await AsyncPostgresSQLClient(admin_credentials).update_password(username, password)
 
-    def update_user_password(self, namespace, server_name, username, password, admin_credentials=None):
-        pgclient = self._pgclient(admin_credentials)
-        pgclient.update_password(username, password)
 
-    def _pgclient(self, admin_credentials, dbname=None) -> PostgresSQLClient:
-        return PostgresSQLClient(admin_credentials, dbname)
+def _database_changed(database, parameters):
+    return database is None or database.charset != parameters.charset or database.collation != parameters.collation
+
+
+def _user_credentials(username, password, database_name, admin_credentials):
+    return {
+        "username": username,
+        "password": password,
+        "dbname": database_name,
+        "host": admin_credentials["host"],
+        "port": "5432",
+        "sslmode": "require"
+    }
 
 
 def _determine_sku(size_spec):
@@ -411,3 +508,22 @@ def _parse_maintenance_window(spec):
     else:
         maintenance_window = MaintenanceWindow(custom_window="Disabled", day_of_week=0, start_hour=0, start_minute=0)
     return maintenance_window
+
+
+def _seconds_until_maintenance_window(maintenance_window):
+    """Seconds until the next maintenance window of the server opens, 0 if it is open right now or no window is configured"""
+    if maintenance_window.custom_window != "Enabled":
+        return 0
+    now = datetime.now(tz=timezone.utc)
+    # Azure counts the days of the week from sunday (0), python from monday (0)
+    weekday = (maintenance_window.day_of_week - 1) % 7
+    start = now.replace(hour=maintenance_window.start_hour, minute=maintenance_window.start_minute, second=0, microsecond=0) + timedelta(days=(weekday - now.weekday()) % 7)
+    # The window is one hour long, like the one Azure uses for its own maintenance
+    duration = timedelta(hours=1)
+    if start > now and now < start - timedelta(days=7) + duration:
+        return 0
+    if start <= now:
+        if now < start + duration:
+            return 0
+        start += timedelta(days=7)
+    return int((start - now).total_seconds())
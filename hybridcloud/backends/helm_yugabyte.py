@@ -90,19 +90,21 @@ serviceEndpoints: []
         pgclient = self._pgclient(admin_credentials)
         return pgclient.database_exists(database_name)
 
-    def create_or_update_database(self, namespace, server_name, database_name, spec, admin_credentials=None):
+    def create_or_update_database(self, namespace, server_name, database_name, spec, admin_credentials=None, state=None):
         pgclient = self._pgclient(admin_credentials)
-        pgclient.create_database(database_name)
-        pgclient.restrict_database_permissions(database_name)
-        return True
+        pgclient.provision_database(database_name, state=state)
 
     def delete_database(self, namespace, server_name, database_name, admin_credentials=None):
         pgclient = self._pgclient(admin_credentials)
         pgclient.delete_database(database_name)
 
-    def create_or_update_user(self, namespace, server_name, database_name, username, password, admin_credentials=None):
+    def probe_database(self, namespace, server_name, database_name, username, admin_credentials=None):
+        """State of the database and its user, read once per reconcile and passed to create_or_update_database and create_or_update_user"""
+        return self._pgclient(admin_credentials).probe(database=database_name, role=username)
+
+    def create_or_update_user(self, namespace, server_name, database_name, username, password, admin_credentials=None, state=None):
         pgclient = self._pgclient(admin_credentials)
-        newly_created = pgclient.create_or_update_user(username, password, database_name)
+        newly_created = pgclient.create_or_update_user(username, password, database_name, state=state)
         return newly_created, {
             "username": username,
             "password": password,
@@ -0,0 +1,182 @@
+import threading
+import time
+from ..config import config_get
+
+
+# Everything the database and user reconciles need to know about a server in one round trip
+CATALOG_QUERY = """
+SELECT json_build_object(
+    'databases', (SELECT coalesce(json_agg(json_build_object('name', d.datname, 'public_has_access', d.datacl IS NULL OR EXISTS (SELECT 1 FROM aclexplode(d.datacl) a WHERE a.grantee = 0))), '[]') FROM pg_database d WHERE NOT d.datistemplate),
+    'roles', (SELECT coalesce(json_agg(rolname), '[]') FROM pg_roles),
+    'database_grants', (SELECT coalesce(json_agg(json_build_object('database', d.datname, 'role', r.rolname, 'privileges', a.privileges)), '[]')
+        FROM pg_database d CROSS JOIN LATERAL (SELECT grantee, array_agg(privilege_type) AS privileges FROM aclexplode(d.datacl) GROUP BY grantee) a JOIN pg_roles r ON r.oid = a.grantee)
+)
+"""
+
+# Schema grants and extensions are only visible for the database the connection is made to, so they are read per database when needed
+DATABASE_CATALOG_QUERY = """
+SELECT json_build_object(
+    'schema_grants', (SELECT coalesce(json_agg(json_build_object('role', r.rolname, 'privileges', a.privileges)), '[]')
+        FROM pg_namespace n CROSS JOIN LATERAL (SELECT grantee, array_agg(privilege_type) AS privileges FROM aclexplode(n.nspacl) GROUP BY grantee) a JOIN pg_roles r ON r.oid = a.grantee WHERE n.nspname = 'public'),
+    'extensions', (SELECT coalesce(json_object_agg(e.extname, json_build_array(e.extversion, a.default_version)), '{}') FROM pg_extension e LEFT JOIN pg_available_extensions a ON a.name = e.extname)
+)
+"""
+
+DATABASE_PRIVILEGES = {"CREATE", "CONNECT", "TEMPORARY"}
+SCHEMA_PRIVILEGES = {"CREATE", "USAGE"}
+
+_snapshots = dict()
+_lock = threading.Lock()
+
+
+def enabled():
+    return config_get("postgres.catalog_snapshot.enabled", default=True)
+
+
+def _ttl():
+    return float(config_get("postgres.catalog_snapshot.ttl_seconds", default=30))
+
+
+class CatalogSnapshot:
+    """Databases, roles, grants and installed extensions of one server. The server-wide part is loaded with one query,
+    schema grants and extensions only for the databases that need them. Both are kept up-to-date with the changes the
+    operator makes itself, so reconciles of many databases on the same server do not each have to query the catalog"""
+
+    def __init__(self):
+        # Only held while reading or swapping in state, never during a query, as the async client takes it on the event loop
+        self._lock = threading.Lock()
+        # Held by a sync client while it queries the catalog, so concurrent callers wait for its result
+        self._load_lock = threading.Lock()
+        self.loaded_at = None
+        self._databases = dict()  # name -> whether PUBLIC still has access
+        self._roles = set()
+        self._database_grants = dict()  # (database, role) -> privileges
+        self._per_database = dict()  # database -> (loaded_at, schema grants (role -> privileges), extensions (name -> (installed version, available version)))
+
+    def load(self, catalog):
+        databases = {database["name"]: database["public_has_access"] for database in catalog["databases"]}
+        roles = set(catalog["roles"])
+        database_grants = {(grant["database"], grant["role"]): set(grant["privileges"]) for grant in catalog["database_grants"]}
+        with self._lock:
+            self._databases, self._roles, self._database_grants = databases, roles, database_grants
+            self.loaded_at = time.monotonic()
+
+    def load_database(self, dbname, catalog):
+        schema_grants = {grant["role"]: set(grant["privileges"]) for grant in catalog["schema_grants"]}
+        extensions = {name: tuple(versions) for name, versions in catalog["extensions"].items()}
+        with self._lock:
+            self._per_database[dbname] = (time.monotonic(), schema_grants, extensions)
+
+    def fresh(self):
+        with self._lock:
+            return self.loaded_at is not None and time.monotonic() - self.loaded_at < _ttl()
+
+    def database_fresh(self, dbname):
+        with self._lock:
+            per_database = self._per_database.get(dbname)
+            return per_database is not None and time.monotonic() - per_database[0] < _ttl()
+
+    def database_exists(self, name):
+        with self._lock:
+            return name in self._databases
+
+    def state(self, dbname, database=None, role=None):
+        """Same result as PostgresSQLClient.probe, computed from the snapshot. The schema grant is None if the
+        connected database dbname is not loaded (anymore)"""
+        with self._lock:
+            database_exists = database in self._databases
+            role_exists = role in self._roles
+            per_database = self._per_database.get(dbname)
+            return {
+                "database_exists": database_exists,
+                "public_has_access": database_exists and self._databases[database],
+                "role_exists": role_exists,
+                "role_has_database_grant": DATABASE_PRIVILEGES <= self._database_grants.get((database, role), set()),
+                "role_has_schema_grant": SCHEMA_PRIVILEGES <= per_database[1].get(role, set()) if per_database else None,
+            }
+
+    def extensions(self, dbname):
+        """Installed extensions of the database or None if it is not loaded (anymore), e.g. because it was dropped in the meantime"""
+        with self._lock:
+            per_database = self._per_database.get(dbname)
+            return dict(per_database[2]) if per_database else None
+
+    def database_created(self, name):
+        with self._lock:
+            self._databases[name] = True
+
+    def public_access_revoked(self, name):
+        with self._lock:
+            if name in self._databases:
+                self._databases[name] = False
+
+    def database_dropped(self, name):
+        with self._lock:
+            self._databases.pop(name, None)
+            self._per_database.pop(name, None)
+            for key in [key for key in self._database_grants.keys() if key[0] == name]:
+                del self._database_grants[key]
+
+    def role_created(self, name):
+        with self._lock:
+            self._roles.add(name)
+
+    def role_dropped(self, name):
+        with self._lock:
+            self._roles.discard(name)
+            for key in [key for key in self._database_grants.keys() if key[1] == name]:
+                del self._database_grants[key]
+            for _, schema_grants, _ in self._per_database.values():
+                schema_grants.pop(name, None)
+
+    def database_granted(self, database, role):
+        with self._lock:
+            self._database_grants.setdefault((database, role), set()).update(DATABASE_PRIVILEGES)
+
+    def schema_granted(self, dbname, role):
+        with self._lock:
+            if dbname in self._per_database:
+                self._per_database[dbname][1].setdefault(role, set()).update(SCHEMA_PRIVILEGES)
+
+    def extension_created(self, dbname, name, version=None):
+        with self._lock:
+            if dbname in self._per_database:
+                # Without a version the extension does not count as drifted until the next load
+                self._per_database[dbname][2][name] = (version, version)
+
+
+def snapshot_for(host, port):
+    with _lock:
+        snapshot = _snapshots.get((host, str(port)))
+        if not snapshot:
+            snapshot = CatalogSnapshot()
+            _snapshots[(host, str(port))] = snapshot
+        return snapshot
+
+
+def get_snapshot(host, port, load, dbname=None, load_database=None):
+    """Return the snapshot for the server, calling load(snapshot) if the server-wide part is stale and, if dbname is given,
+    load_database(snapshot) if the part for the database is. Concurrent callers wait for a running load instead of querying
+    the catalog themselves"""
+    snapshot = snapshot_for(host, port)
+    if snapshot.fresh() and (not dbname or snapshot.database_fresh(dbname)):
+        return snapshot
+    # The queries run outside of the state lock, load and load_database only take it to swap in the result
+    with snapshot._load_lock:
+        if not snapshot.fresh():
+            load(snapshot)
+        if dbname and not snapshot.database_fresh(dbname):
+            load_database(snapshot)
+    return snapshot
+
+
+def peek(host, port):
+    """Return the snapshot for the server without loading it, e.g. to record a change the operator made"""
+    with _lock:
+        return _snapshots.get((host, str(port)))
+
+
+def invalidate(host, port):
+    """Forget the snapshot, e.g. after a write failed and the state of the server is unknown"""
+    with _lock:
+        _snapshots.pop((host, str(port)), None)
@@ -1,63 +1,228 @@
-import psycopg2
-from psycopg2.extensions import AsIs
+from contextlib import contextmanager
+from psycopg2.extensions import AsIs, cursor
+from . import pgcatalog, pgpool
+from ..util import metrics, tracing
+
+
+class _InstrumentedCursor(cursor):
+    """Records every statement in the metrics"""
+    def execute(self, query, vars=None):
+        operation = statement_type(query)
+        with tracing.span(f"postgres {operation}", **{"db.system": "postgresql", "db.name": self.connection.info.dbname, "server.address": self.connection.info.host}), metrics.track_call("postgres", operation):
+            return super().execute(query, vars)
+
+
+def statement_type(query):
+    # Statement type, e.g. SELECT or CREATE DATABASE, to keep the number of metric labels small
+    words = query.split(None, 2)
+    if words and words[0].upper() in ("CREATE", "DROP", "ALTER") and len(words) > 1:
+        return f"{words[0]} {words[1]}".upper()
+    return words[0].upper() if words else ""
+
+
+# Privileges are checked with has_*_privilege only if the objects exist as the functions fail otherwise.
+# With several privileges in one call they return true if any of them is held, so each privilege is checked separately
+PROBE_QUERY = """
+SELECT
+    d.datname IS NOT NULL,
+    d.datname IS NOT NULL AND (d.datacl IS NULL OR EXISTS (SELECT 1 FROM aclexplode(d.datacl) a WHERE a.grantee = 0)),
+    r.rolname IS NOT NULL,
+    CASE WHEN d.datname IS NOT NULL AND r.rolname IS NOT NULL THEN has_database_privilege(r.rolname, d.datname, 'CREATE') AND has_database_privilege(r.rolname, d.datname, 'CONNECT') AND has_database_privilege(r.rolname, d.datname, 'TEMPORARY') ELSE false END,
+    CASE WHEN r.rolname IS NOT NULL THEN has_schema_privilege(r.rolname, 'public', 'CREATE') AND has_schema_privilege(r.rolname, 'public', 'USAGE') ELSE false END
+FROM (SELECT 1) AS dummy
+LEFT JOIN pg_database d ON d.datname = %(database)s
+LEFT JOIN pg_roles r ON r.rolname = %(role)s
+"""
+
+
+EXTENSIONS_QUERY = "SELECT e.extname, e.extversion, a.default_version FROM pg_extension e LEFT JOIN pg_available_extensions a ON a.name = e.extname"
 
 
 class PostgresSQLClient:
+    """Connections are borrowed from a process-wide pool for each operation and given back afterwards"""
 
     def __init__(self, credentials, dbname=None):
         if not dbname:
             dbname = credentials["dbname"]
-        self._con = psycopg2.connect(host=credentials["host"], port=credentials["port"], dbname=dbname, user=credentials["username"], password=credentials["password"], sslmode=credentials["sslmode"])
-        self._con.set_session(autocommit=True)       
+        self._credentials = credentials
+        self._dbname = dbname
+
+    @contextmanager
+    def _cursor(self):
+        with pgpool.connection(self._credentials, self._dbname, _InstrumentedCursor) as con:
+            with con.cursor() as cursor:
+                yield cursor
+
+    def _catalog(self, per_database=False):
+        """Catalog snapshot of the server or None if snapshots are disabled. With per_database the schema grants and
+        extensions of the connected database are loaded as well"""
+        if not pgcatalog.enabled():
+            return None
+        return pgcatalog.get_snapshot(self._credentials["host"], self._credentials["port"], self._load_catalog, self._dbname if per_database else None, self._load_database_catalog)
+
+    def _load_catalog(self, snapshot):
+        with self._cursor() as cursor:
+            cursor.execute(pgcatalog.CATALOG_QUERY)
+            snapshot.load(cursor.fetchone()[0])
+
+    def _load_database_catalog(self, snapshot):
+        with self._cursor() as cursor:
+            cursor.execute(pgcatalog.DATABASE_CATALOG_QUERY)
+            snapshot.load_database(self._dbname, cursor.fetchone()[0])
+
+    def _known_catalog(self):
+        return pgcatalog.peek(self._credentials["host"], self._credentials["port"])
+
+    @contextmanager
+    def _writing(self):
+        """Forget the catalog snapshot if a write fails as the state of the server is then unknown"""
+        try:
+            yield
+        except:
+            pgcatalog.invalidate(self._credentials["host"], self._credentials["port"])
+            raise
 
     def database_exists(self, name):
-        cursor = self._con.cursor()
-        cursor.execute("SELECT datname FROM pg_database WHERE datname=%s", (name,))
-        exists = len(cursor.fetchall()) > 0
-        cursor.close()
-        return exists
-
-    def create_database(self, name):
-        cursor = self._con.cursor()
-        cursor.execute("SELECT datname FROM pg_database WHERE datname=%s", (name,))
-        if len(cursor.fetchall()) == 0:
-            cursor.execute("CREATE DATABASE %s", (AsIs(name),))
-        cursor.close()
+        catalog = self._catalog()
+        if catalog:
+            return catalog.database_exists(name)
+        with self._cursor() as cursor:
+            cursor.execute("SELECT datname FROM pg_database WHERE datname=%s", (name,))
+            return len(cursor.fetchall()) > 0
 
     def delete_database(self, name):
-        cursor = self._con.cursor()
-        cursor.execute("DROP DATABASE IF EXISTS %s", (AsIs(name),))
-        cursor.close()
-
-    def restrict_database_permissions(self, name):
-        cursor = self._con.cursor()
-        # Make sure only explicitly allowed users have access to this database
-        cursor.execute("REVOKE ALL PRIVILEGES ON DATABASE %s FROM PUBLIC", (AsIs(name),))
-        cursor.close()
-
-    def create_or_update_user(self, name, password, database):
-        cursor = self._con.cursor()
-        cursor.execute("SELECT * FROM pg_catalog.pg_user WHERE usename=%s", (name, ))
-        user_missing = len(cursor.fetchall()) == 0
+        # Pooled connections to the database would prevent dropping it
+        pgpool.close_pools(self._credentials["host"], self._credentials["port"], name)
+        with self._writing(), self._cursor() as cursor:
+            cursor.execute("DROP DATABASE IF EXISTS %s", (AsIs(name),))
+        catalog = self._known_catalog()
+        if catalog:
+            catalog.database_dropped(name)
+
+    def probe(self, database=None, role=None):
+        """Fetch the state of a database, a role and its grants in one query (or from the catalog snapshot).
+        Schema grants are only visible in the connected database, for other databases role_has_schema_grant is None"""
+        catalog = self._catalog(per_database=database == self._dbname)
+        if catalog:
+            state = catalog.state(self._dbname, database, role)
+        else:
+            with self._cursor() as cursor:
+                cursor.execute(PROBE_QUERY, {"database": database, "role": role})
+                row = cursor.fetchone()
+            state = dict(zip(("database_exists", "public_has_access", "role_exists", "role_has_database_grant", "role_has_schema_grant"), row))
+        if database != self._dbname:
+            state["role_has_schema_grant"] = None
+        return state
+
+    def provision_database(self, name, create=True, state=None):
+        """Create the database if it is missing and make sure only explicitly allowed users have access.
+        Only the missing statements are sent. state is the result of an earlier probe (it is updated with the changes made),
+        without it the database is probed. Returns True if the database was created"""
+        if state is None:
+            state = self.probe(database=name)
+        catalog = self._known_catalog()
+        created = False
+        with self._writing(), self._cursor() as cursor:
+            if create and not state["database_exists"]:
+                # CREATE DATABASE can not run in a transaction block so it can not be batched with other statements
+                cursor.execute("CREATE DATABASE %s", (AsIs(name),))
+                created = True
+                state["database_exists"] = True
+                if catalog:
+                    catalog.database_created(name)
+            if created or state["public_has_access"]:
+                cursor.execute("REVOKE ALL PRIVILEGES ON DATABASE %s FROM PUBLIC", (AsIs(name),))
+                state["public_has_access"] = False
+                if catalog:
+                    catalog.public_access_revoked(name)
+        return created
+
+    def create_or_update_user(self, name, password, database, state=None):
+        """Create the user if it is missing and grant it access to the database. Only the missing statements are sent"""
+        if state is None:
+            state = self.probe(database=database, role=name)
+        user_missing = not state["role_exists"]
+        schema_granted = self._schema_granted(state, database, name)
+        statements = []
         if user_missing:
-            cursor.execute("CREATE ROLE %s WITH LOGIN ENCRYPTED PASSWORD %s", (AsIs(name), password))
-        cursor.execute("GRANT ALL PRIVILEGES ON DATABASE %s TO %s", (AsIs(database), AsIs(name)))
-        # Needed on AWS RDS
-        cursor.execute("GRANT ALL PRIVILEGES ON SCHEMA public TO %s", (AsIs(name),))
-        cursor.close()
+            statements.append(("CREATE ROLE %s WITH LOGIN ENCRYPTED PASSWORD %s", (AsIs(name), password)))
+        if user_missing or not state["role_has_database_grant"]:
+            statements.append(("GRANT ALL PRIVILEGES ON DATABASE %s TO %s", (AsIs(database), AsIs(name))))
+        if user_missing or not schema_granted:
+            # Needed on AWS RDS
+            statements.append(("GRANT ALL PRIVILEGES ON SCHEMA public TO %s", (AsIs(name),)))
+        self._execute_batch(statements)
+        catalog = self._known_catalog()
+        if catalog:
+            catalog.role_created(name)
+            catalog.database_granted(database, name)
+            catalog.schema_granted(self._dbname, name)
         return user_missing
+
+    def _schema_granted(self, state, database, role):
+        """The schema grant of a probe made from another database (e.g. the admin database) is unknown. If connected to the
+        database it is read from the catalog snapshot. Without snapshots a role that already has its database grant is
+        taken to have the schema grant as well, as both are always granted together"""
+        if state["role_has_schema_grant"] is not None or database != self._dbname:
+            return state["role_has_schema_grant"]
+        catalog = self._catalog(per_database=True)
+        if catalog:
+            return catalog.state(self._dbname, database, role)["role_has_schema_grant"]
+        return state["role_exists"] and state["role_has_database_grant"]
+
+    def _execute_batch(self, statements):
+        """Send several statements in one round trip. The server runs them in one implicit transaction"""
+        if not statements:
+            return
+        with self._writing(), self._cursor() as cursor:
+            cursor.execute("; ".join(statement for statement, _ in statements), tuple(param for _, params in statements for param in params))
     
     def delete_user(self, name):
-        cursor = self._con.cursor()
-        cursor.execute("DROP ROLE IF EXISTS %s", (AsIs(name),))
-        cursor.close()
+        with self._writing(), self._cursor() as cursor:
+            cursor.execute("DROP ROLE IF EXISTS %s", (AsIs(name),))
+        catalog = self._known_catalog()
+        if catalog:
+            catalog.role_dropped(name)
 
     def update_password(self, name, password):
-        cursor = self._con.cursor()
-        cursor.execute("ALTER USER %s WITH ENCRYPTED PASSWORD %s", (AsIs(name), password))
-        cursor.close()
+        with self._cursor() as cursor:
+            cursor.execute("ALTER USER %s WITH ENCRYPTED PASSWORD %s", (AsIs(name), password))
 
     def create_extension(self, name):
-        cursor = self._con.cursor()
-        cursor.execute("CREATE EXTENSION IF NOT EXISTS %s CASCADE", (AsIs(name), ))
-        cursor.close()
+        with self._writing(), self._cursor() as cursor:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS %s CASCADE", (AsIs(name), ))
+        catalog = self._known_catalog()
+        if catalog:
+            catalog.extension_created(self._dbname, name)
+
+    def installed_extensions(self):
+        """Installed extensions of the connected database with their installed and available version"""
+        catalog = self._catalog(per_database=True)
+        extensions = catalog.extensions(self._dbname) if catalog else None
+        if extensions is not None:
+            return extensions
+        with self._cursor() as cursor:
+            cursor.execute(EXTENSIONS_QUERY)
+            return {name: (installed, available) for name, installed, available in cursor.fetchall()}
+
+    def reconcile_extensions(self, extensions, update=False):
+        """Create missing extensions and, if update is set, update outdated ones in one round trip.
+        Nothing is sent if all extensions are installed. Returns the created extensions and the version drift
+        (name -> installed and available version) of the extensions that were not updated"""
+        installed = self.installed_extensions()
+        missing = [name for name in extensions if name not in installed]
+        outdated = [name for name in extensions if name in installed and installed[name][1] and installed[name][0] != installed[name][1]]
+        statements = [("CREATE EXTENSION IF NOT EXISTS %s CASCADE", (AsIs(name),)) for name in missing]
+        if update:
+            statements.extend(("ALTER EXTENSION %s UPDATE", (AsIs(name),)) for name in outdated)
+        self._execute_batch(statements)
+        catalog = self._known_catalog()
+        if catalog:
+            for name in missing:
+                catalog.extension_created(self._dbname, name)
+            if update:
+                for name in outdated:
+                    catalog.extension_created(self._dbname, name, installed[name][1])
+        if update:
+            return missing, dict()
+        return missing, {name: {"installed": installed[name][0], "available": installed[name][1]} for name in outdated}
@@ -0,0 +1,300 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from psycopg import AsyncConnection, sql
+from psycopg_pool import AsyncConnectionPool
+from . import pgcatalog, pgpool
+from .pgclient import EXTENSIONS_QUERY, PROBE_QUERY, statement_type
+from .pgpool import password_fingerprint, pool_config
+from ..util import metrics, tracing
+from ..util.executor import run_sync
+
+
+_pools = dict()  # (host, port, user, dbname) -> _PoolEntry
+_pool_locks = dict()
+_catalog_locks = dict()
+
+
+class _BudgetedConnection(AsyncConnection):
+    """Counts against the per-server connection budget of pgpool, so the sync and async pools together
+    do not open more than postgres.pool.max_server_connections connections to a server"""
+
+    @classmethod
+    async def connect(cls, conninfo="", **kwargs):
+        host, port = kwargs["host"], kwargs["port"]
+        deadline = time.monotonic() + float(pool_config("acquire_timeout_seconds", 30))
+        while not pgpool.try_reserve_connection(host, port):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for a free connection to {host}")
+            await asyncio.sleep(0.5)
+        try:
+            con = await super().connect(conninfo, **kwargs)
+        except:
+            pgpool.release_connection(host, port)
+            raise
+        con._budget = (host, port)
+        return con
+
+    async def close(self):
+        budget, self._budget = getattr(self, "_budget", None), None
+        try:
+            await super().close()
+        finally:
+            if budget:
+                pgpool.release_connection(*budget)
+
+
+class _PoolEntry:
+
+    def __init__(self, fingerprint, pool, max_idle):
+        self.fingerprint = fingerprint
+        self.pool = pool
+        self.max_idle = max_idle
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+
+async def _evict_idle():
+    """Close the pools not used for longer than their max idle time, same as the sync pools of pgpool.
+    Otherwise every database ever reconciled would keep a pool with its worker tasks"""
+    now = time.monotonic()
+    idle = [(key, entry) for key, entry in _pools.items() if entry.in_use == 0 and now - entry.last_used > entry.max_idle]
+    # Removed before the first await, so no other coroutine picks up a pool that is being closed
+    for key, _ in idle:
+        del _pools[key]
+    for _, entry in idle:
+        await entry.pool.close()
+
+
+async def _get_pool(credentials, dbname):
+    key = (credentials["host"], str(credentials["port"]), credentials["username"], dbname)
+    fingerprint = password_fingerprint(credentials["password"])
+    await _evict_idle()
+    existing = _pools.get(key)
+    if existing and existing.fingerprint == fingerprint:
+        return existing
+    # Only one coroutine creates the pool, the others use it once it is open
+    async with _pool_locks.setdefault(key, asyncio.Lock()):
+        existing = _pools.get(key)
+        if existing and existing.fingerprint == fingerprint:
+            return existing
+        if existing:
+            # Password was rotated, connections with the old password are of no use anymore
+            del _pools[key]
+            await existing.pool.close()
+        if dbname == credentials["dbname"]:
+            max_idle = float(pool_config("max_idle_seconds", 300))
+        else:
+            max_idle = float(pool_config("database_max_idle_seconds", 10))
+        pool = AsyncConnectionPool(
+            kwargs=dict(host=credentials["host"], port=credentials["port"], dbname=dbname, user=credentials["username"], password=credentials["password"], sslmode=credentials["sslmode"], autocommit=True),
+            connection_class=_BudgetedConnection,
+            min_size=0,
+            max_size=int(pool_config("max_size", 5)),
+            max_idle=max_idle,
+            timeout=float(pool_config("acquire_timeout_seconds", 30)),
+            check=AsyncConnectionPool.check_connection,
+            open=False,
+        )
+        await pool.open()
+        entry = _PoolEntry(fingerprint, pool, max_idle)
+        _pools[key] = entry
+        return entry
+
+
+async def close_pools(host, port, dbname):
+    """Close all pooled connections (async and sync) to a database, e.g. before it is dropped"""
+    for key in [key for key in _pools.keys() if key[0] == host and key[1] == str(port) and key[3] == dbname]:
+        await _pools.pop(key).pool.close()
+    await run_sync(pgpool.close_pools, host, port, dbname)
+
+
+class AsyncPostgresSQLClient:
+    """Same operations as PostgresSQLClient for use directly from the async handlers, so waiting for the server
+    does not block an executor thread. Uses psycopg 3 and shares the catalog snapshots with the sync client"""
+
+    def __init__(self, credentials, dbname=None):
+        if not dbname:
+            dbname = credentials["dbname"]
+        self._credentials = credentials
+        self._dbname = dbname
+
+    @asynccontextmanager
+    async def _connection(self):
+        entry = await _get_pool(self._credentials, self._dbname)
+        entry.in_use += 1
+        try:
+            async with entry.pool.connection() as con:
+                yield con
+        finally:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+
+    async def _execute(self, query, params=None, fetch=False):
+        text = query.as_string(None) if isinstance(query, sql.Composable) else query
+        operation = statement_type(text)
+        async with self._connection() as con:
+            with tracing.span(f"postgres {operation}", **{"db.system": "postgresql", "db.name": self._dbname, "server.address": self._credentials["host"]}), metrics.track_call("postgres", operation):
+                cursor = await con.execute(query, params)
+                if fetch:
+                    return await cursor.fetchall()
+
+    async def _catalog(self, per_database=False):
+        """Same as PostgresSQLClient._catalog"""
+        if not pgcatalog.enabled():
+            return None
+        snapshot = pgcatalog.snapshot_for(self._credentials["host"], self._credentials["port"])
+        if not snapshot.fresh() or (per_database and not snapshot.database_fresh(self._dbname)):
+            lock = _catalog_locks.setdefault((self._credentials["host"], str(self._credentials["port"])), asyncio.Lock())
+            async with lock:
+                # Another reconcile could have loaded it while waiting for the lock
+                if not snapshot.fresh():
+                    rows = await self._execute(pgcatalog.CATALOG_QUERY, fetch=True)
+                    snapshot.load(rows[0][0])
+                if per_database and not snapshot.database_fresh(self._dbname):
+                    rows = await self._execute(pgcatalog.DATABASE_CATALOG_QUERY, fetch=True)
+                    snapshot.load_database(self._dbname, rows[0][0])
+        return snapshot
+
+    def _known_catalog(self):
+        return pgcatalog.peek(self._credentials["host"], self._credentials["port"])
+
+    @asynccontextmanager
+    async def _writing(self):
+        """Forget the catalog snapshot if a write fails as the state of the server is then unknown"""
+        try:
+            yield
+        except:
+            pgcatalog.invalidate(self._credentials["host"], self._credentials["port"])
+            raise
+
+    async def database_exists(self, name):
+        catalog = await self._catalog()
+        if catalog:
+            return catalog.database_exists(name)
+        rows = await self._execute("SELECT datname FROM pg_database WHERE datname=%s", (name,), fetch=True)
+        return len(rows) > 0
+
+    async def delete_database(self, name):
+        # Pooled connections to the database would prevent dropping it
+        await close_pools(self._credentials["host"], self._credentials["port"], name)
+        async with self._writing():
+            await self._execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.SQL(name)))
+        catalog = self._known_catalog()
+        if catalog:
+            catalog.database_dropped(name)
+
+    async def probe(self, database=None, role=None):
+        """Same as PostgresSQLClient.probe"""
+        catalog = await self._catalog(per_database=database == self._dbname)
+        if catalog:
+            state = catalog.state(self._dbname, database, role)
+        else:
+            rows = await self._execute(PROBE_QUERY, {"database": database, "role": role}, fetch=True)
+            state = dict(zip(("database_exists", "public_has_access", "role_exists", "role_has_database_grant", "role_has_schema_grant"), rows[0]))
+        if database != self._dbname:
+            state["role_has_schema_grant"] = None
+        return state
+
+    async def provision_database(self, name, create=True, state=None):
+        """Same as PostgresSQLClient.provision_database"""
+        if state is None:
+            state = await self.probe(database=name)
+        catalog = self._known_catalog()
+        created = False
+        async with self._writing():
+            if create and not state["database_exists"]:
+                # CREATE DATABASE can not run in a transaction block so it can not be batched with other statements
+                await self._execute(sql.SQL("CREATE DATABASE {}").format(sql.SQL(name)))
+                created = True
+                state["database_exists"] = True
+                if catalog:
+                    catalog.database_created(name)
+            if created or state["public_has_access"]:
+                await self._execute(sql.SQL("REVOKE ALL PRIVILEGES ON DATABASE {} FROM PUBLIC").format(sql.SQL(name)))
+                state["public_has_access"] = False
+                if catalog:
+                    catalog.public_access_revoked(name)
+        return created
+
+    async def create_or_update_user(self, name, password, database, state=None):
+        if state is None:
+            state = await self.probe(database=database, role=name)
+        user_missing = not state["role_exists"]
+        schema_granted = await self._schema_granted(state, database, name)
+        statements = []
+        # Utility statements do not support server-side parameters, so the values are composed client-side
+        if user_missing:
+            statements.append(sql.SQL("CREATE ROLE {} WITH LOGIN ENCRYPTED PASSWORD {}").format(sql.SQL(name), sql.Literal(password)))
+        if user_missing or not state["role_has_database_grant"]:
+            statements.append(sql.SQL("GRANT ALL PRIVILEGES ON DATABASE {} TO {}").format(sql.SQL(database), sql.SQL(name)))
+        if user_missing or not schema_granted:
+            # Needed on AWS RDS
+            statements.append(sql.SQL("GRANT ALL PRIVILEGES ON SCHEMA public TO {}").format(sql.SQL(name)))
+        if statements:
+            # Without parameters several statements can be sent in one round trip, the server runs them in one implicit transaction
+            async with self._writing():
+                await self._execute(sql.SQL("; ").join(statements))
+        catalog = self._known_catalog()
+        if catalog:
+            catalog.role_created(name)
+            catalog.database_granted(database, name)
+            catalog.schema_granted(self._dbname, name)
+        return user_missing
+
+    async def _schema_granted(self, state, database, role):
+        """Same as PostgresSQLClient._schema_granted"""
+        if state["role_has_schema_grant"] is not None or database != self._dbname:
+            return state["role_has_schema_grant"]
+        catalog = await self._catalog(per_database=True)
+        if catalog:
+            return catalog.state(self._dbname, database, role)["role_has_schema_grant"]
+        return state["role_exists"] and state["role_has_database_grant"]
+
+    async def delete_user(self, name):
+        async with self._writing():
+            await self._execute(sql.SQL("DROP ROLE IF EXISTS {}").format(sql.SQL(name)))
+        catalog = self._known_catalog()
+        if catalog:
+            catalog.role_dropped(name)
+
+    async def update_password(self, name, password):
+        await self._execute(sql.SQL("ALTER USER {} WITH ENCRYPTED PASSWORD {}").format(sql.SQL(name), sql.Literal(password)))
+
+    async def create_extension(self, name):
+        async with self._writing():
+            await self._execute(sql.SQL("CREATE EXTENSION IF NOT EXISTS {} CASCADE").format(sql.SQL(name)))
+        catalog = self._known_catalog()
+        if catalog:
+            catalog.extension_created(self._dbname, name)
+
+    async def installed_extensions(self):
+        """Installed extensions of the connected database with their installed and available version"""
+        catalog = await self._catalog(per_database=True)
+        extensions = catalog.extensions(self._dbname) if catalog else None
+        if extensions is not None:
+            return extensions
+        rows = await self._execute(EXTENSIONS_QUERY, fetch=True)
+        return {name: (installed, available) for name, installed, available in rows}
+
+    async def reconcile_extensions(self, extensions, update=False):
+        """Same as PostgresSQLClient.reconcile_extensions"""
+        installed = await self.installed_extensions()
+        missing = [name for name in extensions if name not in installed]
+        outdated = [name for name in extensions if name in installed and installed[name][1] and installed[name][0] != installed[name][1]]
+        statements = [sql.SQL("CREATE EXTENSION IF NOT EXISTS {} CASCADE").format(sql.SQL(name)) for name in missing]
+        if update:
+            statements.extend(sql.SQL("ALTER EXTENSION {} UPDATE").format(sql.SQL(name)) for name in outdated)
+        if statements:
+            async with self._writing():
+                await self._execute(sql.SQL("; ").join(statements))
+        catalog = self._known_catalog()
+        if catalog:
+            for name in missing:
+                catalog.extension_created(self._dbname, name)
+            if update:
+                for name in outdated:
+                    catalog.extension_created(self._dbname, name, installed[name][1])
+        if update:
+            return missing, dict()
+        return missing, {name: {"installed": installed[name][0], "available": installed[name][1]} for name in outdated}
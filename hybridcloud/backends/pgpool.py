@@ -0,0 +1,264 @@
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from ..config import config_get
+from ..util import metrics
+
+
+_pools = dict()
+_budgets = dict()  # (host, port) -> open connections over all pools of the server
+_lock = threading.Lock()
+_budgets_lock = threading.Lock()
+
+
+def pool_config(key, default):
+    return config_get(f"postgres.pool.{key}", default=default)
+
+
+def password_fingerprint(password):
+    # Only keep a hash of the password around to detect rotations
+    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+
+
+class _ServerBudget:
+    """Connections the operator keeps open to one server over all pools, limited by postgres.pool.max_server_connections"""
+
+    def __init__(self):
+        self.open = 0
+        self.condition = threading.Condition()
+
+
+def _budget(server):
+    with _budgets_lock:
+        budget = _budgets.get(server)
+        if not budget:
+            budget = _ServerBudget()
+            _budgets[server] = budget
+        return budget
+
+
+def reserve_connection(host, port, timeout):
+    """Count a new connection against the budget of the server. If the budget is used up idle connections
+    of other pools of the server are closed, otherwise it waits until a connection is closed"""
+    budget = _budget((host, str(port)))
+    max_connections = int(pool_config("max_server_connections", 10))
+    deadline = time.monotonic() + timeout
+    while True:
+        if try_reserve_connection(host, port):
+            return
+        with budget.condition:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Timed out waiting for a free connection to {host}, all {max_connections} connections are in use")
+            # Idle connections of other pools can show up without a notify, so check again from time to time
+            budget.condition.wait(min(remaining, 1))
+
+
+def try_reserve_connection(host, port):
+    """Same as reserve_connection but without waiting. Returns False if the budget is used up"""
+    server = (host, str(port))
+    budget = _budget(server)
+    max_connections = int(pool_config("max_server_connections", 10))
+    while True:
+        with budget.condition:
+            if budget.open < max_connections:
+                budget.open += 1
+                return True
+        if not _close_one_idle(server):
+            return False
+
+
+def release_connection(host, port):
+    budget = _budget((host, str(port)))
+    with budget.condition:
+        budget.open -= 1
+        budget.condition.notify()
+
+
+def _close_one_idle(server):
+    with _lock:
+        pools = [pool for key, pool in _pools.items() if key[:2] == server]
+    # Connections to the databases go first as they are less likely to be needed again soon
+    pools.sort(key=lambda pool: pool.admin)
+    return any(pool.close_oldest_idle() for pool in pools)
+
+
+class ConnectionPool:
+    """Connections to one database on one server as one user. Idle connections are kept for reuse,
+    health-checked before being handed out again and closed once they were idle for too long"""
+
+    def __init__(self, connect_args, password, admin):
+        self._connect_args = connect_args
+        # Pools for the admin database are used by every reconcile of the server, the ones for single databases only shortly
+        self.admin = admin
+        self._password = password
+        self._fingerprint = password_fingerprint(password)
+        self._generation = 0
+        self._idle = []  # (connection, generation, last_used)
+        self._in_use = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def reset_if_password_changed(self, password):
+        """Drop all connections if the password changed (e.g. the admin password was rotated)"""
+        fingerprint = password_fingerprint(password)
+        with self._condition:
+            if fingerprint == self._fingerprint:
+                return
+            self._password = password
+            self._fingerprint = fingerprint
+            # Connections currently in use are closed when they are given back
+            self._generation += 1
+            self._close_idle(lambda _: True)
+
+    def acquire(self):
+        max_size = int(pool_config("max_size", 5))
+        timeout = float(pool_config("acquire_timeout_seconds", 30))
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._idle or self._in_use < max_size, timeout):
+                raise TimeoutError(f"Timed out waiting for a free connection to {self._connect_args['host']}")
+            self._in_use += 1
+            idle = self._idle.pop() if self._idle else None
+            password = self._password
+            generation = self._generation
+        try:
+            if idle and self._healthy(*idle):
+                return idle[0], idle[1]
+            if idle:
+                self._close(idle[0])
+            reserve_connection(self._connect_args["host"], self._connect_args["port"], timeout)
+            try:
+                with metrics.track_call("postgres", "connect"):
+                    con = psycopg2.connect(password=password, **self._connect_args)
+            except:
+                release_connection(self._connect_args["host"], self._connect_args["port"])
+                raise
+            try:
+                con.set_session(autocommit=True)
+            except:
+                self._close(con)
+                raise
+            return con, generation
+        except:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, con, generation, broken=False):
+        with self._condition:
+            self._in_use -= 1
+            if broken or self._closed or generation != self._generation or con.closed or con.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                self._close(con)
+            else:
+                self._idle.append((con, generation, time.monotonic()))
+            self._condition.notify()
+
+    def _healthy(self, con, generation, last_used):
+        if con.closed or generation != self._generation:
+            return False
+        # Connections that were idle for a while could have been dropped by the server or a load balancer
+        if time.monotonic() - last_used > float(pool_config("health_check_after_seconds", 30)):
+            try:
+                with con.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            except psycopg2.Error:
+                return False
+        return True
+
+    def evict_idle(self):
+        if self.admin:
+            max_idle = float(pool_config("max_idle_seconds", 300))
+        else:
+            max_idle = float(pool_config("database_max_idle_seconds", 10))
+        now = time.monotonic()
+        with self._condition:
+            self._close_idle(lambda last_used: now - last_used > max_idle)
+            return self._in_use == 0 and not self._idle
+
+    def close_oldest_idle(self):
+        with self._condition:
+            if not self._idle:
+                return False
+            oldest = min(self._idle, key=lambda idle: idle[2])
+            self._idle.remove(oldest)
+            self._close(oldest[0])
+            return True
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._close_idle(lambda _: True)
+
+    def _close_idle(self, predicate):
+        keep = []
+        for con, generation, last_used in self._idle:
+            if predicate(last_used):
+                self._close(con)
+            else:
+                keep.append((con, generation, last_used))
+        self._idle = keep
+
+    def _close(self, con):
+        _close(con)
+        release_connection(self._connect_args["host"], self._connect_args["port"])
+
+
+def _close(con):
+    try:
+        con.close()
+    except psycopg2.Error:
+        pass
+
+
+def _evict_idle():
+    with _lock:
+        for key, pool in list(_pools.items()):
+            if pool.evict_idle():
+                del _pools[key]
+
+
+def get_pool(credentials, dbname, cursor_factory):
+    key = (credentials["host"], str(credentials["port"]), credentials["username"], dbname)
+    _evict_idle()
+    with _lock:
+        pool = _pools.get(key)
+        if not pool:
+            connect_args = dict(host=credentials["host"], port=credentials["port"], dbname=dbname, user=credentials["username"], sslmode=credentials["sslmode"], cursor_factory=cursor_factory)
+            pool = ConnectionPool(connect_args, credentials["password"], admin=dbname == credentials["dbname"])
+            _pools[key] = pool
+    pool.reset_if_password_changed(credentials["password"])
+    return pool
+
+
+def close_pools(host, port, dbname):
+    """Close all pooled connections to a database, e.g. before it is dropped"""
+    with _lock:
+        for key in [key for key in _pools.keys() if key[0] == host and key[1] == str(port) and key[3] == dbname]:
+            _pools.pop(key).close()
+
+
+@contextmanager
+def connection(credentials, dbname, cursor_factory):
+    if not pool_config("enabled", True):
+        with metrics.track_call("postgres", "connect"):
+            con = psycopg2.connect(host=credentials["host"], port=credentials["port"], dbname=dbname, user=credentials["username"], password=credentials["password"], sslmode=credentials["sslmode"], cursor_factory=cursor_factory)
+        con.set_session(autocommit=True)
+        try:
+            yield con
+        finally:
+            _close(con)
+        return
+    pool = get_pool(credentials, dbname, cursor_factory)
+    con, generation = pool.acquire()
+    broken = False
+    try:
+        yield con
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.release(con, generation, broken)
@@ -1,10 +1,16 @@
 import os
 import logging
+import re
+import threading
+import time
 import yaml
 
 
 logger = logging.getLogger()
 _config = None
+_config_lock = threading.Lock()
+# Seconds between checks if the config file changed
+RELOAD_CHECK_INTERVAL = 10
 
 
 class ConfigurationException(Exception):
@@ -12,24 +18,45 @@ class ConfigurationException(Exception):
         super().__init(description)
 
 
-def _get_config_value_from_env(key):
-    return os.environ.get("HYBRIDCLOUD_" + key.replace('.', '_').upper())
+def _env_key(key):
+    return "HYBRIDCLOUD_" + key.replace('.', '_').upper()
 
 
-def _get_config_value_from_config(config, key):
-    ptr = config
-    for var in key.split('.'):
-        if ptr and var in ptr:
-            ptr = ptr[var]
-        else:
-            return None
-    return ptr
+def _typed(value):
+    """Environment variables are always strings, convert booleans and numbers like the yaml file would"""
+    stripped = value.strip()
+    if stripped.lower() in ("true", "false"):
+        return stripped.lower() == "true"
+    if re.fullmatch(r"-?(0|[1-9][0-9]*)", stripped):
+        return int(stripped)
+    if re.fullmatch(r"-?[0-9]+\.[0-9]+", stripped):
+        return float(stripped)
+    return value
+
+
+def _flatten(data, prefix="", result=None):
+    """Index every (nested) dict level of the config by its dot separated key"""
+    if result is None:
+        result = dict()
+    if isinstance(data, dict):
+        for key, value in data.items():
+            path = f"{prefix}{key}"
+            result[path] = value
+            _flatten(value, path + ".", result)
+    return result
 
 
 class Configuration:
-    def __init__(self, configdata):
+    """Snapshot of the operator config. Everything is resolved when the snapshot is created, lookups are simple dict accesses"""
+    def __init__(self, configdata, path=None, mtime=None):
         self._data = configdata
-    
+        self._flat = _flatten(configdata)
+        self._env = {k: _typed(v) for k, v in os.environ.items() if k.startswith("HYBRIDCLOUD_")}
+        self._indexes = dict()
+        self.path = path
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+
     def get(self, key, default=None, fail_if_missing=False):
         """
         Retrieve a value from the operator config. Dict levels are dot separated in the key.
@@ -38,29 +65,80 @@ class Configuration:
         :param fail_if_missing: If true and key is missing in config, log error and exit app.
         :return: the configured value or None.
         """
-        value = _get_config_value_from_env(key)
-        if not value:
-            value = _get_config_value_from_config(self._data, key)
-        if not value and fail_if_missing:
+        value = self._env.get(_env_key(key))
+        if value is None or value == "":
+            value = self._flat.get(key)
+        if (value is None or value == "") and fail_if_missing:
             logger.critical(f"Required configuration '{key}' is missing.")
             exit(-1)
         if value is None:
             value = default
         return value
 
+    def overrides(self):
+        """Config values set via environment variables"""
+        return dict(self._env)
+
+    def get_index(self, keys, fields):
+        """Retrieve a list of dicts from the config (first of keys found) as a dict keyed by the tuple of the given fields.
+        The index is built once per config snapshot. Built indexes are added by swapping in a new dict, so concurrent
+        readers never see it while it is changed"""
+        index_key = (tuple(keys), tuple(fields))
+        index = self._indexes.get(index_key)
+        if index is None:
+            index = dict()
+            entries = None
+            for key in keys:
+                entries = self.get(key)
+                if entries is not None:
+                    break
+            for entry in entries or []:
+                index[tuple(entry.get(field) for field in fields)] = entry
+            self._indexes = {**self._indexes, index_key: index}
+        return index
+
 
 def _load_config() -> Configuration:
     path = os.environ.get("OPERATOR_CONFIG", "config.yaml")
+    mtime = os.path.getmtime(path)
     with open(path) as f:
        configdata = yaml.safe_load(f)
-    return Configuration(configdata)
+    return Configuration(configdata, path, mtime)
+
+
+def _reload_if_changed(current: Configuration) -> Configuration:
+    """Swap in a new snapshot if the config file changed (e.g. an updated ConfigMap) and return the snapshot to use"""
+    global _config
+    with _config_lock:
+        if _config is not current:
+            return _config
+        current.checked_at = time.monotonic()
+        try:
+            mtime = os.path.getmtime(current.path)
+        except OSError:
+            return current
+        if mtime == current.mtime:
+            return current
+        try:
+            _config = _load_config()
+            logger.info(f"Reloaded configuration from {current.path}")
+        except Exception:
+            logger.exception("Failed to reload configuration, keeping the current one")
+            current.mtime = mtime
+        return _config
 
 
 def config() -> Configuration:
     global _config
-    if not _config:
-        _config = _load_config()
-    return _config
+    current = _config
+    if not current:
+        with _config_lock:
+            if not _config:
+                _config = _load_config()
+            return _config
+    if time.monotonic() - current.checked_at > RELOAD_CHECK_INTERVAL:
+        return _reload_if_changed(current)
+    return current
 
 
 def config_get(key, default=None, fail_if_missing=False):
@@ -71,8 +149,9 @@ def config_get(key, default=None, fail_if_missing=False):
 def get_one_of(*keys, default=None, fail_if_missing=False):
     """Retrieve a value from the operator config. Keys are tried in order until one is found in the config.
     If none is found the default is returned, or if fail_if_missing is set to true an error is logged and the process exits."""
+    snapshot = config()
     for key in keys:
-        result = config_get(key)
+        result = snapshot.get(key)
         if result is not None:
             return result
     if fail_if_missing:
@@ -81,5 +160,10 @@ def get_one_of(*keys, default=None, fail_if_missing=False):
     return default
 
 
+def get_index_one_of(*keys, fields):
+    """Retrieve a list of dicts from the operator config (first of keys found) indexed by the given fields, e.g. name overrides by namespace and name"""
+    return config().get_index(keys, fields)
+
+
 def verify():
     config_get("backend", fail_if_missing=True)
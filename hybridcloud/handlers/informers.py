@@ -0,0 +1,25 @@
+import kopf
+from ..util import k8s, wakeup
+
+
+# Keep in-memory copies of the objects the handlers read over and over (server objects, admin and credential secrets)
+if k8s.cache_enabled():
+    @kopf.on.event("v1", "secrets", labels={k8s.MANAGED_BY_LABEL: k8s.MANAGED_BY_VALUE})
+    async def secret_event(event, namespace, name, **_):
+        if event["type"] == "DELETED":
+            k8s.secret_cache.remove(namespace, name)
+        else:
+            k8s.secret_cache.put(namespace, name, k8s.secret_from_dict(event["object"]))
+
+
+@kopf.on.event(*k8s.PostgreSQLServer.kopf_on())
+async def postgresql_server_event(event, namespace, name, **_):
+    cache = k8s.custom_object_caches[k8s.PostgreSQLServer.plural]
+    if event["type"] == "DELETED":
+        cache.remove(namespace, name)
+        return
+    if k8s.cache_enabled():
+        cache.put(namespace, name, event["object"])
+    if (event["object"].get("status") or dict()).get("deployment", dict()).get("status") == "finished":
+        # Wake up databases waiting for the server to be created
+        wakeup.notify((namespace, name))
@@ -2,10 +2,11 @@ from datetime import datetime, timezone
 import kopf
 from .routing import postgres_backend
 from ..config import config_get
-from ..util import env, k8s
+from ..util import env, k8s, metrics, tracing, wakeup
 from ..util.constants import BACKOFF
+from ..util.executor import call_backend, run_sync
 from ..util.password import generate_password
-from ..util.reconcile_helpers import process_action_label, ignore_control_label_change, determine_resource_password, shorten
+from ..util.reconcile_helpers import process_action_label, ignore_control_label_change, determine_resource_password, secret_outdated, shorten, spec_fingerprint, unchanged_since_last_run
 
 
 def _tmp_secret(namespace, name):
@@ -14,13 +15,15 @@ def _tmp_secret(namespace, name):
 
 if config_get("handler_on_resume", default=False):
     @kopf.on.resume(*k8s.PostgreSQLDatabase.kopf_on(), backoff=BACKOFF)
-    def postgresql_database_resume(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
-        postgresql_database_manage(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs)
+    async def postgresql_database_resume(**kwargs):
+        await postgresql_database_manage(**kwargs)
 
 
 @kopf.on.create(*k8s.PostgreSQLDatabase.kopf_on(), backoff=BACKOFF)
 @kopf.on.update(*k8s.PostgreSQLDatabase.kopf_on(), backoff=BACKOFF)
-def postgresql_database_manage(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
+@metrics.instrument_handler(k8s.PostgreSQLDatabase.kind)
+@tracing.traced_handler(k8s.PostgreSQLDatabase.kind)
+async def postgresql_database_manage(spec, meta, labels, name, namespace, body, status, retry, diff, logger, **kwargs):
     if ignore_control_label_change(diff):
         logger.debug("Only control labels removed. Nothing to do.")
         return
@@ -30,19 +33,32 @@ def postgresql_database_manage(spec, meta, labels, name, namespace, body, status
     tmp_secret_name = _tmp_secret(namespace, name)
     server_name = spec["serverRef"]["name"]
     server_namespace = namespace
-    backend, backend_name, admin_credentials = _wait_for_server(logger, namespace, server_namespace, server_name, retry)
+    backend, backend_name, admin_credentials = await _wait_for_server(logger, namespace, server_namespace, server_name, retry)
+
+    # Nothing changed since the last successful run, only check that the database and its credentials are still there
+    fingerprint = spec_fingerprint(spec, backend_name, "extensions")
+    if unchanged_since_last_run(status, fingerprint, labels):
+        if await run_sync(k8s.get_secret, namespace, spec["credentialsSecret"]) and await call_backend(backend, "database_exists", server_namespace, server_name, dbname, admin_credentials=admin_credentials):
+            logger.info("Spec and config unchanged since last run and database exists. Nothing to do")
+            return
+        logger.info("Database or credentials missing. Reconciling")
 
     # Generate or read password
     credentials_secret_name = spec["credentialsSecret"]
-    credentials_secret = k8s.get_secret(namespace, credentials_secret_name) 
-    password = determine_resource_password(credentials_secret, tmp_secret_name)
+    credentials_secret = await run_sync(k8s.get_secret, namespace, credentials_secret_name)
+    password = await run_sync(determine_resource_password, credentials_secret, tmp_secret_name)
     
     logger.info("Generated password. Creating database")
-    _status(name, namespace, status, "working", backend=backend_name)
-    backend.create_or_update_database(server_namespace, server_name, dbname, spec, admin_credentials=admin_credentials)
+    await run_sync(_status, name, namespace, status, "working", backend=backend_name)
+    # The state of the database and user is read once and shared by both steps, which update it with their changes
+    state = await call_backend(backend, "probe_database", server_namespace, server_name, dbname, username, admin_credentials=admin_credentials)
+    # Returns the version drift of the installed extensions (if the backend supports extensions)
+    extension_drift = await call_backend(backend, "create_or_update_database", server_namespace, server_name, dbname, spec, admin_credentials=admin_credentials, state=state)
+    if extension_drift:
+        logger.warning(f"Extensions with newer versions available: {', '.join(extension_drift.keys())}")
     logger.info("Created database. Creating user")
 
-    user_newly_created, credentials = backend.create_or_update_user(server_namespace, server_name, dbname, username, password, admin_credentials=admin_credentials)
+    user_newly_created, credentials = await call_backend(backend, "create_or_update_user", server_namespace, server_name, dbname, username, password, admin_credentials=admin_credentials, state=state)
 
     def action_reset_password():
         nonlocal credentials_secret
@@ -55,55 +71,62 @@ def postgresql_database_manage(spec, meta, labels, name, namespace, body, status
             credentials_secret = None
         backend.update_user_password(server_namespace, server_name, username, password, admin_credentials=admin_credentials)
         return "Password for user reset"
-    process_action_label(labels, {
+    await run_sync(process_action_label, labels, {
         "reset-password": action_reset_password,
     }, body, k8s.PostgreSQLDatabase)
 
     if not user_newly_created and not credentials_secret:
         # Secret with credentials was deleted, so need to reset the password as it cannot be extracted from database
-        action_reset_password()
+        await run_sync(action_reset_password)
 
     # store credentials in final secret
     credentials["password"] = password
-    if not credentials_secret or user_newly_created:
-        k8s.create_or_update_secret(namespace, credentials_secret_name, credentials)
-    k8s.delete_secret(env.OPERATOR_NAMESPACE, tmp_secret_name)
+    if not credentials_secret or user_newly_created or secret_outdated(credentials_secret, credentials):
+        await run_sync(k8s.create_or_update_secret, namespace, credentials_secret_name, credentials)
+    await run_sync(k8s.delete_secret, env.OPERATOR_NAMESPACE, tmp_secret_name)
     # mark success
-    _status(name, namespace, status, "finished", "Database created", backend=backend_name)
+    await run_sync(_status, name, namespace, status, "finished", "Database created", backend=backend_name, extension_drift=extension_drift, fingerprint=fingerprint)
 
 
 @kopf.on.delete(*k8s.PostgreSQLDatabase.kopf_on(), backoff=BACKOFF)
-def postgresql_database_delete(spec, status, name, namespace, logger, **kwargs):
+@metrics.instrument_handler(k8s.PostgreSQLDatabase.kind)
+@tracing.traced_handler(k8s.PostgreSQLDatabase.kind)
+async def postgresql_database_delete(spec, status, name, namespace, logger, **kwargs):
     if status and "backend" in status:
         backend_name = status["backend"]
     else:
         backend_name = config_get("backend", fail_if_missing=True)
-    backend = postgres_backend(backend_name, logger)
+    backend = await run_sync(postgres_backend, backend_name, logger)
 
     dbname = name.replace("-", "_")
     server_name = spec["serverRef"]["name"]
     server_namespace = namespace
-    server_object = k8s.get_custom_object(k8s.PostgreSQLServer, server_namespace, server_name)
-    server_exists = backend.server_exists(server_namespace, server_name)
-    admin_secret = k8s.get_secret(namespace, server_object["spec"]["credentialsSecret"]) if server_object else None
+    server_object = await run_sync(k8s.get_custom_object, k8s.PostgreSQLServer, server_namespace, server_name)
+    server_exists = await run_sync(backend.server_exists, server_namespace, server_name)
+    admin_secret = await run_sync(k8s.get_secret, namespace, server_object["spec"]["credentialsSecret"]) if server_object else None
     admin_credentials = k8s.decode_secret_data(admin_secret) if admin_secret else None
 
-    if server_exists and backend.database_exists(server_namespace, server_name, dbname, admin_credentials=admin_credentials):
+    if server_exists and await call_backend(backend, "database_exists", server_namespace, server_name, dbname, admin_credentials=admin_credentials):
         logger.info("Deleting database")
-        backend.delete_database(server_namespace, server_name, dbname, admin_credentials=admin_credentials)
-        backend.delete_user(namespace, server_name, dbname, admin_credentials=admin_credentials)
+        await call_backend(backend, "delete_database", server_namespace, server_name, dbname, admin_credentials=admin_credentials)
+        await call_backend(backend, "delete_user", namespace, server_name, dbname, admin_credentials=admin_credentials)
     else:
         logger.info("Database does not exist. Not doing anything")
-    k8s.delete_secret(namespace, spec["credentialsSecret"])
+    await run_sync(k8s.delete_secret, namespace, spec["credentialsSecret"])
 
 
-def _status(name, namespace, status_obj, status, reason=None, backend=None):
+def _status(name, namespace, status_obj, status, reason=None, backend=None, extension_drift=None, fingerprint=None):
     if status_obj:
-        status_obj = dict(backend=status_obj.get("backend", None))
+        status_obj = dict(backend=status_obj.get("backend", None), extensions=status_obj.get("extensions", None))
     else:
         status_obj = dict()
     if backend:
         status_obj["backend"] = backend
+    if status == "finished":
+        # Extensions whose installed version is older than the one available on the server
+        status_obj["extensions"] = {"drift": extension_drift} if extension_drift else None
+    if fingerprint:
+        status_obj["fingerprint"] = fingerprint
     status_obj["deployment"] = {
         "status": status,
         "reason": reason,
@@ -112,16 +135,32 @@ def _status(name, namespace, status_obj, status, reason=None, backend=None):
     k8s.patch_custom_object_status(k8s.PostgreSQLDatabase, namespace, name, status_obj)
 
 
-def _wait_for_server(logger, namespace, server_namespace, server_name, retry):
-    server_object = k8s.get_custom_object(k8s.PostgreSQLServer, server_namespace, server_name)
+async def _wait_for_server(logger, namespace, server_namespace, server_name, retry):
+    # Register as waiter before looking at the server so a notify while the checks run is not missed
+    with wakeup.waiter((server_namespace, server_name)) as server_finished:
+        server_object = await run_sync(k8s.get_custom_object, k8s.PostgreSQLServer, server_namespace, server_name)
+        if not _server_finished(server_object):
+            admin_secret = None if not server_object else await run_sync(k8s.get_secret, namespace, server_object["spec"]["credentialsSecret"])
+            if not admin_secret:
+                # Server is still being created, instead of polling wait until its handler reports it as finished
+                logger.info("Waiting for server to be created")
+                if not await wakeup.wait(server_finished, int(config_get("server_wait_timeout_seconds", default=600))):
+                    raise kopf.TemporaryError("Waiting for server to be created.", delay=20 if retry < 5 else 30 if retry < 10 else 60)
+                server_object = await run_sync(k8s.get_custom_object, k8s.PostgreSQLServer, server_namespace, server_name)
     if not server_object:
         raise kopf.TemporaryError("Waiting for server to be created.", delay=20 if retry < 5 else 30 if retry < 10 else 60)
 
     backend_name = server_object.get("status", dict()).get("backend", server_object["spec"].get("backend", config_get("backend", fail_if_missing=True)))
-    backend = postgres_backend(backend_name, logger)
+    backend = await run_sync(postgres_backend, backend_name, logger)
 
-    server_exists = backend.server_exists(server_namespace, server_name)
-    admin_secret = None if not server_object else k8s.get_secret(namespace, server_object["spec"]["credentialsSecret"])
+    server_exists = await run_sync(backend.server_exists, server_namespace, server_name)
+    admin_secret = None if not server_object else await run_sync(k8s.get_secret, namespace, server_object["spec"]["credentialsSecret"])
     if not server_object or not server_exists or not admin_secret:
         raise kopf.TemporaryError("Waiting for server to be created.", delay=20 if retry < 5 else 30 if retry < 10 else 60)
     return backend, backend_name, k8s.decode_secret_data(admin_secret)
+
+
+def _server_finished(server_object):
+    if not server_object:
+        return False
+    return server_object.get("status", dict()).get("deployment", dict()).get("status") == "finished"
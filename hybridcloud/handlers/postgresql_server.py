@@ -2,10 +2,11 @@ from datetime import datetime, timezone
 import kopf
 from .routing import postgres_backend
 from ..config import config_get
-from ..util import env, k8s
+from ..util import env, k8s, metrics, operations, tracing, wakeup
 from ..util.constants import BACKOFF
+from ..util.executor import call_backend, run_sync
 from ..util.password import generate_password
-from ..util.reconcile_helpers import ignore_control_label_change, process_action_label, determine_resource_password, shorten
+from ..util.reconcile_helpers import ignore_control_label_change, process_action_label, determine_resource_password, secret_outdated, shorten, spec_fingerprint, unchanged_since_last_run
 
 
 def _tmp_secret(namespace, name):
@@ -14,13 +15,15 @@ def _tmp_secret(namespace, name):
 
 if config_get("handler_on_resume", default=False):
     @kopf.on.resume(*k8s.PostgreSQLServer.kopf_on(), backoff=BACKOFF)
-    def postgresql_server_resume(body, spec, status, meta, labels, name, namespace, diff, logger, **kwargs):
-        postgresql_server_handler(body, spec, status, meta, labels, name, namespace, diff, logger, **kwargs)
+    async def postgresql_server_resume(**kwargs):
+        await postgresql_server_handler(**kwargs)
 
 
 @kopf.on.create(*k8s.PostgreSQLServer.kopf_on(), backoff=BACKOFF)
 @kopf.on.update(*k8s.PostgreSQLServer.kopf_on(), backoff=BACKOFF)
-def postgresql_server_handler(body, spec, status, meta, labels, name, namespace, diff, logger, **kwargs):
+@metrics.instrument_handler(k8s.PostgreSQLServer.kind)
+@tracing.traced_handler(k8s.PostgreSQLServer.kind)
+async def postgresql_server_handler(body, spec, status, meta, labels, name, namespace, diff, logger, **kwargs):
     if ignore_control_label_change(diff):
         logger.debug("Only control labels removed. Nothing to do.")
         return
@@ -29,17 +32,26 @@ def postgresql_server_handler(body, spec, status, meta, labels, name, namespace,
         backend_name = status["backend"]
     else:
         backend_name = spec.get("backend", config_get("backend", fail_if_missing=True))
-    backend = postgres_backend(backend_name, logger)
-
-    valid, reason = backend.server_spec_valid(namespace, name, spec)
+    backend = await run_sync(postgres_backend, backend_name, logger)
+
+    # Nothing changed since the last successful run, only check that the server and its credentials are still there
+    fingerprint = spec_fingerprint(spec, backend_name)
+    if unchanged_since_last_run(status, fingerprint, labels):
+        if await run_sync(k8s.get_secret, namespace, spec["credentialsSecret"]) and await run_sync(backend.server_exists, namespace, name):
+            logger.info("Spec and config unchanged since last run and server exists. Nothing to do")
+            wakeup.notify((namespace, name))
+            return
+        logger.info("Server or credentials missing. Reconciling")
+
+    valid, reason = await run_sync(backend.server_spec_valid, namespace, name, spec)
     if not valid:
-        _status_server(name, namespace, status, "failed", f"Validation failed: {reason}")
+        await run_sync(_status_server, name, namespace, status, "failed", f"Validation failed: {reason}")
         raise kopf.PermanentError("Spec is invalid, check status for details")
 
     tmp_secret_name = _tmp_secret(namespace, name)
     # generate and store credentials
-    credentials_secret = k8s.get_secret(namespace, spec["credentialsSecret"])
-    password = determine_resource_password(credentials_secret, tmp_secret_name)
+    credentials_secret = await run_sync(k8s.get_secret, namespace, spec["credentialsSecret"])
+    password = await run_sync(determine_resource_password, credentials_secret, tmp_secret_name)
 
     def action_reset_password():
         nonlocal credentials_secret
@@ -51,48 +63,102 @@ def postgresql_server_handler(body, spec, status, meta, labels, name, namespace,
             k8s.create_or_update_secret(env.OPERATOR_NAMESPACE, tmp_secret_name, {"password": password})
             credentials_secret = None
         return "Admin password reset"
-    process_action_label(labels, {
+    await run_sync(process_action_label, labels, {
         "reset-password": action_reset_password,
     }, body, k8s.PostgreSQLServer)
 
     logger.info("Generated password. Creating/updating server")
-    _status_server(name, namespace, status, "working", backend=backend_name)
-    # create server
-    connection_data, warnings = backend.create_or_update_server(namespace, name, spec, password, admin_password_changed=not credentials_secret)
+    await run_sync(_status_server, name, namespace, status, "working", backend=backend_name)
+    # create server, long-running cloud operations are not waited for but resumed on the next run of the handler
+    with operations.track((status or dict()).get("operations")) as pending_operations:
+        try:
+            connection_data, warnings = await run_sync(backend.create_or_update_server, namespace, name, spec, password, admin_password_changed=not credentials_secret)
+        except operations.OperationPending as ex:
+            replicas = await _replica_status(backend, namespace, name, spec)
+            await run_sync(_status_server, name, namespace, status, "working", str(ex), backend=backend_name, pending_operations=pending_operations, replicas=replicas)
+            raise kopf.TemporaryError(str(ex), delay=ex.delay)
+        except Exception as ex:
+            # The backend may have started or finished operations before it failed, the status has to reflect them for the retry
+            state = "failed" if isinstance(ex, kopf.PermanentError) else "working"
+            await run_sync(_status_server, name, namespace, status, state, str(ex), backend=backend_name, pending_operations=pending_operations)
+            raise
     for warning in warnings:
         kopf.warn(body, reason="CloudProviderWarning", message=warning)
     logger.info("Created/updated server. Creating credentials secret")
 
-    # store credentials in final secret
-    if not credentials_secret:
-        k8s.create_or_update_secret(namespace, spec["credentialsSecret"], connection_data)
-    k8s.delete_secret(env.OPERATOR_NAMESPACE, tmp_secret_name)
-    # mark success
-    _status_server(name, namespace, status, "finished", "Database server created", backend=backend_name)
+    # store credentials in final secret, also if the backend changed the connection data (e.g. added a reader host)
+    if secret_outdated(credentials_secret, connection_data):
+        await run_sync(k8s.create_or_update_secret, namespace, spec["credentialsSecret"], connection_data)
+    await run_sync(k8s.delete_secret, env.OPERATOR_NAMESPACE, tmp_secret_name)
+    # mark success, operations postponed by the backend (e.g. to the maintenance window) stay in the status until they are done
+    scheduled = operations.next_scheduled(pending_operations)
+    replicas = await _replica_status(backend, namespace, name, spec)
+    if scheduled is None:
+        await run_sync(_status_server, name, namespace, status, "finished", "Database server created", backend=backend_name, fingerprint=fingerprint, replicas=replicas)
+    else:
+        await run_sync(_status_server, name, namespace, status, "finished", "Database server created, some changes are applied in the maintenance window", backend=backend_name, pending_operations=pending_operations, fingerprint=fingerprint, replicas=replicas)
+    # Wake up any databases waiting for this server
+    wakeup.notify((namespace, name))
+    if scheduled is not None:
+        logger.info(f"Remaining changes are applied by the scheduled operations timer in {scheduled} seconds")
+
+
+def _has_scheduled_operations(status, **_):
+    return operations.next_scheduled((status or dict()).get("operations")) is not None
+
+
+@kopf.timer(*k8s.PostgreSQLServer.kopf_on(), interval=float(config_get("operations.scheduled_check_seconds", default=300)), idle=60, when=_has_scheduled_operations)
+async def postgresql_server_scheduled_operations(status, logger, **kwargs):
+    """Runs the server handler again once an operation postponed by the backend (e.g. a restart in the maintenance window) is due.
+    The handler itself finishes instead of waiting for it, so spec changes in between are reconciled right away"""
+    if operations.next_scheduled(status.get("operations")) != 0:
+        return
+    logger.info("Scheduled operations are due. Reconciling")
+    await postgresql_server_handler(status=status, logger=logger, diff=None, **kwargs)
 
 
 @kopf.on.delete(*k8s.PostgreSQLServer.kopf_on(), backoff=BACKOFF)
-def postgresql_server_delete(spec, status, name, namespace, logger, **kwargs):
+@metrics.instrument_handler(k8s.PostgreSQLServer.kind)
+@tracing.traced_handler(k8s.PostgreSQLServer.kind)
+async def postgresql_server_delete(spec, status, name, namespace, logger, **kwargs):
     if status and "backend" in status:
         backend_name = status["backend"]
     else:
         backend_name = spec.get("backend", config_get("backend", fail_if_missing=True))
-    backend = postgres_backend(backend_name, logger)
-    if backend.server_exists(namespace, name):
+    backend = await run_sync(postgres_backend, backend_name, logger)
+    if await run_sync(backend.server_exists, namespace, name):
         logger.info("Deleting server")
-        backend.delete_server(namespace, name)
+        await call_backend(backend, "delete_server", namespace, name)
     else:
         logger.info("Server does not exist. Not doing anything")
-    k8s.delete_secret(namespace, spec["credentialsSecret"])
+    await run_sync(k8s.delete_secret, namespace, spec["credentialsSecret"])
+
+
+async def _replica_status(backend, namespace, name, spec):
+    """State of the read replicas if the backend supports them"""
+    if not hasattr(backend, "replica_status"):
+        return None
+    return await run_sync(backend.replica_status, namespace, name, spec)
 
 
-def _status_server(name, namespace, status_obj, status, reason=None, backend=None):
+def _status_server(name, namespace, status_obj, status, reason=None, backend=None, pending_operations=None, fingerprint=None, replicas=None):
+    previous_replicas = (status_obj or dict()).get("replicas") or dict()
     if status_obj:
         status_obj = dict(backend=status_obj.get("backend", None))
     else:
         status_obj = dict()
+    if replicas is not None:
+        # Replicas that no longer exist are removed by the merge patch
+        status_obj["replicas"] = {**{replica: None for replica in previous_replicas.keys()}, **replicas}
     if backend:
         status_obj["backend"] = backend
+    if pending_operations is not None:
+        # Finished operations have a value of None and are removed by the merge patch
+        status_obj["operations"] = pending_operations
+    elif status == "finished":
+        status_obj["operations"] = None
+    if fingerprint:
+        status_obj["fingerprint"] = fingerprint
     status_obj["deployment"] = {
         "status": status,
         "reason": reason,
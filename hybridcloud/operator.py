@@ -7,8 +7,10 @@ import logging
 import random
 import kopf
 from . import config
+from .util import metrics, tracing
+from .util.azure import close_async_clients
 # Import the handlers so kopf sees them
-from .handlers import postgresql_server, postgresql_database
+from .handlers import postgresql_server, postgresql_database, informers
 
 
 logger = logging.getLogger('azure')
@@ -37,6 +39,13 @@ def configure(settings: kopf.OperatorSettings, **_):
     settings.watching.connect_timeout = 60
     settings.watching.client_timeout = 120
     settings.networking.request_timeout = 120
+    metrics.start_server()
+    tracing.setup()
+
+
+@kopf.on.cleanup()
+async def cleanup(**_):
+    await close_async_clients()
 
 
 @kopf.on.login(errors=kopf.ErrorsMode.TEMPORARY, retries=5)
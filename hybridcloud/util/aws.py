@@ -1,14 +1,88 @@
+import threading
+import time
 import boto3
 from botocore.config import Config
-from ..config import get_one_of
+from . import metrics, tracing
+from .executor import max_workers
+from ..config import config_get, get_one_of
 
 
-def _config():
-    region = get_one_of("backends.awsrds.region", "backends.aws.region", fail_if_missing=True)
+# boto3 clients are thread-safe, so one client per region is shared by all handlers. Sessions are not, so the
+# one session all clients are created from is only used while holding the lock
+_session = None
+_clients = dict()
+_lock = threading.Lock()
+
+
+def _config(region):
     return Config(
-        region_name = region,
+        region_name=region,
+        # Every executor thread can talk to AWS at the same time without waiting for a connection
+        max_pool_connections=int(config_get("backends.aws.max_pool_connections", default=max_workers())),
+        # Adaptive mode also rate-limits the client itself once AWS starts throttling, so bursts of reconciles do not fail
+        retries={"mode": "adaptive", "max_attempts": int(config_get("backends.aws.max_attempts", default=10))},
+        tcp_keepalive=True,
     )
 
 
-def aws_client_rds():
-    return boto3.client("rds", config=_config())
+def _client(service, region):
+    if not region:
+        region = get_one_of("backends.awsrds.region", "backends.aws.region", fail_if_missing=True)
+    client = _clients.get((service, region))
+    if not client:
+        global _session
+        with _lock:
+            client = _clients.get((service, region))
+            if not client:
+                if not _session:
+                    _session = boto3.session.Session()
+                client = _session.client(service, config=_config(region))
+                _instrument(client)
+                _clients[(service, region)] = client
+    return client
+
+
+def aws_client_rds(region=None):
+    """Shared RDS client for the region, defaults to the region from the config"""
+    return _client("rds", region)
+
+
+def aws_client_autoscaling(region=None):
+    return _client("application-autoscaling", region)
+
+
+def aws_client_secretsmanager(region=None):
+    return _client("secretsmanager", region)
+
+
+def _instrument(client):
+    """Record every API call of the client in the metrics and as a span"""
+    service = client.meta.service_model.service_name
+    def before_call(context, model, **kwargs):
+        context["hybridcloud_start"] = time.monotonic()
+        context["hybridcloud_span"] = tracing.start_span(f"aws {service}.{model.name}", **{"rpc.service": service, "rpc.method": model.name})
+    def after_call(context, model, parsed, **kwargs):
+        error_code = parsed.get("Error", dict()).get("Code") if parsed else None
+        if not error_code:
+            outcome = "success"
+        elif "Throttl" in error_code:
+            outcome = "throttled"
+        else:
+            outcome = "error"
+        metrics.observe_call(f"aws-{service}", model.name, time.monotonic() - context.get("hybridcloud_start", time.monotonic()), outcome)
+        span = context.pop("hybridcloud_span", None)
+        if span:
+            request_id = parsed.get("ResponseMetadata", dict()).get("RequestId") if parsed else None
+            if request_id:
+                span.set_attribute("cloud.request_id", request_id)
+            if error_code:
+                span.set_attribute("aws.error_code", error_code)
+            span.end()
+    def after_call_error(context, model, **kwargs):
+        metrics.observe_call(f"aws-{service}", model.name, time.monotonic() - context.get("hybridcloud_start", time.monotonic()), "error")
+        span = context.pop("hybridcloud_span", None)
+        if span:
+            span.end()
+    client.meta.events.register(f"before-call.{service}", before_call)
+    client.meta.events.register(f"after-call.{service}", after_call)
+    client.meta.events.register(f"after-call-error.{service}", after_call_error)
@@ -1,10 +1,181 @@
+from collections import deque
+import random
+import threading
+import time
+from urllib.parse import urlparse
+import aiohttp
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.policies import AsyncHTTPPolicy, HTTPPolicy
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
 from azure.mgmt.rdbms.postgresql import PostgreSQLManagementClient
+from azure.mgmt.rdbms.postgresql.aio import PostgreSQLManagementClient as AsyncPostgreSQLManagementClient
 from azure.mgmt.rdbms.postgresql_flexibleservers import PostgreSQLManagementClient as PostgreSQLFlexibleManagementClient
+from azure.mgmt.rdbms.postgresql_flexibleservers.aio import PostgreSQLManagementClient as AsyncPostgreSQLFlexibleManagementClient
 from azure.mgmt.privatedns import PrivateDnsManagementClient
+from azure.mgmt.privatedns.aio import PrivateDnsManagementClient as AsyncPrivateDnsManagementClient
 from azure.mgmt.network import NetworkManagementClient
+from azure.mgmt.network.aio import NetworkManagementClient as AsyncNetworkManagementClient
 from azure.mgmt.resource import ManagementLockClient
-from ..config import get_one_of
+from . import metrics, operations, tracing
+from ..config import config_get, get_one_of
+
+
+# Credential and clients are thread-safe and are shared by all handlers. Reusing the credential also reuses its cached access tokens
+_credential = None
+_clients = dict()
+_lock = threading.Lock()
+# The async clients are only used from the event loop of the operator and share one aiohttp session (and its connection pool)
+_async_credential = None
+_async_clients = dict()
+_session = None
+
+
+class MetricsPolicy(HTTPPolicy):
+    """Records every request to the Azure API (including polls of long-running operations) in the metrics and as a span"""
+    def send(self, request):
+        operation = f"{request.http_request.method} {_resource_type(request.http_request.url)}"
+        start = time.monotonic()
+        with tracing.span(f"azure {operation}", **{"http.method": request.http_request.method, "http.url": request.http_request.url}) as span:
+            try:
+                response = self.next.send(request)
+            except Exception:
+                metrics.observe_call("azure", operation, time.monotonic() - start, "error")
+                raise
+            status_code = response.http_response.status_code
+            span.set_attribute("http.status_code", status_code)
+            request_id = response.http_response.headers.get("x-ms-request-id")
+            if request_id:
+                span.set_attribute("cloud.request_id", request_id)
+        outcome = "success" if status_code < 400 else "throttled" if status_code == 429 else "error"
+        metrics.observe_call("azure", operation, time.monotonic() - start, outcome)
+        return response
+
+
+class AsyncMetricsPolicy(AsyncHTTPPolicy):
+    """Same as MetricsPolicy for the async clients"""
+    async def send(self, request):
+        operation = f"{request.http_request.method} {_resource_type(request.http_request.url)}"
+        start = time.monotonic()
+        with tracing.span(f"azure {operation}", **{"http.method": request.http_request.method, "http.url": request.http_request.url}) as span:
+            try:
+                response = await self.next.send(request)
+            except Exception:
+                metrics.observe_call("azure", operation, time.monotonic() - start, "error")
+                raise
+            status_code = response.http_response.status_code
+            span.set_attribute("http.status_code", status_code)
+            request_id = response.http_response.headers.get("x-ms-request-id")
+            if request_id:
+                span.set_attribute("cloud.request_id", request_id)
+        outcome = "success" if status_code < 400 else "throttled" if status_code == 429 else "error"
+        metrics.observe_call("azure", operation, time.monotonic() - start, outcome)
+        return response
+
+
+def _resource_type(url):
+    # Use the resource type instead of the full url to keep the number of metric labels small
+    # e.g. /subscriptions/x/resourceGroups/y/providers/Microsoft.DBforPostgreSQL/flexibleServers/z/configurations/a -> Microsoft.DBforPostgreSQL/flexibleServers/configurations
+    segments = urlparse(url).path.strip("/").split("/")
+    lowered = [segment.lower() for segment in segments]
+    if "providers" not in lowered:
+        return "other"
+    index = len(lowered) - 1 - lowered[::-1].index("providers")
+    provider = segments[index+1:]
+    if not provider:
+        return "other"
+    return "/".join([provider[0]] + provider[1::2])
+
+
+def _conflict(ex):
+    """ARM runs operations on the same server one after another and rejects the ones arriving while another is running"""
+    if not isinstance(ex, HttpResponseError):
+        return False
+    code = str(getattr(getattr(ex, "error", None), "code", None) or "")
+    return ex.status_code == 409 or code in ("ServerBusy", "OperationConflict", "AnotherOperationInProgress", "ConflictingServerOperation")
+
+
+def _conflict_backoff(attempt):
+    # Jitter so operations rejected together are not all started again at the same time
+    return min(2 ** attempt, 30) * random.uniform(0.5, 1.5)
+
+
+def wait_all(operations, limit=5):
+    """Start long-running operations (callables returning a poller) with at most limit of them running at the same time
+    and wait for all of them. Operations rejected because another one on the same server is running are started again
+    with backoff. If operations fail the first error is raised once all operations are finished"""
+    pending = deque()  # (operation, attempt, poller)
+    error = None
+    max_attempts = int(config_get("backends.azure.conflict_retries", default=8)) + 1
+
+    def start(operation, attempt):
+        nonlocal error
+        while True:
+            try:
+                # The poller polls in the background, so the next operation can be started right away
+                pending.append((operation, attempt, operation()))
+                return
+            except Exception as ex:
+                if not _conflict(ex) or attempt + 1 >= max_attempts:
+                    error = error or ex
+                    return
+            time.sleep(_conflict_backoff(attempt))
+            attempt += 1
+
+    def wait_oldest():
+        nonlocal error
+        operation, attempt, poller = pending.popleft()
+        try:
+            poller.result()
+        except Exception as ex:
+            if _conflict(ex) and attempt + 1 < max_attempts:
+                time.sleep(_conflict_backoff(attempt))
+                start(operation, attempt + 1)
+            else:
+                error = error or ex
+
+    for operation in operations:
+        if len(pending) >= max(int(limit), 1):
+            wait_oldest()
+        start(operation, 0)
+    while pending:
+        wait_oldest()
+    if error:
+        raise error
+
+
+def wait_for_operation(key, begin, *args, **kwargs):
+    """Start a long-running operation (or resume it with the continuation token stored by an earlier handler run) and wait for it.
+    If it takes longer than the grace period and the handler can resume operations, the handler slot is given back
+    instead (operations.OperationPending) and the operation is picked up again on the next run"""
+    request = [_without_secrets(arg.as_dict()) if hasattr(arg, "as_dict") else arg for arg in args]
+    state = operations.pending(key, request)
+    poller = None
+    if state:
+        try:
+            poller = begin(*args, continuation_token=state["continuation_token"], **kwargs)
+        except Exception:
+            # Token can not be used anymore (e.g. operation expired), start over
+            poller = None
+    if not poller:
+        poller = begin(*args, **kwargs)
+    if operations.resumable():
+        poller.wait(operations.grace_seconds())
+        if not poller.done():
+            operations.wait(key, {"continuation_token": poller.continuation_token()}, request)
+    result = poller.result()
+    operations.finished(key)
+    return result
+
+
+def _without_secrets(value):
+    # The fingerprint of the request is stored in the status, passwords (e.g. the administrator login) must not be part of it
+    if isinstance(value, dict):
+        return {key: _without_secrets(item) for key, item in value.items() if "password" not in key.lower()}
+    if isinstance(value, list):
+        return [_without_secrets(item) for item in value]
+    return value
 
 
 def _subscription_id():
@@ -12,24 +183,91 @@ def _subscription_id():
 
 
 def _credentials():
-    return DefaultAzureCredential()
+    global _credential
+    if not _credential:
+        with _lock:
+            if not _credential:
+                _credential = DefaultAzureCredential()
+    return _credential
+
+
+def _client(client_class):
+    key = (client_class, _subscription_id())
+    client = _clients.get(key)
+    if not client:
+        credential = _credentials()
+        with _lock:
+            client = _clients.get(key)
+            if not client:
+                client = client_class(credential, key[1], per_call_policies=[MetricsPolicy()])
+                _clients[key] = client
+    return client
 
 
 def azure_client_postgres():
-    return PostgreSQLManagementClient(_credentials(), _subscription_id())
+    return _client(PostgreSQLManagementClient)
 
 
 def azure_client_postgres_flexible():
-    return PostgreSQLFlexibleManagementClient(_credentials(), _subscription_id())
+    return _client(PostgreSQLFlexibleManagementClient)
 
 
 def azure_client_privatedns():
-    return PrivateDnsManagementClient(_credentials(), _subscription_id())
+    return _client(PrivateDnsManagementClient)
 
 
 def azure_client_network():
-    return NetworkManagementClient(_credentials(), _subscription_id())
+    return _client(NetworkManagementClient)
 
 
 def azure_client_locks():
-    return ManagementLockClient(_credentials(), _subscription_id())
+    return _client(ManagementLockClient)
+
+
+def _transport():
+    global _session
+    if not _session:
+        _session = aiohttp.ClientSession()
+    return AioHttpTransport(session=_session, session_owner=False)
+
+
+def _async_client(client_class):
+    global _async_credential
+    key = (client_class, _subscription_id())
+    client = _async_clients.get(key)
+    if not client:
+        if not _async_credential:
+            _async_credential = AsyncDefaultAzureCredential(transport=_transport())
+        client = client_class(_async_credential, key[1], transport=_transport(), per_call_policies=[AsyncMetricsPolicy()])
+        _async_clients[key] = client
+    return client
+
+
+def azure_client_postgres_async():
+    return _async_client(AsyncPostgreSQLManagementClient)
+
+
+def azure_client_postgres_flexible_async():
+    return _async_client(AsyncPostgreSQLFlexibleManagementClient)
+
+
+def azure_client_privatedns_async():
+    return _async_client(AsyncPrivateDnsManagementClient)
+
+
+def azure_client_network_async():
+    return _async_client(AsyncNetworkManagementClient)
+
+
+async def close_async_clients():
+    """Close the async clients, the credential and the shared session, e.g. when the operator shuts down"""
+    global _async_credential, _session
+    for client in _async_clients.values():
+        await client.close()
+    _async_clients.clear()
+    if _async_credential:
+        await _async_credential.close()
+        _async_credential = None
+    if _session:
+        await _session.close()
+        _session = None
@@ -0,0 +1,26 @@
+import threading
+
+
+class ObjectCache:
+    """In-memory store for kubernetes objects, keyed by namespace and name.
+    It is filled from watch events and from the results of the operators own writes"""
+
+    def __init__(self):
+        self._objects = dict()
+        self._lock = threading.Lock()
+
+    def get(self, namespace, name):
+        with self._lock:
+            return self._objects.get((namespace, name))
+
+    def put(self, namespace, name, obj):
+        with self._lock:
+            self._objects[(namespace, name)] = obj
+
+    def remove(self, namespace, name):
+        with self._lock:
+            self._objects.pop((namespace, name), None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._objects)
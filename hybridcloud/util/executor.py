@@ -0,0 +1,40 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ..config import config_get
+
+
+_executor = None
+_lock = threading.Lock()
+
+
+def max_workers():
+    return int(config_get("executor.max_workers", default=20))
+
+
+def executor() -> ThreadPoolExecutor:
+    """Bounded thread pool all blocking backend and kubernetes calls of the handlers are run on"""
+    global _executor
+    if not _executor:
+        with _lock:
+            if not _executor:
+                _executor = ThreadPoolExecutor(max_workers=max_workers(), thread_name_prefix="backend")
+    return _executor
+
+
+async def run_sync(func, *args, **kwargs):
+    """Run a blocking function on the shared executor and wait for it without blocking the event loop.
+    The context (e.g. the kopf handler context needed for kopf.event) is passed along to the worker thread."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor(), functools.partial(context.run, func, *args, **kwargs))
+
+
+async def call_backend(backend, method, *args, **kwargs):
+    """Call a backend method, preferring its native async variant (<method>_async) if the backend has one"""
+    async_method = getattr(backend, f"{method}_async", None)
+    if async_method:
+        return await async_method(*args, **kwargs)
+    return await run_sync(getattr(backend, method), *args, **kwargs)
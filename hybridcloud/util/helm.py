@@ -1,5 +1,6 @@
 import json
 import subprocess
+from . import metrics, tracing
 
 
 def run(cmd, fail=False, **kwargs):
@@ -13,7 +14,9 @@ def run(cmd, fail=False, **kwargs):
 
 
 def run_helm(cmd, **kwargs):
-    return run(f"helm " + cmd, **kwargs)
+    operation = cmd.split(" ", 1)[0]
+    with tracing.span(f"helm {operation}"), metrics.track_call("helm", operation):
+        return run(f"helm " + cmd, **kwargs)
 
 
 def install_upgrade(namespace, name, chart, options, values=None):
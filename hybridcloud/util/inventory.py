@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from . import tracing
+from ..config import config_get
+
+
+MANAGED_TAG = "hybridcloud-postgresql-operator:namespace"
+
+logger = logging.getLogger(__name__)
+
+_inventories = dict()
+_lock = threading.Lock()
+
+
+def enabled():
+    return config_get("inventory.enabled", default=True)
+
+
+def _refresh_seconds():
+    return float(config_get("inventory.refresh_seconds", default=60))
+
+
+class Inventory:
+    """All servers the operator manages in one backend account/region or resource group, fetched with one paginated list call.
+    Existence and status checks read from it instead of each sending their own GET. It is refreshed once it is older than
+    inventory.refresh_seconds and kept up-to-date with the changes the operator makes itself in between"""
+
+    def __init__(self, name, fetch, args):
+        self._name = name
+        self._fetch = fetch
+        self._args = args
+        self._lock = threading.RLock()
+        self._items = dict()
+        self._loaded_at = None
+        self._failed_at = None
+        self._failures = 0
+
+    def _retry_seconds(self):
+        # Back off after failed refreshes (e.g. throttling), doubling up to 16 times the refresh interval
+        return _refresh_seconds() * 2 ** min(self._failures - 1, 4)
+
+    def _refresh_if_stale(self):
+        # Concurrent callers wait for a running refresh instead of listing the servers themselves
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < _refresh_seconds():
+                return True
+            if self._failed_at is not None and time.monotonic() - self._failed_at < self._retry_seconds():
+                return False
+            try:
+                with tracing.span("inventory refresh", **{"inventory.name": self._name}):
+                    self._items = dict(self._fetch(*self._args))
+            except Exception as ex:
+                # E.g. missing list permissions, the callers then fall back to looking up single servers
+                logger.warning(f"Could not refresh inventory {self._name}: {ex}")
+                self._items = dict()
+                self._loaded_at = None
+                self._failed_at = time.monotonic()
+                self._failures += 1
+                return False
+            self._loaded_at = time.monotonic()
+            self._failed_at = None
+            self._failures = 0
+            return True
+
+    def get(self, key, lookup):
+        """Return the listed object for the key. Servers that are not listed (e.g. created since the last refresh
+        or not tagged because they were adopted via name_overrides) are looked up with lookup() and remembered"""
+        if not enabled() or not self._refresh_if_stale():
+            return lookup()
+        with self._lock:
+            if key in self._items:
+                return self._items[key]
+        obj = lookup()
+        if obj:
+            self.put(key, obj)
+        return obj
+
+    def keys(self):
+        self._refresh_if_stale()
+        with self._lock:
+            return set(self._items.keys())
+
+    def put(self, key, obj):
+        """Record the current state of a server, e.g. after the operator changed it"""
+        with self._lock:
+            self._items[key] = obj
+
+    def remove(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+
+def get_inventory(name, fetch, *args):
+    """Return the shared inventory with the name, fetch(*args) is called to (re)load it and has to return (key, object) pairs.
+    The inventory lives as long as the operator, so fetch should be a module-level function and args plain values
+    (e.g. the region) instead of something that keeps a backend object and its handler logger alive"""
+    with _lock:
+        inventory = _inventories.get(name)
+        if not inventory:
+            inventory = Inventory(name, fetch, args)
+            _inventories[name] = inventory
+        return inventory
+
+
+def aws_managed(resource):
+    return any(tag.get("Key") == MANAGED_TAG for tag in resource.get("TagList", []))
+
+
+def azure_managed(server):
+    return MANAGED_TAG in (server.tags or dict())
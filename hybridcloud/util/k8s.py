@@ -2,11 +2,29 @@ import base64
 from dataclasses import dataclass
 import os
 import re
+import socket
+import threading
 import kopf
 import kubernetes
+import urllib3
+from .cache import ObjectCache
+from .executor import max_workers
+from ..config import config_get
 
 
 API_GROUP = "hybridcloud.maibornwolff.de"
+# Label set on all secrets created by the operator, used to limit the secrets watched for the cache
+MANAGED_BY_LABEL = f"{API_GROUP}/managed-by"
+MANAGED_BY_VALUE = "hybrid-cloud-postgresql-operator"
+
+_api_client = None
+_api_client_token_mtime = None
+_api_client_lock = threading.Lock()
+
+# Filled by the watch handlers in handlers/informers.py, reads fall back to the API on a miss
+secret_cache = ObjectCache()
+custom_object_caches = dict()
+
 
 @dataclass
 class Resource:
@@ -21,6 +39,11 @@ class Resource:
 
 PostgreSQLServer = Resource(API_GROUP, "v1alpha1", "postgresqlservers", "PostgreSQLServer")
 PostgreSQLDatabase = Resource(API_GROUP, "v1alpha1", "postgresqldatabases", "PostgreSQLDatabase")
+custom_object_caches[PostgreSQLServer.plural] = ObjectCache()
+
+
+def cache_enabled():
+    return config_get("cache.enabled", default=True)
 
 
 def decode_secret_data(secret):
@@ -31,35 +54,46 @@ def decode_secret_data(secret):
 
 
 def create_secret(namespace, name, data, labels={}):
-    _auth()
-    api = kubernetes.client.CoreV1Api()
+    api = _core_api()
     metadata = {
         "name": name,
         "namespace": namespace,
-        "labels": labels,
+        "labels": {**labels, MANAGED_BY_LABEL: MANAGED_BY_VALUE},
     }
-    body = kubernetes.client.V1Secret(metadata=metadata, string_data=data)
-    api.create_namespaced_secret(namespace, body)
+    body = kubernetes.client.V1Secret(metadata=metadata, string_data={key: value for key, value in data.items() if value is not None})
+    _cache_secret(api.create_namespaced_secret(namespace, body))
 
 
 def get_secret(namespace, name):
-    _auth()
-    api = kubernetes.client.CoreV1Api()
+    if cache_enabled():
+        secret = secret_cache.get(namespace, name)
+        if secret:
+            return secret
+    api = _core_api()
     try:
-        return api.read_namespaced_secret(name, namespace)
+        secret = api.read_namespaced_secret(name, namespace)
     except:
         return None
+    _cache_secret(secret)
+    return secret
 
 
 def update_secret(namespace, name, data):
-    _auth()
-    api = kubernetes.client.CoreV1Api()
+    """Patch the secret with the given values, keys with a value of None are removed from it"""
+    api = _core_api()
     metadata = {
         "name": name,
-        "namespace": namespace
+        "namespace": namespace,
+        # Secrets created by older versions of the operator do not have the label yet
+        "labels": {MANAGED_BY_LABEL: MANAGED_BY_VALUE},
+    }
+    # stringData is only merged into the existing keys, removing one needs a null in data
+    body = {
+        "metadata": metadata,
+        "stringData": {key: value for key, value in data.items() if value is not None},
+        "data": {key: None for key, value in data.items() if value is None},
     }
-    body = kubernetes.client.V1Secret(metadata=metadata, string_data=data)
-    api.patch_namespaced_secret(name, namespace, body)
+    _cache_secret(api.patch_namespaced_secret(name, namespace, body))
 
 
 def create_or_update_secret(namespace, name, data, labels={}):
@@ -70,8 +104,8 @@ def create_or_update_secret(namespace, name, data, labels={}):
 
 
 def delete_secret(namespace, name):
-    _auth()
-    api = kubernetes.client.CoreV1Api()
+    api = _core_api()
+    secret_cache.remove(namespace, name)
     try:
         api.delete_namespaced_secret(name, namespace)
     except:
@@ -79,22 +113,26 @@ def delete_secret(namespace, name):
 
 
 def patch_custom_object(resource: Resource, namespace: str,  name: str, body):
-    _auth()
-    api = kubernetes.client.CustomObjectsApi()
-    api.patch_namespaced_custom_object(resource.group, resource.version, namespace, resource.plural, name, body)
+    api = _custom_objects_api()
+    _cache_custom_object(resource, api.patch_namespaced_custom_object(resource.group, resource.version, namespace, resource.plural, name, body))
 
 
 def get_custom_object(resource: Resource, namespace: str, name: str):
-    _auth()
-    api = kubernetes.client.CustomObjectsApi()
+    cache = custom_object_caches.get(resource.plural)
+    if cache is not None and cache_enabled():
+        obj = cache.get(namespace, name)
+        if obj:
+            return obj
+    api = _custom_objects_api()
     try:
-        return api.get_namespaced_custom_object(resource.group, resource.version, namespace, resource.plural, name)
+        obj = api.get_namespaced_custom_object(resource.group, resource.version, namespace, resource.plural, name)
     except:
         return None
+    _cache_custom_object(resource, obj)
+    return obj
 
 
 def patch_custom_object_status(resource: Resource, namespace: str, name: str, status):
-    _auth()
     body = {
         "metadata": {
             "name": name,
@@ -106,8 +144,7 @@ def patch_custom_object_status(resource: Resource, namespace: str, name: str, st
 
 
 def list_pvcs(namespace: str, name_pattern: str):
-    _auth()
-    api = kubernetes.client.CoreV1Api()
+    api = _core_api()
     pattern = re.compile(name_pattern)
     pvcs = api.list_namespaced_persistent_volume_claim(namespace)
     for pvc in pvcs.items:
@@ -116,14 +153,65 @@ def list_pvcs(namespace: str, name_pattern: str):
 
 
 def delete_pvc(namespace: str, name: str):
-    _auth()
-    api = kubernetes.client.CoreV1Api()
+    api = _core_api()
     try:
         api.delete_namespaced_persistent_volume_claim(name, namespace)
     except:
         pass
 
-def _auth():
-    if os.getenv("TOKEN_PATH"):
-        # We only need to explictly auth if we use a token, otherwise kopf takes care of that for us
-        kubernetes.config.load_config()
+
+def secret_from_dict(obj):
+    """Convert a raw secret (e.g. from a watch event) into the object type returned by the kubernetes client"""
+    metadata = obj.get("metadata", dict())
+    return kubernetes.client.V1Secret(
+        api_version="v1",
+        kind="Secret",
+        metadata=kubernetes.client.V1ObjectMeta(name=metadata.get("name"), namespace=metadata.get("namespace"), labels=metadata.get("labels"), resource_version=metadata.get("resourceVersion")),
+        data=dict(obj.get("data") or dict()),
+        type=obj.get("type"),
+    )
+
+
+def _cache_secret(secret):
+    # Only cache secrets that are also watched, otherwise changes by others would never be seen
+    if not cache_enabled() or not secret or not secret.metadata.labels or secret.metadata.labels.get(MANAGED_BY_LABEL) != MANAGED_BY_VALUE:
+        return
+    if secret.data is None:
+        secret.data = dict()
+    secret_cache.put(secret.metadata.namespace, secret.metadata.name, secret)
+
+
+def _cache_custom_object(resource: Resource, obj):
+    cache = custom_object_caches.get(resource.plural)
+    if cache is None or not cache_enabled() or not obj:
+        return
+    cache.put(obj["metadata"]["namespace"], obj["metadata"]["name"], obj)
+
+
+def _core_api():
+    return kubernetes.client.CoreV1Api(_client())
+
+
+def _custom_objects_api():
+    return kubernetes.client.CustomObjectsApi(_client())
+
+
+def _client() -> kubernetes.client.ApiClient:
+    """Return the shared api client. It is only rebuilt if the token file (see TOKEN_PATH) changed"""
+    global _api_client, _api_client_token_mtime
+    token_path = os.getenv("TOKEN_PATH")
+    token_mtime = os.path.getmtime(token_path) if token_path else None
+    if _api_client and token_mtime == _api_client_token_mtime:
+        return _api_client
+    with _api_client_lock:
+        if not _api_client or token_mtime != _api_client_token_mtime:
+            if token_path:
+                # We only need to explictly auth if we use a token, otherwise kopf takes care of that for us
+                kubernetes.config.load_config()
+            configuration = kubernetes.client.Configuration.get_default_copy()
+            # One connection per executor thread so parallel handlers do not have to wait for a free connection
+            configuration.connection_pool_maxsize = max_workers()
+            configuration.socket_options = urllib3.connection.HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+            _api_client = kubernetes.client.ApiClient(configuration)
+            _api_client_token_mtime = token_mtime
+    return _api_client
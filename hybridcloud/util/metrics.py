@@ -0,0 +1,83 @@
+from contextlib import contextmanager
+import functools
+import time
+import kopf
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from ..config import config_get
+
+
+HANDLER_DURATION = Histogram("hybridcloud_postgresql_handler_duration_seconds", "Duration of handler runs", ["kind", "handler", "backend", "outcome"],
+                             buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800))
+HANDLERS_IN_FLIGHT = Gauge("hybridcloud_postgresql_handlers_in_flight", "Number of currently running handlers", ["kind"])
+HANDLERS_RETRYING = Gauge("hybridcloud_postgresql_handlers_retrying", "Number of objects whose last handler run failed and is waiting to be retried", ["kind"])
+EXTERNAL_CALLS = Counter("hybridcloud_postgresql_external_calls_total", "Calls to external systems (cloud APIs, postgres, helm)", ["system", "operation", "outcome"])
+EXTERNAL_CALL_DURATION = Histogram("hybridcloud_postgresql_external_call_duration_seconds", "Duration of calls to external systems (cloud APIs, postgres, helm)", ["system", "operation"],
+                                   buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+
+_retrying = dict()
+
+
+def start_server():
+    if config_get("metrics.enabled", default=True):
+        start_http_server(int(config_get("metrics.port", default=9090)))
+
+
+def observe_call(system, operation, duration, outcome="success"):
+    EXTERNAL_CALLS.labels(system, operation, outcome).inc()
+    EXTERNAL_CALL_DURATION.labels(system, operation).observe(duration)
+
+
+@contextmanager
+def track_call(system, operation):
+    """Record the duration and outcome of a call to an external system"""
+    outcome = "success"
+    start = time.monotonic()
+    try:
+        yield
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        observe_call(system, operation, time.monotonic() - start, outcome)
+
+
+def _handler_backend(kwargs):
+    status = kwargs.get("status") or dict()
+    spec = kwargs.get("spec") or dict()
+    return status.get("backend") or spec.get("backend") or config_get("backend", default="")
+
+
+def instrument_handler(kind):
+    """Decorator for the async kopf handlers to record duration, outcome, in-flight and retrying objects"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            backend = _handler_backend(kwargs)
+            uid = kwargs.get("uid")
+            retrying = _retrying.setdefault(kind, set())
+            outcome = "cancelled"
+            start = time.monotonic()
+            HANDLERS_IN_FLIGHT.labels(kind).inc()
+            try:
+                result = await fn(*args, **kwargs)
+                outcome = "success"
+                return result
+            except kopf.PermanentError:
+                outcome = "permanent_error"
+                raise
+            except kopf.TemporaryError:
+                outcome = "temporary_error"
+                raise
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                HANDLERS_IN_FLIGHT.labels(kind).dec()
+                HANDLER_DURATION.labels(kind, fn.__name__, backend, outcome).observe(time.monotonic() - start)
+                if outcome in ("temporary_error", "error"):
+                    retrying.add(uid)
+                elif outcome != "cancelled":
+                    retrying.discard(uid)
+                HANDLERS_RETRYING.labels(kind).set(len(retrying))
+        return wrapper
+    return decorator
@@ -0,0 +1,113 @@
+from collections.abc import Mapping
+import contextvars
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+from contextlib import contextmanager
+import kopf
+from ..config import config_get
+
+
+# Long-running cloud operations started by earlier runs of the handler, as stored in the status of the object (key -> state)
+_operations = contextvars.ContextVar("operations", default=None)
+
+
+class OperationPending(Exception):
+    """Raised by a backend when it started (or resumed) a long-running operation that is not finished yet.
+    The handler stores the state in the status and retries later instead of blocking until the operation is done"""
+
+    def __init__(self, key, state, delay=None, message=None):
+        super().__init__(message or f"Waiting for {key} to finish")
+        self.key = key
+        self.state = state
+        self.delay = delay or int(config_get("operations.poll_interval_seconds", default=20))
+
+
+@contextmanager
+def track(operations):
+    """Make the operations from the status available to the backend calls in this context.
+    Yields the dict that is updated with started (key -> state) and finished (key -> None) operations"""
+    operations = dict(operations or dict())
+    token = _operations.set(operations)
+    try:
+        yield operations
+    finally:
+        _operations.reset(token)
+
+
+def resumable():
+    """True if the handler stores pending operations, otherwise backends have to wait for operations to finish"""
+    return _operations.get() is not None
+
+
+def grace_seconds():
+    # How long to wait for an operation to finish before giving the handler slot back
+    return float(config_get("operations.grace_seconds", default=5))
+
+
+def _plain(value):
+    # kopf passes spec and status as read-only mapping views, which json can not serialize
+    if isinstance(value, Mapping):
+        return {str(k): _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    return value
+
+
+def fingerprint(request):
+    """Short hash of a request (e.g. the one that started an operation), to detect if a stored state is for an outdated request"""
+    return hashlib.sha256(json.dumps(_plain(request), sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def pending(key, request=None):
+    """Return the stored state of an operation started by an earlier run, None if there is none or it was for a different request"""
+    operations = _operations.get()
+    if operations is None:
+        return None
+    state = operations.get(key)
+    if not state:
+        return None
+    if request is not None and state.get("request") != fingerprint(request):
+        operations[key] = None
+        return None
+    return state
+
+
+def wait(key, state, request=None, delay=None):
+    """Remember the operation and give the handler slot back. Only call if resumable() is True"""
+    operations = _operations.get()
+    state = dict(state)
+    if request is not None:
+        state["request"] = fingerprint(request)
+    operations[key] = state
+    raise OperationPending(key, state, delay)
+
+
+def finished(key):
+    operations = _operations.get()
+    if operations is not None and operations.get(key):
+        operations[key] = None
+
+
+def timed_out(key, message, delay=20):
+    """Forget an operation that did not finish in time, so the next run of the handler starts it over, and give the handler slot back.
+    Goes through OperationPending so the handler also removes the operation from the status"""
+    finished(key)
+    if not resumable():
+        raise kopf.TemporaryError(message, delay=delay)
+    raise OperationPending(key, None, delay, message)
+
+
+def schedule(key, delay):
+    """Remember an operation that should only be started in delay seconds (e.g. a restart postponed to the maintenance window).
+    Unlike wait the handler finishes, a timer runs it again once the operation is due. Only call if resumable() is True"""
+    operations = _operations.get()
+    operations[key] = {"scheduled": (datetime.now(tz=timezone.utc) + timedelta(seconds=delay)).isoformat()}
+
+
+def next_scheduled(operations):
+    """Seconds until the earliest scheduled operation is due (0 if it is already due), None if no operation is scheduled"""
+    due = [datetime.fromisoformat(state["scheduled"]) for state in (operations or dict()).values() if state and "scheduled" in state]
+    if not due:
+        return None
+    return max(int((min(due) - datetime.now(tz=timezone.utc)).total_seconds()), 0)
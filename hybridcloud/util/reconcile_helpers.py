@@ -1,9 +1,10 @@
 import base64
 import kopf
 from . import k8s
+from .operations import fingerprint
 from ..util import env
 from ..util.password import generate_password
-from ..config import config_get
+from ..config import config, config_get
 
 
 def ignore_control_label_change(diff):
@@ -62,16 +63,25 @@ def field_from_spec(spec, path, default=None, fail_if_missing=False):
     return ptr
 
 
+def secret_outdated(secret, data):
+    """True if the secret does not exist or any of the values differs, e.g. because the backend now also provides a reader host.
+    A value of None marks a key that should no longer be in the secret (e.g. the proxy host after pooling was disabled)"""
+    if not secret:
+        return True
+    current = k8s.decode_secret_data(secret)
+    return any(current.get(key) != (None if value is None else str(value)) for key, value in data.items())
+
+
 def determine_resource_password(credentials_secret, tmp_secret_name):
     """Determine password to use for a resource by either
         * Reading the password from a credentials secret
         * Reading the password from a temporary secret while the resource is still being created (when the operator has to rerun the handler)
         * Generate a new password and store it in a temporary secret
     """
-    tmp_secret = k8s.get_secret(env.OPERATOR_NAMESPACE, tmp_secret_name)
     if credentials_secret:
-        password = base64.b64decode(credentials_secret.data["password"]).decode("utf-8")
-    elif tmp_secret:
+        return base64.b64decode(credentials_secret.data["password"]).decode("utf-8")
+    tmp_secret = k8s.get_secret(env.OPERATOR_NAMESPACE, tmp_secret_name)
+    if tmp_secret:
         password = base64.b64decode(tmp_secret.data["password"]).decode("utf-8")
     else:
         password = generate_password(int(config_get("security.password_length", default=16)), special_chars=config_get("security.special_characters", default=True))
@@ -83,3 +93,22 @@ def shorten(text):
     if len(text) > 63:
         return text[:63]
     return text
+
+
+def spec_fingerprint(spec, backend_name, *config_keys):
+    """Hash of everything a reconcile depends on: the spec, the backend and the relevant parts of the operator config"""
+    return fingerprint({
+        "spec": spec,
+        "backend": backend_name,
+        "config": {key: config_get(key) for key in ("backends",) + config_keys},
+        "overrides": config().overrides(),
+    })
+
+
+def unchanged_since_last_run(status, fingerprint, labels):
+    """True if the last run of the handler finished for exactly this fingerprint and no action was requested"""
+    if not config_get("reconcile.skip_unchanged", default=True):
+        return False
+    if not status or has_label(labels, "operator/action"):
+        return False
+    return status.get("fingerprint") == fingerprint and status.get("deployment", dict()).get("status") == "finished" and not status.get("operations")
@@ -0,0 +1,51 @@
+from contextlib import contextmanager
+import functools
+from opentelemetry import trace
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+from ..config import config_get
+
+
+# Until setup is called (and if tracing is disabled) this is a no-op tracer
+_tracer = trace.get_tracer("hybrid-cloud-postgresql-operator")
+
+
+def setup():
+    """Configure the span exporter, either a local file with one json span per line or an OTLP (http) collector"""
+    if not config_get("tracing.enabled", default=False):
+        return
+    exporter = config_get("tracing.exporter", default="file")
+    if exporter == "otlp":
+        # Endpoint can also be configured via the standard OTEL_EXPORTER_OTLP_* environment variables
+        exporter = OTLPSpanExporter(endpoint=config_get("tracing.endpoint"))
+    else:
+        out = open(config_get("tracing.file", default="traces.jsonl"), "a")
+        exporter = ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n")
+    provider = TracerProvider(resource=Resource.create({"service.name": "hybrid-cloud-postgresql-operator"}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Run the block in a child span of the current span (e.g. of the handler)"""
+    with _tracer.start_as_current_span(name, attributes={k: v for k, v in attributes.items() if v is not None}) as current:
+        yield current
+
+
+def start_span(name, **attributes):
+    """Start a span without making it the current one, the caller has to end it"""
+    return _tracer.start_span(name, attributes={k: v for k, v in attributes.items() if v is not None})
+
+
+def traced_handler(kind):
+    """Decorator for the async kopf handlers to run each handler invocation in a root span"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(f"{kind}.{fn.__name__}", **{"k8s.kind": kind, "k8s.namespace": kwargs.get("namespace"), "k8s.name": kwargs.get("name"), "kopf.retry": kwargs.get("retry")}):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
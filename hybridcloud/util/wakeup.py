@@ -0,0 +1,52 @@
+import asyncio
+from contextlib import contextmanager
+
+
+# Pending waiters per key, e.g. the databases waiting for a (namespace, server name) to become ready
+_events = dict()
+_waiters = dict()
+
+
+@contextmanager
+def waiter(key):
+    """Register as waiting for the key and return the event notify sets. Register before checking whether waiting
+    is needed at all, otherwise a notify between the check and the wait is lost"""
+    event = _events.get(key)
+    if not event:
+        event = asyncio.Event()
+        _events[key] = event
+    _waiters[key] = _waiters.get(key, 0) + 1
+    try:
+        yield event
+    finally:
+        _waiters[key] -= 1
+        if not _waiters[key]:
+            del _waiters[key]
+            if _events.get(key) is event:
+                del _events[key]
+
+
+async def wait(event, timeout):
+    """Wait until the event from waiter() is set. Returns False if the timeout is reached first"""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+async def wait_for(key, timeout):
+    """Wait until notify is called for the key. Returns False if the timeout is reached first"""
+    with waiter(key) as event:
+        return await wait(event, timeout)
+
+
+def notify(key):
+    """Wake up everyone waiting for the key. Must be called from the event loop"""
+    event = _events.pop(key, None)
+    if event:
+        event.set()
+
+
+def pending(key):
+    return _waiters.get(key, 0)